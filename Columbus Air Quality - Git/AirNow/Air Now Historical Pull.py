@@ -1,7 +1,15 @@
 import requests
 import datetime
 import pandas as pd
-import time
+import os
+import sys
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Http_Client import BATCH_RETRY_AFTER_MAX, http_get
+
+# Pulls a range into a local CSV for a quick look. To fill the storage the live collectors write to,
+# use Backfill/Backfill.py, which fetches every source in parallel and resumes interrupted runs.
 
 # AirNow API configuration (replace with your actual key)
 AIRNOW_API_KEY = 'YOUR_AIRNOW_API_KEY'
@@ -12,8 +20,13 @@ DISTANCE = 15
 START_DATE = datetime.datetime(year=2024, month=9, day=7)
 END_DATE = datetime.datetime(year=2024, month=9, day=9)
 
-# List to store the data for each day
+# Times a day is requested before it is given up on
+DAY_ATTEMPTS = 3
+
+# List to store the data for each day, and the days that could not be fetched
 all_data = []
+failed_days = []
+attempt = 1
 
 # Go through each day in the date range
 current_date = START_DATE
@@ -25,16 +38,8 @@ while current_date <= END_DATE:
     api_url = f"https://www.airnowapi.org/aq/observation/zipCode/historical/?format=application/json&zipCode={ZIP_CODE}&date={date_str}&distance={DISTANCE}&API_KEY={AIRNOW_API_KEY}"
 
     try:
-        response = requests.get(api_url)
-
-        # Check if we hit the API's rate limit
-        if response.status_code == 429:
-            # If so, wait for the specified time before trying again
-            retry_after = int(response.headers.get('Retry-After', 60))
-            print(f"Rate limit reached. Retrying after {retry_after} seconds...")
-            time.sleep(retry_after)
-            continue
-
+        # Rate limits (429 with Retry-After) are waited out by the client, up to BATCH_RETRY_AFTER_MAX
+        response = http_get('airnow', api_url, max_wait=BATCH_RETRY_AFTER_MAX)
         response.raise_for_status()
 
         data = response.json()
@@ -45,10 +50,19 @@ while current_date <= END_DATE:
             print(f"Unexpected data format for {current_date}: {data}")
 
     except requests.exceptions.RequestException as e:
-        print(f"An error occurred for {current_date}: {e}")
+        print(f"An error occurred for {current_date} (attempt {attempt} of {DAY_ATTEMPTS}): {e}")
+        if attempt < DAY_ATTEMPTS:
+            # Ask for the same day again
+            attempt += 1
+            continue
+        failed_days.append(current_date)
 
     # Move to the next day
     current_date += datetime.timedelta(days=1)
+    attempt = 1
+
+if failed_days:
+    print(f"No data for {', '.join(day.strftime('%Y-%m-%d') for day in failed_days)}, run those days again")
 
 # If we got any data, organize it and save it
 if all_data:
@@ -1,16 +1,29 @@
 import schedule
-import datetime
 import time
+import datetime
+import math
 import requests
 import pandas as pd
-from google.cloud import storage
 import os
-import tempfile
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+import Clock
+from AQI_Calculator import POLLUTANTS
+from Dtype_Policy import apply_dtype_policy
+from Http_Client import http_get
+from Locations import active_locations, MAX_CONCURRENT_LOCATIONS
+from Nowcast import NOWCAST_FILENAME, nowcast
+from Staging import UPSERT_KEYS, flush, stage_object, stage_upserts
+from Storage import get_storage_client, location_blob_name
 
 # AirNow API configuration (replace with your actual key)
+# The ZIP code searched for each location is set in Common/Locations.py
 AIRNOW_API_KEY = 'YOUR_AIRNOW_API_KEY'
-ZIP_CODE = "43215"
 DISTANCE = 15  # Search radius in miles
+CONCENTRATION_HOURS = 3  # Hours of monitor readings fetched every run, late readings are picked up by the next runs
 
 # Google Cloud Storage configuration (replace with your actual service account key file path)
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'PATH_TO_YOUR_SERVICE_ACCOUNT_KEY_FILE.json'
@@ -19,30 +32,39 @@ STORAGE_BUCKET_NAME = 'YOUR_STORAGE_BUCKET_NAME'
 # File names within the storage bucket
 ALL_AIR_QUALITY_DATA_FILENAME = 'air_quality_data_all.csv'
 CURRENT_AQI_FILENAME = 'current-aqi.csv'
+POLLUTANT_CONCENTRATIONS_FILENAME = 'pollutant_concentrations_all.csv'
+
+# AirNow's parameter names for the pollutants the AQI is computed from
+AIRNOW_PARAMETERS = {'OZONE': 'OZONE', 'PM2.5': 'PM25', 'PM10': 'PM10', 'CO': 'CO', 'NO2': 'NO2', 'SO2': 'SO2'}
 
 def get_and_save_air_quality_data():
     """
-    Fetches current air quality data and saves it to cloud storage.
+    Fetches current air quality data for every location at the same time.
     """
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOCATIONS) as pool:
+        list(pool.map(get_and_save_location_air_quality_data, active_locations()))
 
-    try:
-        # Get today's date in EST timezone
-        est_timezone = datetime.timezone(datetime.timedelta(hours=-4))
-        today = datetime.datetime.now(tz=est_timezone).strftime('%Y-%m-%d')
 
+def get_and_save_location_air_quality_data(location):
+    """
+    Fetches current air quality data for one location and stages it for its cloud storage partition.
+    """
+
+    try:
         # Build the web address to get air quality data
-        url = f"https://www.airnowapi.org/aq/observation/zipCode/current/?format=application/json&zipCode={ZIP_CODE}&distance={DISTANCE}&API_KEY={AIRNOW_API_KEY}"
+        url = f"https://www.airnowapi.org/aq/observation/zipCode/current/?format=application/json&zipCode={location['zip_code']}&distance={DISTANCE}&API_KEY={AIRNOW_API_KEY}"
 
         # Get the air quality data
-        response = requests.get(url)
+        response = http_get('airnow', url)
         response.raise_for_status()
 
         data = response.json()
 
         if data:
-            # Organize the air quality data into a table
+            # Organize the air quality data into a table, stamped with when each observation was made
             air_quality_data = pd.DataFrame([{
-                'date': today,
+                'date': item['DateObserved'].strip(),
+                'hour': item['HourObserved'],
                 'location': item['ReportingArea'],
                 'parameter_name': item['ParameterName'],
                 'aqi': item['AQI'],
@@ -51,46 +73,123 @@ def get_and_save_air_quality_data():
 
             # Convert 'date' column to month/day/year format
             air_quality_data['date'] = pd.to_datetime(air_quality_data['date']).dt.strftime('%m/%-d/%Y')
+            air_quality_data = apply_dtype_policy(air_quality_data)
 
-            # Connect to cloud storage
-            storage_client = storage.Client()
-            bucket = storage_client.bucket(STORAGE_BUCKET_NAME)
-
-            # Save all air quality data to cloud storage
-            all_data_blob = bucket.blob(ALL_AIR_QUALITY_DATA_FILENAME)
-            if all_data_blob.exists():
-                # Add new data to existing file
-                with tempfile.NamedTemporaryFile(mode='w+', delete=False) as temp_file:
-                    all_data_blob.download_to_filename(temp_file.name)
-                    existing_data = pd.read_csv(temp_file.name)
-                updated_data = pd.concat([existing_data, air_quality_data], ignore_index=True)
-                all_data_blob.upload_from_string(updated_data.to_csv(index=False), content_type='text/csv')
-                os.remove(temp_file.name)
-            else:
-                # Create a new file for air quality data
-                all_data_blob.upload_from_string(air_quality_data.to_csv(index=False), content_type='text/csv')
+            # Stage the new or changed observations, the flusher appends them to cloud storage in batches.
+            # An observation already staged is skipped, so hourly re-runs and retries do not add copies.
+            n_staged = stage_upserts(STORAGE_BUCKET_NAME,
+                                     location_blob_name(location, ALL_AIR_QUALITY_DATA_FILENAME),
+                                     air_quality_data, UPSERT_KEYS[ALL_AIR_QUALITY_DATA_FILENAME])
 
             # Save the highest AQI value
             max_aqi_data = pd.DataFrame({'Current AQI': [air_quality_data['aqi'].max()]})
 
-            # Overwrite the 'current-aqi' file with the highest AQI
-            current_aqi_blob = bucket.blob(CURRENT_AQI_FILENAME)
-            current_aqi_blob.upload_from_string(max_aqi_data.to_csv(index=False), content_type='text/csv')
+            # Stage the 'current-aqi' file with the highest AQI, it replaces the old one on the next flush
+            stage_object(STORAGE_BUCKET_NAME, location_blob_name(location, CURRENT_AQI_FILENAME),
+                         max_aqi_data.to_csv(index=False))
+
+            print(f"Air quality data for {location['name']} fetched, {n_staged} new observations staged!")
 
-            print(f"Air quality data fetched and saved successfully!")
-            print(f"Maximum AQI exported and 'current-aqi' dataset overwritten successfully!")
+            # Correct today's and tomorrow's model forecast with the new reading, published with the next flush
+            try:
+                observed_at = pd.to_datetime(data[0]['DateObserved'].strip()) + pd.Timedelta(hours=data[0]['HourObserved'])
+                adjusted = nowcast(location, observed_at, float(max_aqi_data['Current AQI'].iloc[0]),
+                                   get_storage_client())
+                if adjusted is not None:
+                    stage_object(STORAGE_BUCKET_NAME, location_blob_name(location, NOWCAST_FILENAME),
+                                 adjusted.to_csv(index=False))
+            except Exception as e:
+                print(f"Error updating the nowcast for {location['name']}: {e}")
 
         else:
-            print("No air quality data available for this location and date.")
+            print(f"No air quality data available for {location['name']} and this date.")
 
     except requests.exceptions.RequestException as e:
-        print(f"API Error: {e}")
+        print(f"API Error for {location['name']}: {e}")
+
+
+def get_and_save_concentration_data():
+    """
+    Fetches the latest hourly pollutant concentrations of every monitor around every location at the same time.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOCATIONS) as pool:
+        list(pool.map(get_and_save_location_concentration_data, active_locations()))
+
+
+def monitor_box(location):
+    """
+    Returns the box (west, south, east, north) DISTANCE miles around the location, as AirNow expects it.
+    """
+    latitude, longitude = location['coordinates']
+    latitude_delta = DISTANCE / 69.0
+    longitude_delta = DISTANCE / (69.0 * math.cos(math.radians(latitude)))
+    return (f"{longitude - longitude_delta:.4f},{latitude - latitude_delta:.4f},"
+            f"{longitude + longitude_delta:.4f},{latitude + latitude_delta:.4f}")
+
+
+def get_and_save_location_concentration_data(location):
+    """
+    Fetches the raw hourly concentrations of the monitors around one location and stages them.
+
+    The AQI of every pollutant is computed from these (AQI_Calculator.py) when
+    the master dataset is built, instead of relying on the AQI AirNow reports.
+    """
+
+    try:
+        # AirNow takes hours in UTC
+        end = Clock.now(datetime.timezone.utc)
+        start = end - datetime.timedelta(hours=CONCENTRATION_HOURS)
+        parameters = ','.join(AIRNOW_PARAMETERS.values())
+        url = (f"https://www.airnowapi.org/aq/data/?startDate={start.strftime('%Y-%m-%dT%H')}"
+               f"&endDate={end.strftime('%Y-%m-%dT%H')}&parameters={parameters}&BBOX={monitor_box(location)}"
+               f"&dataType=C&format=application/json&verbose=1&monitorType=0&includerawconcentrations=1"
+               f"&API_KEY={AIRNOW_API_KEY}")
+
+        response = http_get('airnow', url)
+        response.raise_for_status()
+
+        readings = [item for item in response.json() if item['Parameter'] in POLLUTANTS]
+
+        if readings:
+            # AirNow marks a missing raw reading with -999
+            concentrations = pd.DataFrame([{
+                'utc': item['UTC'],
+                'site': item['FullAQSCode'],
+                'site_name': item['SiteName'],
+                'parameter': item['Parameter'],
+                'unit': item['Unit'],
+                'concentration': item['RawConcentration'] if item['RawConcentration'] > -999 else None,
+            } for item in readings])
+            concentrations = apply_dtype_policy(concentrations)
+
+            n_staged = stage_upserts(STORAGE_BUCKET_NAME,
+                                     location_blob_name(location, POLLUTANT_CONCENTRATIONS_FILENAME),
+                                     concentrations, UPSERT_KEYS[POLLUTANT_CONCENTRATIONS_FILENAME])
+            print(f"Pollutant concentrations for {location['name']} fetched, {n_staged} new readings staged!")
+
+        else:
+            print(f"No monitor readings available for {location['name']} and these hours.")
+
+    except requests.exceptions.RequestException as e:
+        print(f"API Error for {location['name']}: {e}")
+
+
+def schedule_jobs(scheduler=schedule.default_scheduler):
+    """
+    Schedules this script's jobs (the replay harness reads them from here too).
+    """
+    # Schedule the task to run every hour
+    scheduler.every().hour.do(get_and_save_air_quality_data)
+    scheduler.every().hour.do(get_and_save_concentration_data)
+
+    # Push the staged data to cloud storage once it is due (the current AQI goes up within a minute)
+    scheduler.every().minute.do(flush)
 
 
-# Schedule the task to run every hour
-schedule.every().hour.do(get_and_save_air_quality_data)
+if __name__ == '__main__':
+    schedule_jobs()
 
-# Keep the script running to check for scheduled tasks
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+    # Keep the script running to check for scheduled tasks
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
\ No newline at end of file
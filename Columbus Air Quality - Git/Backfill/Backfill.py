@@ -0,0 +1,347 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from io import StringIO
+
+import pandas as pd
+import requests
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Dtype_Policy import apply_dtype_policy
+from Http_Client import BATCH_RETRY_AFTER_MAX, http_get
+from Locations import active_locations
+from Staging import STAGING_DB_PATH, UPSERT_KEYS, connect, flush, stage_rows, stage_upserts, transaction
+from Storage import location_blob_name
+
+# API keys (replace with your actual keys, the same as in the collectors)
+AIRNOW_API_KEY = 'YOUR_AIRNOW_API_KEY'
+WEATHERSTACK_API_KEY = 'YOUR_WEATHERSTACK_API_KEY'
+EIA_API_KEY = 'YOUR_EIA_API_KEY'
+NASA_FIRMS_API_KEY = 'YOUR_NASA_FIRMS_API_KEY'
+
+# Google Cloud Storage configuration (replace with your actual service account key file path)
+os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'PATH_TO_YOUR_SERVICE_ACCOUNT_KEY_FILE.json'
+
+# Buckets the live data is read from (replace with your actual bucket names, the same as in Feature_Engineering.py)
+BUCKET_NAMES = {
+    'airnow': 'columbus-aqi-bucket',
+    'weather': 'columbus-weather-bucket',
+    'energy': 'energy-generation-bucket',
+    'wildfire': 'columbus-wildfire-bucket',
+}
+
+# Files the live collectors write, so the backfilled rows land next to theirs
+ALL_AIR_QUALITY_DATA_FILENAME = 'air_quality_data_all.csv'
+ALL_WEATHER_DATA_FILENAME = 'weather_data_all.csv'
+ALL_ENERGY_DATA_FILENAME = 'eia_data_all.csv'
+BINNED_WILDFIRE_DATA_FILENAME = 'wildfire_data_binned.csv'
+
+# Hours the weather is collected at (the same as in WeatherCurrentPull.py)
+WEATHER_HOURS = [4, 16]
+
+# AirNow search radius in miles (the same as in AirNow.py)
+DISTANCE = 15
+
+# FIRMS source and area. Standard processing covers the archive, MODIS_NRT only the last two months.
+FIRMS_DATA_SOURCE = 'MODIS_SP'
+AREA_COORDINATES = '-140.8,12.7,-50.9,69.9'  # North and Central America (the same as in WildfireCurrent.py)
+
+# Days in one work unit, the most every API returns in one request
+CHUNK_DAYS = {
+    'airnow': 1,
+    'weather': 60,
+    'energy': 7,  # A week of hourly PJM fuel types fits in one EIA page
+    'wildfire': 10,
+}
+
+# Units of one source fetched at the same time. The shared rate budgets in Http_Client.py
+# keep them (and the live collectors) within every provider's quota.
+MAX_CONCURRENT_UNITS = {
+    'airnow': 4,
+    'weather': 4,
+    'energy': 2,
+    'wildfire': 2,
+}
+
+# Staged rows are pushed to cloud storage after this many units, so a long run does not pile them up
+FLUSH_EVERY_UNITS = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+    source TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (source, unit)
+) WITHOUT ROWID;
+"""
+
+
+def connect_checkpoints(path=STAGING_DB_PATH):
+    # Kept in the staging store, so a unit's rows and its checkpoint are committed together
+    connection = connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def date_chunks(start, end, days):
+    """
+    Splits the days from `start` to `end` (both included) into (first, last) chunks of up to `days` days.
+    """
+    chunks = []
+    while start <= end:
+        last = min(start + datetime.timedelta(days=days - 1), end)
+        chunks.append((start, last))
+        start = last + datetime.timedelta(days=1)
+    return chunks
+
+
+def categorize_country(latitude):
+    # The same split as WildfireCurrent.py
+    if latitude > 49:
+        return 'Canada'
+    elif latitude > 29:
+        return 'USA'
+    else:
+        return 'Central America'
+
+
+def fetch_air_quality(location, first, last):
+    """
+    Gets one day of AirNow observations for a location, in the rows AirNow.py writes.
+    """
+    date_str = first.strftime("%Y-%m-%dT00-0000")
+    url = f"https://www.airnowapi.org/aq/observation/zipCode/historical/?format=application/json&zipCode={location['zip_code']}&date={date_str}&distance={DISTANCE}&API_KEY={AIRNOW_API_KEY}"
+    response = http_get('airnow', url, max_wait=BATCH_RETRY_AFTER_MAX)
+    response.raise_for_status()
+
+    data = response.json()
+    if not isinstance(data, list) or not data:
+        return []
+
+    air_quality_data = pd.DataFrame([{
+        'date': item['DateObserved'].strip(),
+        'hour': item['HourObserved'],
+        'location': item['ReportingArea'],
+        'parameter_name': item['ParameterName'],
+        'aqi': item['AQI'],
+        'category': item['Category']['Name']
+    } for item in data])
+    air_quality_data['date'] = pd.to_datetime(air_quality_data['date']).dt.strftime('%m/%-d/%Y')
+
+    return [(BUCKET_NAMES['airnow'], location_blob_name(location, ALL_AIR_QUALITY_DATA_FILENAME),
+             apply_dtype_policy(air_quality_data), UPSERT_KEYS[ALL_AIR_QUALITY_DATA_FILENAME])]
+
+
+def fetch_weather(location, first, last):
+    """
+    Gets the weather of the hours WeatherCurrentPull.py collects for a location, in the rows it writes.
+    """
+    params = {
+        "access_key": WEATHERSTACK_API_KEY,
+        "query": location['weather_query'],
+        "historical_date_start": first.strftime('%Y-%m-%d'),
+        "historical_date_end": last.strftime('%Y-%m-%d'),
+        "hourly": 1,
+        "interval": 1
+    }
+    response = http_get('weatherstack', "http://api.weatherstack.com/historical", params=params,
+                        max_wait=BATCH_RETRY_AFTER_MAX)
+    response.raise_for_status()
+
+    data = response.json()
+    if 'error' in data:
+        # Weatherstack reports errors with a 200, raise them like a failed request so the unit is retried
+        raise requests.exceptions.RequestException(f"Weatherstack error: {data['error'].get('info')}")
+
+    rows = []
+    for day in (data.get('historical') or {}).values():
+        for reading in day.get('hourly', []):
+            # Times come as 0, 100, ..., 2300
+            hour = int(reading['time']) // 100
+            if hour not in WEATHER_HOURS:
+                continue
+            rows.append({
+                'date': pd.Timestamp(day['date']).strftime('%-m/%-d/%Y'),
+                'hour': hour,
+                'temperature': reading['temperature'],
+                'description': reading['weather_descriptions'],
+                'humidity': reading['humidity'],
+                'wind_speed': reading['wind_speed'],
+                'wind_dir': reading['wind_dir'],
+                'pressure': reading['pressure'],
+                'precip': reading['precip'],
+                'cloudcover': reading['cloudcover'],
+                'feelslike': reading['feelslike'],
+                'uv_index': reading['uv_index'],
+                'visibility': reading['visibility']
+            })
+    if not rows:
+        return []
+    return [(BUCKET_NAMES['weather'], location_blob_name(location, ALL_WEATHER_DATA_FILENAME),
+             apply_dtype_policy(pd.DataFrame(rows)), UPSERT_KEYS[ALL_WEATHER_DATA_FILENAME])]
+
+
+def fetch_energy(location, first, last):
+    """
+    Gets the hourly PJM generation by fuel type, in the rows Energy_Current.py writes.
+    """
+    headers = {
+        "X-Params": json.dumps({
+            "frequency": "local-hourly",
+            "data": ["value"],
+            "facets": {"respondent": ["PJM"]},
+            "start": f"{first.strftime('%Y-%m-%d')}T00-00:00",
+            "end": f"{last.strftime('%Y-%m-%d')}T23-00:00",
+            "sort": [{"column": "period", "direction": "desc"}],
+            "offset": 0,
+            "length": 5000
+        })
+    }
+    response = http_get('eia', "https://api.eia.gov/v2/electricity/rto/fuel-type-data/data/",
+                        headers=headers, params={"api_key": EIA_API_KEY, "data[]": "value"},
+                        max_wait=BATCH_RETRY_AFTER_MAX)
+    response.raise_for_status()
+
+    data = response.json().get('response', {})
+    if int(data.get('total', 0)) > len(data.get('data', [])):
+        print(f"EIA returned {len(data['data'])} of {data['total']} rows for {first:%Y-%m-%d}, lower CHUNK_DAYS['energy']")
+    if not data.get('data'):
+        return []
+    return [(BUCKET_NAMES['energy'], ALL_ENERGY_DATA_FILENAME, apply_dtype_policy(pd.DataFrame(data['data'])),
+             UPSERT_KEYS[ALL_ENERGY_DATA_FILENAME])]
+
+
+def fetch_wildfire(location, first, last):
+    """
+    Gets the fires of up to 10 days, summarized by country and day the way WildfireCurrent.py does.
+    """
+    days = (last - first).days + 1
+    api_endpoint = f"https://firms.modaps.eosdis.nasa.gov/api/area/csv/{NASA_FIRMS_API_KEY}/{FIRMS_DATA_SOURCE}/{AREA_COORDINATES}/{days}/{first.strftime('%Y-%m-%d')}"
+    response = http_get('firms', api_endpoint, max_wait=BATCH_RETRY_AFTER_MAX)
+    response.raise_for_status()
+
+    wildfire_data = pd.read_csv(StringIO(response.text))
+    if wildfire_data.empty or 'latitude' not in wildfire_data.columns:
+        return []
+
+    wildfire_data['Country'] = wildfire_data['latitude'].apply(categorize_country)
+    summary = wildfire_data.groupby(['acq_date', 'Country'])['frp'].sum().reset_index()
+    summary['Date'] = pd.to_datetime(summary['acq_date']).dt.strftime('%m/%d/%Y')
+    summary = apply_dtype_policy(summary[['Country', 'frp', 'Date']], BINNED_WILDFIRE_DATA_FILENAME)
+    return [(BUCKET_NAMES['wildfire'], BINNED_WILDFIRE_DATA_FILENAME, summary,
+             UPSERT_KEYS[BINNED_WILDFIRE_DATA_FILENAME])]
+
+
+# How every source is backfilled: the provider whose budget it draws from, whether it is
+# collected per location, and the function that fetches one unit
+SOURCES = {
+    'airnow': {'provider': 'airnow', 'per_location': True, 'fetch': fetch_air_quality},
+    'weather': {'provider': 'weatherstack', 'per_location': True, 'fetch': fetch_weather},
+    'energy': {'provider': 'eia', 'per_location': False, 'fetch': fetch_energy},
+    'wildfire': {'provider': 'firms', 'per_location': False, 'fetch': fetch_wildfire},
+}
+
+
+def work_units(source, start, end, locations):
+    """
+    Lists the (unit name, location, first day, last day) units of a source.
+    """
+    units = []
+    for first, last in date_chunks(start, end, CHUNK_DAYS[source]):
+        if SOURCES[source]['per_location']:
+            units += [(f"{location['slug']}/{first:%Y-%m-%d}/{last:%Y-%m-%d}", location, first, last)
+                      for location in locations]
+        else:
+            units.append((f"{first:%Y-%m-%d}/{last:%Y-%m-%d}", None, first, last))
+    return units
+
+
+def completed_units(source, path=STAGING_DB_PATH):
+    with closing(connect_checkpoints(path)) as connection:
+        return {unit for (unit,) in connection.execute('SELECT unit FROM backfill_checkpoints WHERE source = ?',
+                                                       (source,))}
+
+
+def run_unit(source, unit, location, first, last, path=STAGING_DB_PATH):
+    """
+    Fetches one unit and stages its rows together with its checkpoint.
+
+    Returns the number of rows staged. A failed unit is not checkpointed, so the next run fetches it again.
+    """
+    outputs = SOURCES[source]['fetch'](location, first, last)
+
+    n_staged = 0
+    with closing(connect_checkpoints(path)) as connection, transaction(connection):
+        for bucket_name, blob_name, df, key_columns in outputs:
+            if key_columns:
+                n_staged += stage_upserts(bucket_name, blob_name, df, key_columns, connection=connection)
+            else:
+                stage_rows(bucket_name, blob_name, df, connection=connection)
+                n_staged += len(df)
+        connection.execute('INSERT OR REPLACE INTO backfill_checkpoints VALUES (?, ?, ?, ?)',
+                           (source, unit, n_staged, time.time()))
+    return n_staged
+
+
+def backfill(start, end, sources, locations, push=True):
+    """
+    Backfills `sources` from `start` to `end` for `locations`.
+
+    Every source gets its own pool of workers, so the providers are fetched at
+    the same time while each stays within its rate budget. Units finished by an
+    earlier run are skipped.
+    """
+    pools = {source: ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UNITS[source]) for source in sources}
+    futures = {}
+    for source in sources:
+        done = completed_units(source)
+        pending = [unit for unit in work_units(source, start, end, locations) if unit[0] not in done]
+        print(f"{source}: {len(pending)} units to fetch, {len(done)} already done")
+        for unit in pending:
+            futures[pools[source].submit(run_unit, source, *unit)] = (source, unit[0])
+
+    n_done, n_failed = 0, 0
+    try:
+        for future in as_completed(futures):
+            source, unit = futures[future]
+            try:
+                n_staged = future.result()
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                # Left without a checkpoint, the next run picks it up again
+                n_failed += 1
+                print(f"Error backfilling {source} {unit}: {e}")
+                continue
+
+            n_done += 1
+            print(f"{source} {unit}: {n_staged} rows staged")
+            if push and n_done % FLUSH_EVERY_UNITS == 0:
+                flush(force=True)
+    finally:
+        for pool in pools.values():
+            pool.shutdown(cancel_futures=True)
+
+    if push:
+        flush(force=True)
+    print(f"Backfill finished: {n_done} units done, {n_failed} failed (run again to retry them)")
+    return n_failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Backfills historical data into the same files the live collectors write. '
+                    'Interrupted runs resume where they stopped. (Traffic has no historical API to backfill from.)')
+    parser.add_argument('--start', required=True, type=datetime.date.fromisoformat, help='First day, YYYY-MM-DD')
+    parser.add_argument('--end', required=True, type=datetime.date.fromisoformat, help='Last day, YYYY-MM-DD')
+    parser.add_argument('--sources', nargs='+', choices=list(SOURCES), default=list(SOURCES))
+    parser.add_argument('--no-flush', action='store_true',
+                        help='Leave the rows staged for the flusher instead of pushing them at the end')
+    args = parser.parse_args()
+
+    sys.exit(1 if backfill(args.start, args.end, args.sources, active_locations(), push=not args.no_flush) else 0)
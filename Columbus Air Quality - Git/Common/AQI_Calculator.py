@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# EPA AQI breakpoints as (lowest concentration, highest concentration, lowest AQI, highest AQI), in the units
+# AirNow reports them in. PM2.5 follows the 2024 revision. Concentrations are truncated to `decimals` first.
+# `average_hours` is the averaging time of the table, `nowcast` marks the pollutants whose hourly AQI
+# comes from the NowCast instead of the plain average.
+POLLUTANTS = {
+    'PM2.5': {
+        'unit': 'UG/M3', 'decimals': 1, 'average_hours': 24, 'nowcast': True,
+        'breakpoints': [(0.0, 9.0, 0, 50), (9.1, 35.4, 51, 100), (35.5, 55.4, 101, 150),
+                        (55.5, 125.4, 151, 200), (125.5, 225.4, 201, 300), (225.5, 325.4, 301, 500)],
+    },
+    'PM10': {
+        'unit': 'UG/M3', 'decimals': 0, 'average_hours': 24, 'nowcast': True,
+        'breakpoints': [(0, 54, 0, 50), (55, 154, 51, 100), (155, 254, 101, 150),
+                        (255, 354, 151, 200), (355, 424, 201, 300), (425, 604, 301, 500)],
+    },
+    'OZONE': {
+        'unit': 'PPB', 'decimals': 0, 'average_hours': 8, 'nowcast': False,
+        'breakpoints': [(0, 54, 0, 50), (55, 70, 51, 100), (71, 85, 101, 150),
+                        (86, 105, 151, 200), (106, 200, 201, 300)],
+    },
+    'CO': {
+        'unit': 'PPM', 'decimals': 1, 'average_hours': 8, 'nowcast': False,
+        'breakpoints': [(0.0, 4.4, 0, 50), (4.5, 9.4, 51, 100), (9.5, 12.4, 101, 150),
+                        (12.5, 15.4, 151, 200), (15.5, 30.4, 201, 300), (30.5, 50.4, 301, 500)],
+    },
+    'NO2': {
+        'unit': 'PPB', 'decimals': 0, 'average_hours': 1, 'nowcast': False,
+        'breakpoints': [(0, 53, 0, 50), (54, 100, 51, 100), (101, 360, 101, 150),
+                        (361, 649, 151, 200), (650, 1249, 201, 300), (1250, 2049, 301, 500)],
+    },
+    'SO2': {
+        'unit': 'PPB', 'decimals': 0, 'average_hours': 1, 'nowcast': False,
+        'breakpoints': [(0, 35, 0, 50), (36, 75, 51, 100), (76, 185, 101, 150),
+                        (186, 304, 151, 200), (305, 604, 201, 300), (605, 1004, 301, 500)],
+    },
+}
+
+# Ozone also has a 1-hour table, starting at 125 ppb. Where a 1-hour value falls in it, the higher of the
+# two AQIs is the ozone AQI. The 8-hour table ends at 200 ppb, above that only the 1-hour table counts.
+OZONE_1_HOUR_BREAKPOINTS = [(125, 164, 101, 150), (165, 204, 151, 200), (205, 404, 201, 300), (405, 604, 301, 500)]
+
+# NowCast settings: hours weighed, the lowest weight factor, and how many of the 3 latest hours must be there
+NOWCAST_HOURS = 12
+NOWCAST_MIN_WEIGHT = 0.5
+NOWCAST_RECENT_REQUIRED = 2
+
+# An average needs at least this share of its hours
+MIN_COMPLETENESS = 0.75
+
+
+def feature_name(pollutant):
+    return f"AQI_{pollutant.replace('.', '')}"
+
+
+def feature_names():
+    """
+    Returns the names of the per-pollutant AQI columns added to the master dataset.
+    """
+    return [feature_name(pollutant) for pollutant in POLLUTANTS]
+
+
+def truncate(values, decimals):
+    # The small offset keeps values like 35.4 from becoming 35.39999 and truncating down a step
+    scale = 10 ** decimals
+    return np.floor(np.asarray(values, dtype=float) * scale + 1e-6) / scale
+
+
+def concentration_to_aqi(values, breakpoints, decimals, above=500):
+    """
+    Turns concentrations into AQI values with a breakpoint table, a whole array at a time.
+
+    Values below the first breakpoint are 0, values past the last one are
+    `above`, missing values stay missing. With a table that does not start at
+    0 (the 1-hour ozone table), values below it are missing.
+    """
+    table = np.array(breakpoints, dtype=float)
+    c_low, c_high, i_low, i_high = table.T
+    values = truncate(values, decimals)
+    index = np.clip(np.searchsorted(c_low, values, side='right') - 1, 0, len(table) - 1)
+    clipped = np.clip(values, c_low[index], c_high[index])
+    aqi = (i_high[index] - i_low[index]) / (c_high[index] - c_low[index]) * (clipped - c_low[index]) + i_low[index]
+    # The EPA rounds halves up
+    aqi = np.floor(aqi + 0.5)
+    aqi[values > c_high[-1]] = above
+    if c_low[0] > 0:
+        aqi[values < c_low[0]] = np.nan
+    aqi[np.isnan(values)] = np.nan
+    return aqi
+
+
+def pollutant_aqi_values(values, pollutant):
+    """
+    Returns the AQI of concentrations of `pollutant` averaged over its table's averaging time.
+    """
+    settings = POLLUTANTS[pollutant]
+    # Past the 8-hour ozone table the AQI is missing, so the 1-hour value decides
+    above = np.nan if pollutant == 'OZONE' else 500
+    return concentration_to_aqi(values, settings['breakpoints'], settings['decimals'], above)
+
+
+def hourly_grid(hourly):
+    """
+    Puts a table of hourly concentrations (one column per monitor) on an unbroken hourly index.
+    """
+    if hourly.empty:
+        return hourly
+    index = pd.date_range(hourly.index.min().floor('h'), hourly.index.max().floor('h'), freq='h')
+    return hourly.groupby(hourly.index.floor('h')).mean().reindex(index)
+
+
+def rolling_average(hourly, hours):
+    """
+    Trailing `hours`-hour averages of every monitor, missing where less than MIN_COMPLETENESS of the hours
+    were reported.
+    """
+    if hours == 1:
+        return hourly
+    return hourly.rolling(hours, min_periods=int(np.ceil(MIN_COMPLETENESS * hours))).mean()
+
+
+def nowcast(hourly, hours=NOWCAST_HOURS, min_weight=NOWCAST_MIN_WEIGHT):
+    """
+    The EPA NowCast of every monitor and hour, from a table on an unbroken hourly index.
+
+    Each of the last `hours` hours is weighted by w ** hours_ago, where w is
+    the minimum over the maximum concentration of those hours (at least
+    `min_weight`), so the average follows quickly changing air more closely.
+    Computed for all hours and monitors at once over a sliding window.
+    """
+    values = hourly.to_numpy(dtype=float)
+    padded = np.vstack([np.full((hours - 1, values.shape[1]), np.nan), values])
+    # (hours, monitors, window) with the latest hour of every window first
+    windows = sliding_window_view(padded, hours, axis=0)[..., ::-1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        highest = np.max(np.where(np.isnan(windows), -np.inf, windows), axis=-1)
+        lowest = np.min(np.where(np.isnan(windows), np.inf, windows), axis=-1)
+        weight = np.where(highest > 0, lowest / highest, 1.0)
+    weight = np.clip(weight, min_weight, 1.0)
+
+    powers = weight[..., None] ** np.arange(hours)
+    present = ~np.isnan(windows)
+    total = np.sum(np.where(present, powers * windows, 0.0), axis=-1)
+    norm = np.sum(np.where(present, powers, 0.0), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = total / norm
+    result[present[..., :3].sum(axis=-1) < NOWCAST_RECENT_REQUIRED] = np.nan
+    return pd.DataFrame(result, index=hourly.index, columns=hourly.columns)
+
+
+def hourly_aqi(hourly, pollutant):
+    """
+    The AQI of every monitor and hour, from a table of its hourly concentrations on an unbroken index.
+
+    Particles use the NowCast, ozone and carbon monoxide the trailing 8-hour
+    average (ozone also checks its 1-hour table), NO2 and SO2 the hour itself.
+    """
+    settings = POLLUTANTS[pollutant]
+    averaged = nowcast(hourly) if settings['nowcast'] else rolling_average(hourly, settings['average_hours'])
+    aqi = pollutant_aqi_values(averaged.to_numpy(dtype=float), pollutant)
+    if pollutant == 'OZONE':
+        aqi = np.fmax(aqi, concentration_to_aqi(hourly.to_numpy(dtype=float), OZONE_1_HOUR_BREAKPOINTS, 0))
+    return pd.DataFrame(aqi, index=hourly.index, columns=hourly.columns)
+
+
+def daily_aqi(hourly, pollutant):
+    """
+    The daily AQI of every monitor, following the EPA's daily rules.
+
+    Particles use the average of the day, ozone and carbon monoxide the highest
+    8-hour average of the day, NO2 and SO2 the highest hour.
+    """
+    settings = POLLUTANTS[pollutant]
+    days = hourly.index.normalize()
+    if settings['average_hours'] == 24:
+        counts = hourly.notna().groupby(days).sum()
+        averaged = hourly.groupby(days).mean().where(counts >= MIN_COMPLETENESS * 24)
+    else:
+        averaged = rolling_average(hourly, settings['average_hours']).groupby(days).max()
+    aqi = pollutant_aqi_values(averaged.to_numpy(dtype=float), pollutant)
+    if pollutant == 'OZONE':
+        one_hour = concentration_to_aqi(hourly.groupby(days).max().to_numpy(dtype=float), OZONE_1_HOUR_BREAKPOINTS, 0)
+        aqi = np.fmax(aqi, one_hour)
+    return pd.DataFrame(aqi, index=averaged.index, columns=averaged.columns)
+
+
+def pollutant_aqi(readings, resolution='hourly'):
+    """
+    Computes the AQI of every pollutant from raw concentrations.
+
+    `readings` has one row per monitor, pollutant and hour: a 'time' column
+    (local time), 'site', 'parameter' (a POLLUTANTS name) and 'concentration'.
+    Every pollutant is pivoted to one column per monitor and computed a whole
+    table at a time. An area's AQI is that of its worst monitor, so the result
+    is the highest over the monitors: one row per hour (or day with
+    resolution='daily') and one column per pollutant (see feature_names()).
+    """
+    columns = {}
+    readings = readings[readings['parameter'].isin(list(POLLUTANTS))]
+    for pollutant, rows in readings.groupby('parameter', observed=True):
+        hourly = rows.pivot_table(index='time', columns='site', values='concentration', aggfunc='mean',
+                                  observed=True)
+        hourly = hourly_grid(hourly)
+        aqi = hourly_aqi(hourly, pollutant) if resolution == 'hourly' else daily_aqi(hourly, pollutant)
+        columns[feature_name(pollutant)] = aqi.max(axis=1)
+    if not columns:
+        return pd.DataFrame(columns=feature_names())
+    return pd.DataFrame(columns).astype('float32')
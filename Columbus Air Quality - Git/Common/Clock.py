@@ -0,0 +1,26 @@
+import datetime
+
+# The time the collectors stamp their rows with. None means the real clock, the replay harness
+# sets it to the simulated time of each tick.
+_simulated_now = None
+
+
+def set_simulated_now(value):
+    """
+    Makes now() and today() return `value` (a naive local datetime) until it is set back to None.
+    """
+    global _simulated_now
+    _simulated_now = value
+
+
+def now(tz=None):
+    """
+    Returns the current time like datetime.datetime.now(tz), or the simulated time when one is set.
+    """
+    if _simulated_now is None:
+        return datetime.datetime.now(tz)
+    return _simulated_now.astimezone(tz) if tz is not None else _simulated_now
+
+
+def today():
+    return now().date()
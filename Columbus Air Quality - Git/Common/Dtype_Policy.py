@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+
+# Text columns that repeat a handful of values, always stored as categoricals
+CATEGORICAL_COLUMNS = ['segment_name', 'location', 'parameter_name', 'parameter', 'unit', 'category', 'type-name',
+                       'Country', 'wind_dir', 'frc', 'respondent', 'respondent-name', 'type', 'value-units',
+                       'satellite', 'instrument', 'version', 'daynight', 'confidence']
+
+# Other text columns become categoricals when they have at most this share of distinct values
+CATEGORICAL_MAX_UNIQUE_RATIO = 0.5
+
+# Largest relative error allowed when a float64 column is stored as float32
+FLOAT32_RTOL = 1e-6
+
+
+def _is_text(column):
+    return column.dtype == object or pd.api.types.is_string_dtype(column.dtype)
+
+
+def _compact_column(name, column):
+    """
+    Returns the smallest dtype version of one column that keeps its values.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column
+
+    if _is_text(column):
+        # Numbers that were read back as text (for example from csv.reader) become numbers again
+        numbers = pd.to_numeric(column, errors='coerce')
+        if column.notna().any() and numbers.notna().sum() == column.notna().sum():
+            column = numbers
+        else:
+            try:
+                n_unique = column.nunique(dropna=True)
+            except TypeError:
+                # Lists and other unhashable values stay as they are
+                return column
+            if name in CATEGORICAL_COLUMNS or n_unique <= CATEGORICAL_MAX_UNIQUE_RATIO * len(column):
+                return column.astype('category')
+            return column
+
+    if pd.api.types.is_bool_dtype(column):
+        return column
+
+    if pd.api.types.is_integer_dtype(column):
+        return pd.to_numeric(column, downcast='integer')
+
+    if pd.api.types.is_float_dtype(column):
+        values = column.to_numpy(dtype=np.float64, na_value=np.nan)
+        finite = values[np.isfinite(values)]
+
+        # Whole numbers without gaps fit in small ints
+        if len(finite) == len(values) and len(values) and np.array_equal(finite, np.round(finite)):
+            return pd.to_numeric(column.astype(np.int64), downcast='integer')
+
+        if np.allclose(finite, finite.astype(np.float32), rtol=FLOAT32_RTOL, atol=0):
+            return column.astype(np.float32)
+
+    return column
+
+
+def apply_dtype_policy(df, name=None):
+    """
+    Downcasts numbers and turns repeated text into categoricals.
+
+    If `name` is given, the memory saved is printed under that name.
+    """
+    before = df.memory_usage(deep=True).sum()
+    compact = df.copy()
+    for col in compact.columns:
+        compact[col] = _compact_column(col, compact[col])
+
+    if name:
+        after = compact.memory_usage(deep=True).sum()
+        print(f"{name}: {before / 1e6:.2f} MB -> {after / 1e6:.2f} MB "
+              f"({before / max(after, 1):.1f}x smaller)")
+    return compact
+
+
+def read_csv_compact(file_path, name=None, **kwargs):
+    """
+    Reads a CSV file and applies the dtype policy to it.
+    """
+    return apply_dtype_policy(pd.read_csv(file_path, **kwargs), name)
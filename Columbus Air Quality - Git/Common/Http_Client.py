@@ -0,0 +1,219 @@
+import email.utils
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Request budget of every API, shared by all the scripts on the machine.
+# 'rate' is how many requests per second are allowed on average, 'burst' how many can go out at once.
+PROVIDERS = {
+    'airnow': {'rate': 500 / 3600, 'burst': 10},  # 500 requests an hour
+    'eia': {'rate': 5000 / 3600, 'burst': 5},  # 5,000 requests an hour
+    'weatherstack': {'rate': 1, 'burst': 5},
+    'tomtom': {'rate': 5, 'burst': 10},  # 5 queries a second
+    'firms': {'rate': 5000 / 600, 'burst': 5},  # 5,000 transactions every 10 minutes
+}
+
+# Where the token buckets are kept, so concurrent jobs draw from the same budget
+RATE_LIMIT_DB_PATH = os.environ.get('AQ_RATE_LIMIT_DB', '/tmp/aq_rate_limits.sqlite')
+
+# Seconds to wait for a connection and for the response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# Retries of a failed request, waiting a random time up to BACKOFF_BASE * 2^attempt (at most BACKOFF_CAP) between them
+MAX_RETRIES = 4
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# A provider asking (with Retry-After) to wait longer than this is not retried, the call fails instead.
+# Batch jobs nobody is waiting on pass max_wait=BATCH_RETRY_AFTER_MAX to wait out longer limits.
+RETRY_AFTER_MAX = BACKOFF_CAP
+BATCH_RETRY_AFTER_MAX = 60 * 60
+
+# After this many failed calls in a row a provider is left alone for CIRCUIT_COOLDOWN seconds
+CIRCUIT_FAILURES = 5
+CIRCUIT_COOLDOWN = 120
+
+# Connections kept open per provider
+POOL_SIZE = 16
+
+# Set to send every call to '<AQ_API_BASE_URL>/<provider><path>' instead of the real APIs
+# (the replay harness points it at its stub APIs)
+API_BASE_URL = os.environ.get('AQ_API_BASE_URL')
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Raised instead of calling a provider that keeps failing.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider after CIRCUIT_FAILURES failed calls in a row.
+
+    Once CIRCUIT_COOLDOWN has passed, one call is let through to test the
+    provider. It closes the circuit if it succeeds.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self, provider):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited < CIRCUIT_COOLDOWN:
+                raise CircuitOpenError(f"{provider} is failing, not calling it for another "
+                                       f"{CIRCUIT_COOLDOWN - waited:.0f}s")
+            # Let this call test the provider, the others keep waiting until it is done
+            self.opened_at = time.monotonic()
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= CIRCUIT_FAILURES:
+                    self.opened_at = time.monotonic()
+
+
+_sessions = {}
+_breakers = {}
+_lock = threading.Lock()
+
+
+def _session(provider):
+    with _lock:
+        if provider not in _sessions:
+            # Keep-alive connections are reused by every call to the provider
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[provider] = session
+            _breakers[provider] = CircuitBreaker()
+        return _sessions[provider], _breakers[provider]
+
+
+def _connect_rate_limits(path):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS token_buckets '
+                       '(provider TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+    return connection
+
+
+def acquire(provider, path=RATE_LIMIT_DB_PATH):
+    """
+    Waits until the provider's token bucket has a token and takes it.
+    """
+    budget = PROVIDERS[provider]
+    with closing(_connect_rate_limits(path)) as connection:
+        while True:
+            connection.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = connection.execute('SELECT tokens, updated_at FROM token_buckets WHERE provider = ?',
+                                     (provider,)).fetchone()
+            tokens, updated_at = row if row else (budget['burst'], now)
+
+            # Refill for the time since the bucket was last touched
+            tokens = min(budget['burst'], tokens + (now - updated_at) * budget['rate'])
+            if tokens >= 1:
+                connection.execute('INSERT OR REPLACE INTO token_buckets VALUES (?, ?, ?)', (provider, tokens - 1, now))
+                connection.execute('COMMIT')
+                return
+
+            connection.execute('INSERT OR REPLACE INTO token_buckets VALUES (?, ?, ?)', (provider, tokens, now))
+            connection.execute('COMMIT')
+            time.sleep((1 - tokens) / budget['rate'])
+
+
+def retry_after_seconds(response):
+    """
+    Reads the Retry-After header, which is either a number of seconds or a date.
+    """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def rebase_url(provider, url, base_url):
+    """
+    Moves a provider's URL under `base_url`, keeping its path and query.
+    """
+    base = urlsplit(base_url)
+    parts = urlsplit(url)
+    return urlunsplit((base.scheme, base.netloc, f"{base.path.rstrip('/')}/{provider}{parts.path}", parts.query, ''))
+
+
+def backoff_seconds(attempt):
+    # Full jitter, so jobs that failed together do not retry together
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def http_get(provider, url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), max_wait=RETRY_AFTER_MAX, **kwargs):
+    """
+    GETs `url` from one of the PROVIDERS.
+
+    Every call waits for the provider's rate budget, uses a pooled
+    connection and has a timeout. Connection errors, timeouts and the
+    statuses in RETRY_STATUSES are retried with jittered exponential backoff
+    (or as long as Retry-After asks, up to `max_wait` seconds). The last response
+    is returned like requests.get does, so callers still use raise_for_status().
+    """
+    session, breaker = _session(provider)
+    breaker.check(provider)
+    if API_BASE_URL:
+        url = rebase_url(provider, url, API_BASE_URL)
+
+    # Only the path is printed, query strings carry API keys
+    where = f"{provider} {urlsplit(url).path}"
+    for attempt in range(MAX_RETRIES + 1):
+        acquire(provider)
+        try:
+            response = session.get(url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == MAX_RETRIES:
+                breaker.record(False)
+                raise
+            wait = backoff_seconds(attempt)
+            print(f"{where} failed ({type(e).__name__}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+            continue
+
+        if response.status_code not in RETRY_STATUSES:
+            breaker.record(response.status_code < 500)
+            return response
+        if attempt == MAX_RETRIES:
+            breaker.record(False)
+            return response
+
+        wait = retry_after_seconds(response)
+        if wait is not None and wait > max_wait:
+            # Waiting that long would hold up the job, and the failures count towards opening the circuit
+            print(f"{where} returned {response.status_code} and asked to wait {wait:.0f}s, giving up")
+            breaker.record(False)
+            return response
+        wait = backoff_seconds(attempt) if wait is None else wait
+        print(f"{where} returned {response.status_code}, retrying in {wait:.1f}s")
+        time.sleep(wait)
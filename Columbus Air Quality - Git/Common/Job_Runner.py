@@ -0,0 +1,158 @@
+import gc
+import importlib
+import multiprocessing
+import os
+import resource
+import time
+
+# A run is killed once its worker's memory passes JOB_MAX_RSS_MB or it takes longer than JOB_TIMEOUT_SECONDS
+JOB_MAX_RSS_MB = int(os.environ.get('AQ_JOB_MAX_RSS_MB', 6144))
+JOB_TIMEOUT_SECONDS = int(os.environ.get('AQ_JOB_TIMEOUT_SECONDS', 3600))
+
+# A worker is replaced by a fresh one after this many runs, or once it still holds RECYCLE_RSS_MB after a run
+RECYCLE_AFTER_RUNS = int(os.environ.get('AQ_JOB_RECYCLE_AFTER_RUNS', 24))
+RECYCLE_RSS_MB = int(os.environ.get('AQ_JOB_RECYCLE_RSS_MB', 2048))
+
+# How often the worker's memory is checked during a run
+POLL_SECONDS = 0.5
+
+
+def rss_mb(pid):
+    """
+    Reads the resident memory of a process in MB from /proc (None where there is no /proc).
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def _worker_loop(connection):
+    # Runs jobs sent by the parent until it sends None
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        function, args = job
+        try:
+            if isinstance(function, str):
+                # 'module:function', imported here so the parent never loads the job's libraries
+                module_name, function_name = function.split(':')
+                function = getattr(importlib.import_module(module_name), function_name)
+            result, error = function(*args), None
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        gc.collect()
+        # ru_maxrss is in KB on Linux, it covers the whole life of the worker
+        connection.send((result, error, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+class JobRunner:
+    """
+    Runs a scheduled job in a separate worker process.
+
+    The worker is started fresh with spawn, so nothing the job leaves behind
+    (Keras graphs, pandas caches, fragmented heap) reaches the scheduler. Every
+    run is killed if it passes the memory or time limit, reports its duration and
+    peak memory, and the worker is recycled after `recycle_after_runs` runs or
+    once it holds more than `recycle_rss_mb` between runs.
+    """
+
+    def __init__(self, name, max_rss_mb=JOB_MAX_RSS_MB, timeout_seconds=JOB_TIMEOUT_SECONDS,
+                 recycle_after_runs=RECYCLE_AFTER_RUNS, recycle_rss_mb=RECYCLE_RSS_MB):
+        self.name = name
+        self.max_rss_mb = max_rss_mb
+        self.timeout_seconds = timeout_seconds
+        self.recycle_after_runs = recycle_after_runs
+        self.recycle_rss_mb = recycle_rss_mb
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.connection = None
+        self.runs = 0
+        self.last_error = None  # Why the last run failed or was killed, None if it finished
+        self.last_duration = None  # Seconds the last run took
+        self.last_peak_rss_mb = None  # Peak memory of the worker during the last run
+
+    def start_worker(self):
+        self.connection, child_connection = self.context.Pipe()
+        self.process = self.context.Process(target=_worker_loop, args=(child_connection,), daemon=True,
+                                            name=f'{self.name}-worker')
+        self.process.start()
+        child_connection.close()
+        self.runs = 0
+
+    def stop_worker(self, kill=False):
+        if self.process is None:
+            return
+        if not kill:
+            try:
+                self.connection.send(None)
+                self.process.join(timeout=10)
+            except OSError:
+                pass
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+        self.process = None
+
+    def run(self, function, *args):
+        """
+        Runs `function(*args)` in the worker and returns its result (None if it failed or was killed).
+
+        `function` has to be importable by the worker, a module level function of the calling script is.
+        It can also be given as 'module:function', then only the worker imports it.
+        """
+        if self.process is None or not self.process.is_alive():
+            self.start_worker()
+
+        started = time.time()
+        self.connection.send((function, args))
+        peak_rss = 0.0
+        killed = None
+        while not self.connection.poll(POLL_SECONDS):
+            rss = rss_mb(self.process.pid)
+            peak_rss = max(peak_rss, rss or 0.0)
+            if not self.process.is_alive():
+                killed = f"worker exited with code {self.process.exitcode}"
+            elif rss is not None and rss > self.max_rss_mb:
+                killed = f"memory passed {self.max_rss_mb} MB"
+            elif time.time() - started > self.timeout_seconds:
+                killed = f"run took longer than {self.timeout_seconds}s"
+            if killed:
+                break
+
+        duration = time.time() - started
+        self.last_error = killed
+        self.last_duration, self.last_peak_rss_mb = duration, peak_rss
+        if killed:
+            self.stop_worker(kill=True)
+            print(f"{self.name}: killed after {duration:.1f}s, {killed} (peak RSS {peak_rss:.0f} MB)")
+            return None
+
+        try:
+            result, error, lifetime_peak_rss = self.connection.recv()
+        except (EOFError, ConnectionError):
+            self.last_error = "worker died"
+            self.stop_worker(kill=True)
+            print(f"{self.name}: worker died after {duration:.1f}s (peak RSS {peak_rss:.0f} MB)")
+            return None
+        self.runs += 1
+        self.last_error = error
+
+        # Runs too short to be sampled fall back on the worker's lifetime peak
+        peak_rss = peak_rss or lifetime_peak_rss
+        self.last_peak_rss_mb = peak_rss
+        rss_after = rss_mb(self.process.pid)
+        status = f"failed ({error})" if error else "finished"
+        print(f"{self.name}: {status} in {duration:.1f}s, peak RSS {peak_rss:.0f} MB, "
+              f"run {self.runs}/{self.recycle_after_runs} of this worker")
+
+        if self.runs >= self.recycle_after_runs or (rss_after or 0) > self.recycle_rss_mb:
+            print(f"{self.name}: recycling the worker (holding {rss_after or 0:.0f} MB after {self.runs} runs)")
+            self.stop_worker()
+        return result
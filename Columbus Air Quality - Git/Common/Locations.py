@@ -0,0 +1,53 @@
+import os
+
+# Every place the pipeline collects data and forecasts for.
+# 'slug' names the location's storage partition, so it must not change once data is collected.
+# 'coordinates' (latitude, longitude) centre the box the pollutant monitors are searched in.
+# Traffic is only collected for locations with highway segments listed.
+LOCATIONS = [
+    {
+        'slug': 'columbus',
+        'name': 'Columbus, Ohio',
+        'zip_code': '43215',
+        'coordinates': (39.9612, -82.9988),
+        'weather_query': 'Columbus, Ohio',
+        'traffic_segments': {
+            "I-70 West Downtown": (39.973589, -83.082973),
+            "I-70 East Downtown": (39.952439, -82.945859),
+            "I-71 North Downtown": (40.007293, -82.985081),
+            "I-71 South Downtown": (39.907918, -83.023019),
+            "I-315 North Downtown": (39.998029, -83.026691),
+            "I-670 West Downtown": (39.966024, -83.036566),
+            "I-670 East Downtown": (39.978885, -82.970333),
+        },
+    },
+    {'slug': 'cleveland', 'name': 'Cleveland, Ohio', 'zip_code': '44114', 'coordinates': (41.4993, -81.6944),
+     'weather_query': 'Cleveland, Ohio', 'traffic_segments': {}},
+    {'slug': 'cincinnati', 'name': 'Cincinnati, Ohio', 'zip_code': '45202', 'coordinates': (39.1031, -84.5120),
+     'weather_query': 'Cincinnati, Ohio', 'traffic_segments': {}},
+    {'slug': 'toledo', 'name': 'Toledo, Ohio', 'zip_code': '43604', 'coordinates': (41.6528, -83.5379),
+     'weather_query': 'Toledo, Ohio', 'traffic_segments': {}},
+    {'slug': 'akron', 'name': 'Akron, Ohio', 'zip_code': '44308', 'coordinates': (41.0814, -81.5190),
+     'weather_query': 'Akron, Ohio', 'traffic_segments': {}},
+    {'slug': 'dayton', 'name': 'Dayton, Ohio', 'zip_code': '45402', 'coordinates': (39.7589, -84.1916),
+     'weather_query': 'Dayton, Ohio', 'traffic_segments': {}},
+]
+
+# Files written before locations existed belong to this location
+LEGACY_LOCATION = 'columbus'
+
+# How many locations a collector works on at the same time
+MAX_CONCURRENT_LOCATIONS = 8
+
+
+def active_locations():
+    """
+    Returns the locations to work on.
+
+    Set AQ_LOCATIONS to a comma separated list of slugs to only run some of them.
+    """
+    selected = os.environ.get('AQ_LOCATIONS')
+    if not selected:
+        return LOCATIONS
+    slugs = [slug.strip() for slug in selected.split(',')]
+    return [location for location in LOCATIONS if location['slug'] in slugs]
@@ -0,0 +1,193 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from Locations import LEGACY_LOCATION
+
+# Where the model forecast is read from (the same as in LSTM.py)
+FORECAST_BUCKET_NAME = 'columbus-forecast-bucket'
+RESOLUTION = os.environ.get('AQ_RESOLUTION', 'daily')
+FORECAST_FILENAME = 'aqi_forecast_hourly.csv' if RESOLUTION == 'hourly' else 'aqi_forecast.csv'
+
+# The adjusted forecast every location publishes next to its current AQI
+NOWCAST_FILENAME = 'aqi_nowcast.csv'
+
+# Every location's filter state, a single row each
+NOWCAST_DB_PATH = os.environ.get('AQ_NOWCAST_DB', '/tmp/aq_nowcast.sqlite')
+
+# Filter settings, in AQI points squared: how far the model's error can drift in an hour, how far an
+# observed AQI is from the true one, and how unsure the correction is before the first observation
+PROCESS_VARIANCE_PER_HOUR = 4.0
+OBSERVATION_VARIANCE = 100.0
+INITIAL_VARIANCE = 400.0
+
+# The correction fades with lead time, by 1/e every this many hours
+CORRECTION_TIMESCALE_HOURS = 24
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nowcast_state (
+    location TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+"""
+
+
+def connect(path=NOWCAST_DB_PATH):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def load_state(slug, path=NOWCAST_DB_PATH):
+    with closing(connect(path)) as connection:
+        row = connection.execute('SELECT state FROM nowcast_state WHERE location = ?', (slug,)).fetchone()
+    if row is None:
+        return {'residual': 0.0, 'variance': INITIAL_VARIANCE, 'observed_at': None, 'day_max': None,
+                'day_forecast': None, 'forecast': {}, 'forecast_generation': None}
+    return json.loads(row[0])
+
+
+def save_state(slug, state, path=NOWCAST_DB_PATH):
+    with closing(connect(path)) as connection:
+        connection.execute('INSERT OR REPLACE INTO nowcast_state VALUES (?, ?)', (slug, json.dumps(state)))
+
+
+def forecast_key(timestamp):
+    # What one forecast row covers: a day, or an hour of the hourly forecast
+    return timestamp.strftime('%Y-%m-%dT%H:00' if RESOLUTION == 'hourly' else '%Y-%m-%d')
+
+
+def merge_forecast(state, forecast_rows, generation, observed_at):
+    """
+    Keeps the latest model forecast of every day (or hour) from the current one on.
+
+    The model's forecast starts after its last row, so the forecast for today
+    comes from an earlier run. Rows are remembered across runs, a newer run
+    replaces the rows it covers and rows in the past are dropped.
+    """
+    if generation != state['forecast_generation']:
+        for date, predicted in zip(pd.to_datetime(forecast_rows['Date']), forecast_rows['Predicted AQI']):
+            state['forecast'][forecast_key(date)] = float(predicted)
+        state['forecast_generation'] = generation
+    current = forecast_key(observed_at)
+    state['forecast'] = {key: value for key, value in state['forecast'].items() if key >= current}
+
+
+def correct(state, observed, forecast):
+    """
+    One Kalman step: moves the correction towards the model's error on an observed day (or hour).
+    """
+    if observed is None or forecast is None:
+        return
+    gain = state['variance'] / (state['variance'] + OBSERVATION_VARIANCE)
+    state['residual'] += gain * (observed - forecast - state['residual'])
+    state['variance'] *= 1 - gain
+
+
+def update(state, observed_at, aqi):
+    """
+    Folds one reading into the state, a scalar Kalman filter on the model's error.
+
+    The correction is a random walk whose variance grows with the hours since
+    the last reading. An hourly forecast is corrected by every reading. A
+    daily forecast is for the day's highest AQI, which the morning readings
+    say little about, so the day only counts once it is over, with its
+    highest reading; until then the readings keep today's forecast from
+    falling below them. Readings not newer than the last one are ignored, so
+    re-runs do not count twice.
+    """
+    if state['observed_at'] is not None:
+        last = pd.Timestamp(state['observed_at'])
+        if observed_at <= last:
+            return False
+        state['variance'] += PROCESS_VARIANCE_PER_HOUR * (observed_at - last) / pd.Timedelta(hours=1)
+        if RESOLUTION != 'hourly' and observed_at.normalize() != last.normalize():
+            correct(state, state['day_max'], state['day_forecast'])
+            state['day_max'] = state['day_forecast'] = None
+    state['observed_at'] = observed_at.isoformat()
+
+    if RESOLUTION == 'hourly':
+        correct(state, float(aqi), state['forecast'].get(forecast_key(observed_at)))
+    else:
+        state['day_max'] = max(state['day_max'] or 0.0, float(aqi))
+        state['day_forecast'] = state['forecast'].get(forecast_key(observed_at), state['day_forecast'])
+    return True
+
+
+def adjusted_forecast(state, observed_at):
+    """
+    Returns today's and tomorrow's forecast with the correction applied, fading with lead time.
+
+    A daily forecast for today is never below the highest reading of the day so far.
+    """
+    today = pd.Timestamp(observed_at).normalize()
+    rows = []
+    for key, predicted in sorted(state['forecast'].items()):
+        date = pd.Timestamp(key)
+        if date.normalize() > today + pd.Timedelta(days=1):
+            continue
+        lead_hours = max((date - pd.Timestamp(observed_at)) / pd.Timedelta(hours=1), 0.0)
+        adjusted = predicted + state['residual'] * np.exp(-lead_hours / CORRECTION_TIMESCALE_HOURS)
+        if RESOLUTION != 'hourly' and date == today and state['day_max'] is not None:
+            adjusted = max(adjusted, state['day_max'])
+        rows.append({'Date': date, 'Model AQI': round(predicted, 1), 'Nowcast AQI': round(max(adjusted, 0.0), 1),
+                     'Correction': round(adjusted - predicted, 1), 'Updated': state['observed_at']})
+    return pd.DataFrame(rows, columns=['Date', 'Model AQI', 'Nowcast AQI', 'Correction', 'Updated'])
+
+
+class ForecastReader:
+    """
+    Keeps the latest model forecast in memory, only downloading it again when its generation changes.
+    """
+
+    def __init__(self):
+        self.generation = None
+        self.forecast = None
+        self.lock = threading.Lock()
+
+    def read(self, storage_client):
+        """
+        Returns the forecast table and its generation, or (None, None) if there is none yet.
+        """
+        blob = storage_client.bucket(FORECAST_BUCKET_NAME).get_blob(FORECAST_FILENAME)
+        if blob is None:
+            return None, None
+        with self.lock:
+            if blob.generation != self.generation:
+                forecast = pd.read_csv(io.BytesIO(blob.download_as_bytes()))
+                if 'Location' not in forecast.columns:
+                    # Forecasts written before locations existed only cover the legacy location
+                    forecast['Location'] = LEGACY_LOCATION
+                self.forecast, self.generation = forecast, blob.generation
+            return self.forecast, self.generation
+
+
+_forecast_reader = ForecastReader()
+
+
+def nowcast(location, observed_at, aqi, storage_client, path=NOWCAST_DB_PATH):
+    """
+    Updates a location's correction with a new reading and returns its adjusted forecast.
+
+    Only reads the small forecast file (when it changed) and one row of
+    state, so it takes milliseconds and needs neither the models nor the
+    master dataset. Returns None before the first model forecast.
+    """
+    forecast, generation = _forecast_reader.read(storage_client)
+    if forecast is None:
+        return None
+    slug = location['slug']
+    observed_at = pd.Timestamp(observed_at)
+
+    state = load_state(slug, path)
+    merge_forecast(state, forecast[forecast['Location'] == slug], generation, observed_at)
+    update(state, observed_at, aqi)
+    save_state(slug, state, path)
+    return adjusted_forecast(state, observed_at)
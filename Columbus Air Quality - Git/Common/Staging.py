@@ -0,0 +1,420 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import closing, contextmanager
+
+import numpy as np
+import pandas as pd
+
+from Dtype_Policy import apply_dtype_policy, read_csv_compact
+from Storage import get_storage_client, partition_blob, precondition_failed
+
+# Collectors write here first and return, the flusher moves the rows to cloud storage later.
+# Every collector on the machine shares the same file.
+STAGING_DB_PATH = os.environ.get('AQ_STAGING_DB', '/tmp/aq_staging.sqlite')
+
+# A file's staged rows are uploaded once the oldest has waited this long, or once there are this many
+FLUSH_INTERVAL_SECONDS = int(os.environ.get('AQ_FLUSH_INTERVAL_SECONDS', 15 * 60))
+FLUSH_MAX_ROWS = int(os.environ.get('AQ_FLUSH_MAX_ROWS', 500))
+
+# A batch claimed by a flusher that died before finishing it can be claimed again after this long
+CLAIM_TIMEOUT_SECONDS = 30 * 60
+
+# Deltas are folded into the main file once there are this many of them
+COMPACT_AFTER_DELTAS = 24
+
+# How many times a compaction starts over when another one wrote the main file first
+COMPACT_ATTEMPTS = 3
+
+# Uploaded batches sit next to the main file as deltas/<file name>/<batch id>.csv.gz
+DELTA_PREFIX = 'deltas'
+
+# Files written with stage_upserts and the columns that identify one of their rows.
+# Reads and compactions keep only the latest row for every key.
+UPSERT_KEYS = {
+    'air_quality_data_all.csv': ['location', 'parameter_name', 'date', 'hour'],
+    'pollutant_concentrations_all.csv': ['site', 'parameter', 'utc'],
+    'weather_data_all.csv': ['date', 'hour'],
+    'eia_data_all.csv': ['period', 'respondent', 'fueltype'],
+    'wildfire_data_binned.csv': ['Date', 'Country'],
+}
+
+# How long a key stays in the upsert index (observations older than this are not re-sent by the APIs)
+UPSERT_INDEX_DAYS = 7
+
+# Keys looked up in the upsert index per query, well below SQLite's limit on bound variables (999 on older builds)
+UPSERT_LOOKUP_CHUNK = 500
+
+# Metadata key on the main file listing the batches folded into it whose deltas may still exist
+MERGED_BATCHES_KEY = 'merged-batches'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS staged_rows (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bucket TEXT NOT NULL,
+    blob_name TEXT NOT NULL,
+    row TEXT NOT NULL,
+    staged_at REAL NOT NULL,
+    batch_id TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS staged_rows_batch ON staged_rows (batch_id, bucket, blob_name);
+CREATE TABLE IF NOT EXISTS staged_objects (
+    bucket TEXT NOT NULL,
+    blob_name TEXT NOT NULL,
+    data BLOB NOT NULL,
+    content_type TEXT,
+    staged_at REAL NOT NULL,
+    PRIMARY KEY (bucket, blob_name)
+);
+CREATE TABLE IF NOT EXISTS upsert_index (
+    bucket TEXT NOT NULL,
+    blob_name TEXT NOT NULL,
+    key_hash INTEGER NOT NULL,
+    row_hash INTEGER NOT NULL,
+    indexed_at REAL NOT NULL,
+    PRIMARY KEY (bucket, blob_name, key_hash)
+) WITHOUT ROWID;
+"""
+
+
+def connect(path=STAGING_DB_PATH):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    # WAL lets the collectors keep writing while the flusher reads
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(staged_rows)').fetchall()]
+    if 'claimed_at' not in columns:
+        # Staging stores made before batches were claimed
+        connection.execute('ALTER TABLE staged_rows ADD COLUMN claimed_at REAL')
+    return connection
+
+
+@contextmanager
+def transaction(connection):
+    # IMMEDIATE takes the write lock up front, so two flushers cannot claim the same batch
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def insert_rows(connection, bucket_name, blob_name, df):
+    records = json.loads(df.to_json(orient='records', date_format='iso'))
+    now = time.time()
+    connection.executemany('INSERT INTO staged_rows (bucket, blob_name, row, staged_at) VALUES (?, ?, ?, ?)',
+                           [(bucket_name, blob_name, json.dumps(record), now) for record in records])
+
+
+def stage_rows(bucket_name, blob_name, df, path=STAGING_DB_PATH, connection=None):
+    """
+    Stages rows to be appended to a CSV file in cloud storage.
+
+    Pass `connection` to stage them inside a transaction already open on the staging store.
+    """
+    if connection is not None:
+        insert_rows(connection, bucket_name, blob_name, df)
+        return
+    with closing(connect(path)) as connection, transaction(connection):
+        insert_rows(connection, bucket_name, blob_name, df)
+
+
+def canonical_text(df):
+    """
+    Writes every value the same way whatever its dtype, so 5, 5.0 and '5' (or NaN and None) hash alike.
+    The columns are put in name order, so neither does the same row with its columns in another order.
+    """
+    df = df[sorted(df.columns)].astype(object)
+    numbers = df.apply(pd.to_numeric, errors='coerce')
+    text = df.astype(str).mask(numbers.notna(), numbers.map(lambda value: f'{value:.15g}', na_action='ignore'))
+    return text.mask(df.isna(), '')
+
+
+def row_hashes(df):
+    return pd.util.hash_pandas_object(canonical_text(df), index=False).values.view(np.int64)
+
+
+def upsert_rows(connection, bucket_name, blob_name, df, key_columns):
+    key_hashes = row_hashes(df[key_columns])
+    hashes = row_hashes(df)
+    now = time.time()
+
+    connection.execute('DELETE FROM upsert_index WHERE indexed_at < ?', (now - UPSERT_INDEX_DAYS * 86400,))
+    known = {}
+    for start in range(0, len(key_hashes), UPSERT_LOOKUP_CHUNK):
+        chunk = key_hashes[start:start + UPSERT_LOOKUP_CHUNK].tolist()
+        known.update(connection.execute(
+            f'SELECT key_hash, row_hash FROM upsert_index WHERE bucket = ? AND blob_name = ? '
+            f'AND key_hash IN ({",".join("?" * len(chunk))})', [bucket_name, blob_name] + chunk).fetchall())
+
+    # A key seen twice in the same batch keeps its last row
+    changed = {}
+    for position, (key_hash, row_hash) in enumerate(zip(key_hashes.tolist(), hashes.tolist())):
+        if known.get(key_hash) != row_hash:
+            changed[key_hash] = (position, row_hash)
+    if not changed:
+        return 0
+
+    insert_rows(connection, bucket_name, blob_name, df.iloc[sorted(position for position, _ in changed.values())])
+    connection.executemany('INSERT OR REPLACE INTO upsert_index VALUES (?, ?, ?, ?, ?)',
+                           [(bucket_name, blob_name, key_hash, row_hash, now)
+                            for key_hash, (_, row_hash) in changed.items()])
+    return len(changed)
+
+
+def stage_upserts(bucket_name, blob_name, df, key_columns, path=STAGING_DB_PATH, connection=None):
+    """
+    Stages only the rows that are new or changed since they were last staged.
+
+    Rows are matched on `key_columns` through a hash index kept in the staging
+    store, so re-runs and retries never grow the file. A changed row replaces
+    the old one when the file is read or compacted.
+    Pass `connection` to stage them inside a transaction already open on the staging store.
+
+    Returns the number of rows staged.
+    """
+    if connection is not None:
+        return upsert_rows(connection, bucket_name, blob_name, df, key_columns)
+    with closing(connect(path)) as connection, transaction(connection):
+        return upsert_rows(connection, bucket_name, blob_name, df, key_columns)
+
+
+def stage_object(bucket_name, blob_name, data, content_type='text/csv', path=STAGING_DB_PATH):
+    """
+    Stages a whole file that replaces the one in cloud storage (only the latest version is kept).
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    with closing(connect(path)) as connection, transaction(connection):
+        connection.execute('INSERT OR REPLACE INTO staged_objects VALUES (?, ?, ?, ?, ?)',
+                           (bucket_name, blob_name, data, content_type, time.time()))
+
+
+def new_batch_id():
+    # Starts with the time, so batch ids sort in the order the batches were made
+    return f'{time.time_ns():020d}-{uuid.uuid4().hex[:8]}'
+
+
+def delta_blob_name(blob_name, batch_id):
+    return f'{DELTA_PREFIX}/{blob_name}/{batch_id}.csv.gz'
+
+
+def batch_id_of(delta_blob):
+    return delta_blob.name.rsplit('/', 1)[-1][:-len('.csv.gz')]
+
+
+def list_deltas(bucket, blob_name):
+    return sorted(bucket.list_blobs(prefix=f'{DELTA_PREFIX}/{blob_name}/'), key=lambda blob: blob.name)
+
+
+def claim_due_batches(connection, force=False):
+    """
+    Claims the batches this flusher uploads and returns them as (bucket, blob name, batch id).
+
+    The rows that are due for upload get a batch id, one batch per file. A
+    batch keeps its id until it is uploaded, so retrying after a failed upload
+    rewrites the same delta instead of adding a duplicate. Batches another
+    flusher is working on are left alone, unless it claimed them more than
+    CLAIM_TIMEOUT_SECONDS ago.
+    """
+    now = time.time()
+    with transaction(connection):
+        pending = connection.execute('SELECT bucket, blob_name, COUNT(*), MIN(staged_at) FROM staged_rows '
+                                     'WHERE batch_id IS NULL GROUP BY bucket, blob_name').fetchall()
+        for bucket_name, blob_name, n_rows, oldest in pending:
+            if force or n_rows >= FLUSH_MAX_ROWS or now - oldest >= FLUSH_INTERVAL_SECONDS:
+                connection.execute('UPDATE staged_rows SET batch_id = ? '
+                                   'WHERE batch_id IS NULL AND bucket = ? AND blob_name = ?',
+                                   (new_batch_id(), bucket_name, blob_name))
+
+        # New batches, batches released after a failed upload and batches of a flusher that died
+        batches = connection.execute('SELECT DISTINCT bucket, blob_name, batch_id FROM staged_rows '
+                                     'WHERE batch_id IS NOT NULL AND (claimed_at IS NULL OR claimed_at < ?) '
+                                     'ORDER BY batch_id', (now - CLAIM_TIMEOUT_SECONDS,)).fetchall()
+        connection.executemany('UPDATE staged_rows SET claimed_at = ? WHERE batch_id = ?',
+                               [(now, batch_id) for _, _, batch_id in batches])
+    return batches
+
+
+def release_batch(connection, batch_id):
+    # Lets the next flush, of any process, retry the batch
+    with transaction(connection):
+        connection.execute('UPDATE staged_rows SET claimed_at = NULL WHERE batch_id = ?', (batch_id,))
+
+
+def flush(storage_client=None, force=False, path=STAGING_DB_PATH):
+    """
+    Uploads the staged rows that are due as compressed deltas, and every staged file.
+
+    Anything that fails to upload stays staged and is retried on the next flush.
+    Returns the number of uploads.
+    """
+    uploads = 0
+    with closing(connect(path)) as connection:
+        batches = claim_due_batches(connection, force)
+        objects = connection.execute('SELECT bucket, blob_name, data, content_type, staged_at '
+                                     'FROM staged_objects').fetchall()
+        if not batches and not objects:
+            return 0
+
+        storage_client = storage_client or get_storage_client()
+        for bucket_name, blob_name, batch_id in batches:
+            rows = [json.loads(row) for (row,) in connection.execute(
+                'SELECT row FROM staged_rows WHERE batch_id = ? ORDER BY id', (batch_id,))]
+            try:
+                bucket = storage_client.bucket(bucket_name)
+                data = gzip.compress(pd.DataFrame(rows).to_csv(index=False).encode('utf-8'))
+                bucket.blob(delta_blob_name(blob_name, batch_id)).upload_from_string(
+                    data, content_type='application/gzip')
+            except Exception as e:
+                print(f"Error uploading {len(rows)} staged rows for {blob_name}, they stay staged: {e}")
+                release_batch(connection, batch_id)
+                continue
+
+            with transaction(connection):
+                connection.execute('DELETE FROM staged_rows WHERE batch_id = ?', (batch_id,))
+            uploads += 1
+            print(f"Uploaded {len(rows)} staged rows for {blob_name} ({len(data)} bytes)")
+
+            try:
+                if len(list_deltas(bucket, blob_name)) >= COMPACT_AFTER_DELTAS:
+                    compact(bucket, blob_name)
+            except Exception as e:
+                # The deltas are safe where they are, compaction is tried again after the next upload
+                print(f"Error compacting {blob_name}: {e}")
+
+        for bucket_name, blob_name, data, content_type, staged_at in objects:
+            try:
+                storage_client.bucket(bucket_name).blob(blob_name).upload_from_string(data, content_type=content_type)
+            except Exception as e:
+                print(f"Error uploading staged {blob_name}, it stays staged: {e}")
+                continue
+
+            # Only drop it if no newer version was staged during the upload
+            with transaction(connection):
+                connection.execute('DELETE FROM staged_objects WHERE bucket = ? AND blob_name = ? AND staged_at = ?',
+                                   (bucket_name, blob_name, staged_at))
+            uploads += 1
+
+    return uploads
+
+
+def staged_version(bucket, blob_name):
+    """
+    Returns something that changes whenever the main file or its deltas change, without downloading them.
+    """
+    base = bucket.get_blob(blob_name)
+    deltas = list_deltas(bucket, blob_name)
+    if base is None and not deltas:
+        return None
+    return base.generation if base else None, tuple(delta.name for delta in deltas)
+
+
+def read_staged_csv(bucket, blob_name):
+    """
+    Reads a CSV file from cloud storage together with the deltas not folded into it yet.
+
+    Returns None if neither exists.
+    """
+    df, _, _, _ = read_with_deltas(bucket, blob_name)
+    return df
+
+
+def read_with_deltas(bucket, blob_name):
+    """
+    Returns the combined table, the deltas it read, the ids of the batches the main file already holds
+    and the generation of the main file that was read (0 if there is none).
+    """
+    base = partition_blob(bucket, blob_name)
+    frames = []
+    merged = set()
+    generation = 0
+    if base.exists():
+        base.reload()
+        generation = base.generation
+        merged = set(filter(None, (base.metadata or {}).get(MERGED_BATCHES_KEY, '').split(',')))
+        frames.append(read_csv_compact(io.BytesIO(base.download_as_bytes())))
+
+    # Deltas the main file already holds may still be around if deleting them failed
+    deltas = [delta for delta in list_deltas(bucket, blob_name) if batch_id_of(delta) not in merged]
+    for delta in deltas:
+        try:
+            frames.append(read_csv_compact(io.BytesIO(delta.download_as_bytes()), compression='gzip'))
+        except Exception:
+            if delta.exists():
+                raise
+            # A compaction folded it into the main file after it was listed, read everything again
+            return read_with_deltas(bucket, blob_name)
+    if not frames:
+        return None, deltas, merged, generation
+
+    df = pd.concat(frames, ignore_index=True)
+    key_columns = UPSERT_KEYS.get(blob_name.rsplit('/', 1)[-1])
+    if key_columns:
+        df = df.reindex(columns=list(dict.fromkeys(list(df.columns) + key_columns)))
+
+        # Rows from before the key existed only lose exact copies, they cannot tell their hours apart
+        keyed = df[key_columns].notna().all(axis=1)
+        df = pd.concat([df[~keyed].drop_duplicates(),
+                        df[keyed].drop_duplicates(subset=key_columns, keep='last')]).sort_index()
+        df = df.reset_index(drop=True)
+    return apply_dtype_policy(df, blob_name), deltas, merged, generation
+
+
+def compact(bucket, blob_name):
+    """
+    Folds the deltas into the main file and deletes them.
+
+    The main file lists the batches it holds in its metadata, in the same
+    write as its contents, so a crash before the deltas are deleted never
+    counts them twice. The main file is only written if it is still the
+    version that was read, so two compactions at once cannot drop each
+    other's deltas: the one that loses starts over from the winner's file.
+    Only the deltas listed in the file that was written are deleted.
+    """
+    for _ in range(COMPACT_ATTEMPTS):
+        df, deltas, merged, generation = read_with_deltas(bucket, blob_name)
+        if not deltas:
+            return
+
+        # Batches merged earlier stay listed for as long as their deltas are still around
+        remaining = {batch_id_of(delta) for delta in list_deltas(bucket, blob_name)}
+        merged = (merged & remaining) | {batch_id_of(delta) for delta in deltas}
+
+        blob = bucket.blob(blob_name)
+        blob.metadata = {MERGED_BATCHES_KEY: ','.join(sorted(merged))}
+        try:
+            blob.upload_from_string(df.to_csv(index=False), content_type='text/csv', if_generation_match=generation)
+        except Exception as e:
+            if not precondition_failed(e):
+                raise
+            print(f"{blob_name} changed while compacting, starting over")
+            continue
+
+        for delta in list_deltas(bucket, blob_name):
+            if batch_id_of(delta) in merged:
+                try:
+                    delta.delete()
+                except Exception as e:
+                    # Readers skip it all the same, the main file lists it as merged
+                    print(f"Error deleting {delta.name}, possibly deleted by another compaction: {e}")
+        print(f"Compacted {len(deltas)} deltas into {blob_name}")
+        return
+    print(f"Gave up compacting {blob_name}, another compaction keeps writing it, the deltas stay")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Uploads the rows staged by the collectors.')
+    parser.add_argument('--force', action='store_true', help='Upload every staged row now, due or not')
+    args = parser.parse_args()
+
+    print(f"{flush(force=args.force)} uploads")
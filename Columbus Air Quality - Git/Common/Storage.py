@@ -0,0 +1,195 @@
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+from Locations import LEGACY_LOCATION
+
+# Set to a directory to keep every bucket on the local filesystem instead of Cloud Storage
+# (one folder per bucket), for running and load testing the pipeline locally
+STORAGE_DIR = os.environ.get('AQ_STORAGE_DIR')
+METADATA_SUFFIX = '.metadata.json'
+LOCK_SUFFIX = '.lock'
+
+
+class PreconditionFailed(Exception):
+    """
+    Raised by the filesystem backend when a write's if_generation_match does not hold, like Cloud Storage does.
+    """
+    # The HTTP status Cloud Storage answers with, google.api_core's PreconditionFailed has the same code
+    code = 412
+
+
+def precondition_failed(error):
+    """
+    Tells whether an upload failed because the blob's generation was not the one it was made for.
+    """
+    return getattr(error, 'code', None) == PreconditionFailed.code
+
+
+class LocalBlob:
+    """
+    A file standing in for a Cloud Storage blob, with the parts of its API the scripts use.
+
+    The file's modification time in nanoseconds plays the part of the blob
+    generation (0 when it does not exist, as for if_generation_match). Custom
+    metadata is kept in a JSON file next to it.
+    md5_hash is computed the way Cloud Storage reports it (base64 of the MD5 digest).
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, *name.split('/'))
+        self.metadata_path = f'{self.path}{METADATA_SUFFIX}'
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None and os.path.exists(self.metadata_path):
+            with open(self.metadata_path) as f:
+                self._metadata = json.load(f)
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, value):
+        self._metadata = value
+
+    @property
+    def generation(self):
+        return os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+
+    @property
+    def md5_hash(self):
+        return md5_hash(self.download_as_bytes()) if os.path.exists(self.path) else None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def reload(self):
+        self._metadata = None
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def download_as_bytes(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, 'rb') as f:
+            self.upload_from_string(f.read(), content_type)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Writers of the same file take turns, so checking the generation and writing are one step
+        with open(f'{self.path}{LOCK_SUFFIX}', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if if_generation_match is not None and (self.generation or 0) != if_generation_match:
+                raise PreconditionFailed(f'{self.name} is not at generation {if_generation_match}')
+
+            if self._metadata is not None:
+                with open(self.metadata_path, 'w') as f:
+                    json.dump(self._metadata, f)
+
+            # Readers never see a half written file
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+
+    def delete(self):
+        os.remove(self.path)
+        if os.path.exists(self.metadata_path):
+            os.remove(self.metadata_path)
+
+
+class LocalBucket:
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = self.blob(name)
+        return blob if blob.exists() else None
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        destination = destination_bucket.blob(new_name)
+        destination.upload_from_string(blob.download_as_bytes())
+        return destination
+
+    def list_blobs(self, prefix=''):
+        blobs = []
+        for folder, _, files in os.walk(self.path):
+            for file in files:
+                name = os.path.relpath(os.path.join(folder, file), self.path).replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith(('.tmp', METADATA_SUFFIX, LOCK_SUFFIX)):
+                    blobs.append(self.blob(name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+
+class LocalStorageClient:
+    def __init__(self, root):
+        self.root = root
+
+    def bucket(self, name):
+        return LocalBucket(self.root, name)
+
+
+def md5_hash(data):
+    """
+    Hashes file contents the way Cloud Storage reports a blob's md5_hash.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def get_storage_client():
+    """
+    Returns the Cloud Storage client, or the filesystem backend when AQ_STORAGE_DIR is set.
+    """
+    if STORAGE_DIR:
+        return LocalStorageClient(STORAGE_DIR)
+
+    # Only needed when talking to Cloud Storage
+    from google.cloud import storage
+    return storage.Client()
+
+
+def location_blob_name(location, filename):
+    """
+    Name of a file in a location's partition, for example 'columbus/air_quality_data_all.csv'.
+    """
+    return f"{location['slug']}/{filename}"
+
+
+def location_blob(bucket, location, filename):
+    """
+    Returns the blob holding `filename` for one location.
+    """
+    return partition_blob(bucket, location_blob_name(location, filename))
+
+
+def partition_blob(bucket, blob_name):
+    """
+    Returns the blob for a name like 'columbus/air_quality_data_all.csv'.
+
+    Files written before locations existed sit at the top of the bucket. They
+    belong to the legacy location and are copied into its partition on first use.
+    """
+    blob = bucket.blob(blob_name)
+    slug, _, filename = blob_name.partition('/')
+    if slug == LEGACY_LOCATION and filename and not blob.exists():
+        legacy_blob = bucket.blob(filename)
+        if legacy_blob.exists():
+            bucket.copy_blob(legacy_blob, bucket, blob.name)
+    return blob
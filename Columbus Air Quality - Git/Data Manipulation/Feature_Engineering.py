@@ -1,39 +1,366 @@
 import pandas as pd
-from google.cloud import storage
 import os
 import schedule
 import time
 import gc
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import Feature_Store
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+import AQI_Calculator
+from Dtype_Policy import apply_dtype_policy
+from Job_Runner import JobRunner
+from Locations import MAX_CONCURRENT_LOCATIONS, active_locations
+from Staging import read_staged_csv
+from Storage import get_storage_client, location_blob_name, md5_hash
+
+# Dictionary mapping
+bucket_names = {
+    'traffic_data_all_segments.csv': 'columbus-traffic-bucket',
+    'weather_data_all.csv': 'columbus-weather-bucket',
+    'wildfire_data_binned.csv': 'columbus-wildfire-bucket',
+    'eia_data_all.csv': 'energy-generation-bucket',
+    'air_quality_data_all.csv': 'columbus-aqi-bucket',
+    'pollutant_concentrations_all.csv': 'columbus-aqi-bucket'
+}
+
+# Sources collected separately for every location, the others cover the whole region
+LOCATION_FILES = ['traffic_data_all_segments.csv', 'weather_data_all.csv', 'air_quality_data_all.csv',
+                  'pollutant_concentrations_all.csv']
+
+# Sources the master dataset is built without until they have been collected
+OPTIONAL_FILES = ['pollutant_concentrations_all.csv']
+
+# Resolution of the master dataset, 'daily' or 'hourly' (LSTM.py reads the same setting)
+RESOLUTION = os.environ.get('AQ_RESOLUTION', 'daily')
+MASTER_DATASET_FILENAME = 'master_dataset_hourly.csv' if RESOLUTION == 'hourly' else 'master_dataset.csv'
+
+# Folder the feature stores are kept in
+FEATURE_STORE_DIR = os.environ.get('AQ_FEATURE_STORE_DIR', '/tmp')
+
+# How each source is put on the hourly grid: how readings within the same hour are
+# combined, and for how many hours the last reading is carried forward.
+# Sources that only record the date are carried through the whole day.
+HOURLY_RULES = {
+    'traffic_data_all_segments.csv': {'aggregate': 'sum', 'fill_limit': 3},
+    'weather_data_all.csv': {'aggregate': 'mean', 'fill_limit': 12},
+    'wildfire_data_binned.csv': {'aggregate': 'sum', 'fill_limit': 23},
+    'eia_data_all.csv': {'aggregate': 'mean', 'fill_limit': 2},
+    'air_quality_data_all.csv': {'aggregate': 'max', 'fill_limit': 2},
+    'pollutant_concentrations_all.csv': {'aggregate': 'max', 'fill_limit': 2},
+}
+
+
+def download_source(storage_client, csv_file):
+    """
+    Downloads one of the collected CSV files and reads it into a table.
+
+    Per-location files are downloaded from every location's partition at the
+    same time and stacked, with the location's slug in a 'Location' column.
+    Batches the collectors flushed since the last compaction are included.
+    """
+    bucket = storage_client.bucket(bucket_names[csv_file])
+    if csv_file not in LOCATION_FILES:
+        return read_staged_csv(bucket, csv_file)
+
+    def download_location(location):
+        df = read_staged_csv(bucket, location_blob_name(location, csv_file))
+        if df is None:
+            print(f"No {csv_file} collected for {location['name']} yet")
+            return None
+        df['Location'] = location['slug']
+        return df
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOCATIONS) as pool:
+        frames = [df for df in pool.map(download_location, active_locations()) if df is not None]
+    if not frames:
+        return None
+    return apply_dtype_policy(pd.concat(frames, ignore_index=True), csv_file)
+
+
+def pollutant_aqi(df, resolution):
+    """
+    Computes every location's AQI per pollutant from its monitors' raw concentrations.
+
+    Returns one row per location and hour (or day) with a column per pollutant.
+    """
+    # AirNow reports the monitors in UTC, the other sources use local time
+    times = (pd.to_datetime(df['utc'].astype(str), format='%Y-%m-%dT%H:%M', utc=True)
+             .dt.tz_convert('America/New_York').dt.tz_localize(None))
+    readings = pd.DataFrame({'time': times.values, 'site': df['site'].astype(str).values,
+                             'parameter': df['parameter'].astype(str).values,
+                             'concentration': pd.to_numeric(df['concentration'], errors='coerce').values})
+    frames = []
+    for slug, rows in readings.groupby(df['Location'].astype(str).values):
+        aqi = AQI_Calculator.pollutant_aqi(rows, resolution)
+        aqi.index.name = 'Date'
+        frames.append(aqi.reset_index().assign(Location=slug))
+    return pd.concat(frames, ignore_index=True)
+
+
+def feature_store_path(slug):
+    # Every location keeps its own feature store, the windows must not run across locations
+    return os.path.join(FEATURE_STORE_DIR, f'feature_store_values_{RESOLUTION}_{slug}.sqlite')
+
+
+def add_location_features(master_df):
+    """
+    Adds the lag, rolling and EWM features to every location's rows.
+    """
+    frames = [Feature_Store.add_features(rows, path=feature_store_path(slug))
+              for slug, rows in master_df.groupby('Location', observed=True, sort=False)]
+    return pd.concat(frames, ignore_index=True)
+
+
+def impute_missing(master_df, settle_rows):
+    """
+    Fills the gaps in the master dataset, location by location.
+
+    Each location's most recent row is left as it is. Wildfire data arrives a
+    day late, so its columns are only zero-filled for rows with at least
+    `settle_rows` newer rows after them.
+    """
+    master_df = master_df.sort_values(['Location', 'Date']).reset_index(drop=True)
+    rows_from_end = master_df.groupby('Location', observed=True).cumcount(ascending=False)
+    history = (rows_from_end > 0).values
+    settled = (rows_from_end >= settle_rows).values
+
+    # Impute 0 for the wildfire columns
+    wildfire_columns = [col for col in ['Canada', 'USA', 'Central America'] if col in master_df.columns]
+    master_df.loc[settled, wildfire_columns] = master_df.loc[settled, wildfire_columns].fillna(0)
+
+    # Impute missing values with the location's mean of each column (all locations' mean when the
+    # location never reported it), except for the most recent row
+    numerical_columns = master_df.select_dtypes(include=['number']).columns
+    past = master_df.loc[history]
+    means = past.groupby('Location', observed=True)[numerical_columns].transform('mean')
+    means = means.fillna(past[numerical_columns].mean())
+    master_df.loc[history, numerical_columns] = past[numerical_columns].fillna(means)
+
+    # Fill missing values in 'wind_dir' with the most frequent value, except for the most recent row
+    if 'wind_dir' in master_df.columns and master_df.loc[history, 'wind_dir'].notna().any():
+        master_df.loc[history, 'wind_dir'] = master_df.loc[history, 'wind_dir'].fillna(
+            master_df.loc[history, 'wind_dir'].mode()[0])
+    return master_df
+
+
+def finish_master_dataset(master_df, date_format):
+    """
+    Puts the columns in the order the LSTM expects and formats the dates.
+    """
+    # 'Location' and 'Date' first, 'MaxAQI' last
+    middle = [col for col in master_df.columns if col not in ('Location', 'Date', 'MaxAQI')]
+    master_df = master_df[['Location', 'Date'] + middle + ['MaxAQI']]
+
+    # Drop rows where 'Date' is NaN
+    master_df = master_df.dropna(subset=['Date'])
+    master_df['Date'] = pd.to_datetime(master_df['Date']).dt.strftime(date_format)
+
+    # Drop columns that are completely empty
+    return master_df.dropna(axis=1, how='all')
+
+
+def traffic_totals(df, period_columns):
+    """
+    Sums the segments' mean speed difference (free flow minus current speed) and congestion minutes
+    per location and period.
+
+    Raw snapshots count as one sample each and streaming rollups as the samples they
+    hold, so the totals do not depend on how often traffic was sampled.
+    """
+    keys = ['Location'] + period_columns + ['segment_name']
+    weights = df['samples'].astype(float).fillna(1) if 'samples' in df.columns else 1.0
+    congestion = df['congestion_minutes'].astype(float) if 'congestion_minutes' in df.columns else float('nan')
+    difference = df['freeFlowSpeed'].astype(float) - df['currentSpeed'].astype(float)
+
+    segments = df[keys].assign(weighted=difference * weights, weight=weights, CongestionMinutes=congestion)
+    segments = segments.groupby(keys, observed=True, dropna=False).sum(min_count=1)
+    segments['TotalSpeedDifference'] = segments['weighted'] / segments['weight']
+    return segments.groupby(level=keys[:-1], dropna=False)[['TotalSpeedDifference', 'CongestionMinutes']].sum(
+        min_count=1).reset_index()
+
+
+def source_readings(csv_file, df):
+    """
+    Turns one source into a table of readings indexed by their local time.
+    """
+    if csv_file == 'traffic_data_all_segments.csv':
+        # Snapshots only have the date, hourly rollups also have the hour
+        df = df.assign(hour=df['hour'].fillna(0) if 'hour' in df.columns else 0)
+        df = traffic_totals(df, ['timestamp', 'hour'])
+        # As text, a categorical of dates (once the file is compacted) would stay a categorical
+        times = (pd.to_datetime(df['timestamp'].astype(str), format='%m/%d/%Y')
+                 + pd.to_timedelta(df['hour'].astype(float), unit='h'))
+        readings = df[['TotalSpeedDifference', 'CongestionMinutes']]
+
+    elif csv_file == 'weather_data_all.csv':
+        times = pd.to_datetime(df['date'].astype(str), format='%m/%d/%Y')
+        if 'hour' in df.columns:
+            # Readings from before the hour was recorded count from midnight
+            times = times + pd.to_timedelta(df['hour'].astype(float).fillna(0), unit='h')
+        readings = df[['temperature', 'humidity', 'wind_speed', 'pressure', 'precip', 'visibility', 'wind_dir']]
+
+    elif csv_file == 'wildfire_data_binned.csv':
+        df = df.drop_duplicates(subset=['Date', 'Country']).astype({'Country': str})
+        pivoted = df.pivot(index='Date', columns='Country', values='frp')
+        times = pd.to_datetime(pivoted.index.to_series(), format='%m/%d/%Y')
+        readings = pivoted.reset_index(drop=True)
+
+    elif csv_file == 'pollutant_concentrations_all.csv':
+        aqi = pollutant_aqi(df, 'hourly')
+        times = aqi['Date']
+        readings = aqi.drop(columns=['Date', 'Location'])
+        df = aqi
+
+    elif csv_file == 'eia_data_all.csv':
+        # EIA reports in UTC, the other sources use local time
+        df = df[df['type-name'].isin(['Coal', 'Natural Gas', 'Petroleum', 'Other'])].astype({'type-name': str})
+        df = df.assign(period=pd.to_datetime(df['period'], format='%Y-%m-%dT%H-%M', utc=True)
+                       .dt.tz_convert('America/New_York').dt.tz_localize(None))
+        pivoted = df.pivot_table(index='period', columns='type-name', values='value', aggfunc='mean')
+        times = pivoted.index.to_series()
+        readings = pivoted.reset_index(drop=True)
+
+    else:
+        # As text, with errors='coerce' a categorical of dates stays a categorical
+        times = pd.to_datetime(df['date'].astype(str), format='%m/%d/%Y', errors='coerce')
+        if 'hour' in df.columns:
+            times = times + pd.to_timedelta(df['hour'].fillna(0), unit='h')
+        readings = pd.DataFrame({'MaxAQI': df['aqi']})
+
+    readings = readings.reset_index(drop=True)
+    if csv_file in LOCATION_FILES:
+        readings['Location'] = df['Location'].astype(str).values
+    readings.index = pd.DatetimeIndex(times.values)
+    return readings[readings.index.notna()]
+
+
+def resample_hourly(readings, rule, grid):
+    """
+    Puts a source's readings on the hourly grid following its rule.
+    """
+    date_only = bool((readings.index == readings.index.normalize()).all())
+    fill_limit = 23 if date_only else rule['fill_limit']
+
+    numeric = readings.select_dtypes(include=['number']).astype('float32')
+    hourly = numeric.groupby(numeric.index.floor('h')).agg(rule['aggregate'])
+    if 'wind_dir' in readings.columns:
+        hourly['wind_dir'] = readings['wind_dir'].groupby(readings.index.floor('h')).first()
+
+    return hourly.reindex(grid).ffill(limit=fill_limit)
+
+
+def build_hourly_master_dataset(storage_client):
+    """
+    Builds the master dataset on an hourly grid instead of one row per day.
+    """
+    readings = {}
+    for csv_file in HOURLY_RULES:
+        df = download_source(storage_client, csv_file)
+        if df is None and csv_file in OPTIONAL_FILES:
+            print(f"No {csv_file} collected yet, building without it")
+            continue
+        readings[csv_file] = source_readings(csv_file, df)
+
+    start = min(r.index.min() for r in readings.values() if not r.empty).floor('h')
+    end = max(r.index.max() for r in readings.values() if not r.empty).floor('h')
+    grid = pd.date_range(start, end, freq='h', name='Date')
+
+    # The regional sources are shared by every location
+    regional = [resample_hourly(readings[csv_file], rule, grid)
+                for csv_file, rule in HOURLY_RULES.items() if csv_file not in LOCATION_FILES]
+
+    frames = []
+    for location in active_locations():
+        slug = location['slug']
+        if not (readings['air_quality_data_all.csv']['Location'] == slug).any():
+            # Nothing to train on or forecast without AQI readings
+            continue
+        local = [resample_hourly(readings[csv_file][readings[csv_file]['Location'] == slug].drop(columns='Location'),
+                                 HOURLY_RULES[csv_file], grid)
+                 for csv_file in LOCATION_FILES if csv_file in readings]
+        frame = pd.concat(local + regional, axis=1)
+        frame['Location'] = slug
+        frames.append(frame)
+    del readings, regional
+    gc.collect()
+
+    master_df = pd.concat(frames).reset_index()
+    master_df['Lagged_MaxAQI'] = master_df.groupby('Location')['MaxAQI'].shift(1)
+
+    # Add the lag, rolling and EWM features (windows count hours here)
+    master_df = add_location_features(master_df)
+
+    # Wildfire data arrives a day late, so the last two days are left for it to fill in
+    master_df = impute_missing(master_df, settle_rows=48)
+
+    numerical_columns = master_df.select_dtypes(include=['number']).columns
+    master_df[numerical_columns] = master_df[numerical_columns].astype('float32')
+    master_df['wind_dir'] = master_df['wind_dir'].astype('category')
+    master_df['Location'] = master_df['Location'].astype('category')
+
+    return finish_master_dataset(master_df, '%m/%d/%Y %H:%M')
+
+
+def upload_master_dataset(storage_client, master_df):
+    try:
+        master_dataset_bucket_name = 'master-aqi-bucket'
+        master_dataset_bucket = storage_client.bucket(master_dataset_bucket_name)
+
+        # Write the master dataframe to a CSV file
+        master_df.to_csv(f'/tmp/{MASTER_DATASET_FILENAME}', index=False)
+
+        # Skip the upload when nothing changed, so the generation only moves (and the models only
+        # retrain) when the data does
+        with open(f'/tmp/{MASTER_DATASET_FILENAME}', 'rb') as f:
+            content_hash = md5_hash(f.read())
+        existing = master_dataset_bucket.get_blob(MASTER_DATASET_FILENAME)
+        if existing is not None and existing.md5_hash == content_hash:
+            print('Master dataset unchanged, not uploaded.')
+            return
+
+        # Upload the CSV file to the bucket
+        blob = master_dataset_bucket.blob(MASTER_DATASET_FILENAME)
+        blob.upload_from_filename(f'/tmp/{MASTER_DATASET_FILENAME}')
+
+        print('Master dataset uploaded successfully to Google Cloud Storage.')
+
+    except Exception as e:
+        print(f"Error uploading master dataset: {e}")
+        # The runner and the pipeline have to see the build failed, so it is retried
+        raise
+
+
+def merge_frames(master_df, df, on):
+    if master_df.empty:
+        return df.copy()
+    return pd.merge(master_df, df, on=on, how='outer')
 
 
 def process_data():
     # Set your Google Cloud credentials path
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'XXXXXXXXXX'
 
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
 
-    # Dictionary mapping
-    bucket_names = {
-        'traffic_data_all_segments.csv': 'columbus-traffic-bucket',
-        'weather_data_all.csv': 'columbus-weather-bucket',
-        'wildfire_data_binned.csv': 'columbus-wildfire-bucket',
-        'eia_data_all.csv': 'energy-generation-bucket',
-        'air_quality_data_all.csv': 'columbus-aqi-bucket'
-    }
+    if RESOLUTION == 'hourly':
+        upload_master_dataset(storage_client, build_hourly_master_dataset(storage_client))
+        return
 
     csv_files = list(bucket_names.keys())
-    master_df = pd.DataFrame()
 
-    for csv_file in csv_files:
-        bucket_name = bucket_names[csv_file]
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(csv_file)
+    # One row per location and day for the local sources, one row per day for the regional ones
+    location_df = pd.DataFrame()
+    regional_df = pd.DataFrame()
 
-        # Download the CSV file to a temporary location
-        temp_file_path = f'/tmp/{csv_file}'
-        blob.download_to_filename(temp_file_path)
-
-        df = pd.read_csv(temp_file_path)
+    for csv_file in csv_files:
+        df = download_source(storage_client, csv_file)
+        if df is None and csv_file in OPTIONAL_FILES:
+            print(f"No {csv_file} collected yet, building without it")
+            continue
 
         # Print column names for debugging
         print(f"Columns in {csv_file}: {df.columns}")
@@ -42,20 +369,13 @@ def process_data():
             # Standardize date
             df['timestamp'] = pd.to_datetime(df['timestamp'], format='%m/%d/%Y').dt.date
 
-            df['SpeedDifference'] = df['freeFlowSpeed'] - df['currentSpeed']
-            daily_speed_diff = df.groupby(['timestamp'])['SpeedDifference'].sum().reset_index()
-            daily_speed_diff.columns = ['Date', 'TotalSpeedDifference']
+            daily_speed_diff = traffic_totals(df, ['timestamp'])
+            daily_speed_diff.rename(columns={'timestamp': 'Date'}, inplace=True)
 
-            # Convert 'Date' to datetime before formatting
+            # Convert 'Date' to datetime
             daily_speed_diff['Date'] = pd.to_datetime(daily_speed_diff['Date'])
 
-            # Format the 'Date' column in daily_speed_diff as 'MM/DD/YYYY'
-            daily_speed_diff['Date'] = daily_speed_diff['Date'].dt.strftime('%m/%d/%Y')
-
-            if master_df.empty:
-                master_df = daily_speed_diff.copy()
-            else:
-                master_df = pd.merge(master_df, daily_speed_diff, on='Date', how='outer')
+            location_df = merge_frames(location_df, daily_speed_diff, ['Location', 'Date'])
 
 
         elif csv_file == 'weather_data_all.csv':
@@ -63,52 +383,39 @@ def process_data():
             # Standardize date format
             df['date'] = pd.to_datetime(df['date'], format='%m/%d/%Y')
             columns_to_average = ['temperature', 'humidity', 'wind_speed', 'pressure', 'precip', 'visibility']
-            daily_averages = df.groupby(df['date'].dt.date)[columns_to_average].mean().reset_index()
-            daily_averages['wind_dir'] = df.groupby(df['date'].dt.date)['wind_dir'].first().reset_index()['wind_dir']
+            by_day = df.groupby([df['Location'], df['date'].dt.date], observed=True)
+            daily_averages = by_day[columns_to_average].mean()
+            daily_averages['wind_dir'] = by_day['wind_dir'].first()
+            daily_averages = daily_averages.reset_index()
 
             # Rename 'date' column in daily_averages to match master_df
             daily_averages.rename(columns={'date': 'Date'}, inplace=True)
 
-            # Convert 'Date' to datetime before formatting
+            # Convert 'Date' to datetime
             daily_averages['Date'] = pd.to_datetime(daily_averages['Date'])
 
-            # Format the 'Date' column in daily_averages as 'MM/DD/YYYY'
-            daily_averages['Date'] = daily_averages['Date'].dt.strftime('%m/%d/%Y')
-            if master_df.empty:
-                master_df = daily_averages.copy()
-            else:
-                master_df = pd.merge(master_df, daily_averages, on='Date', how='outer')
-
-
-
+            location_df = merge_frames(location_df, daily_averages, ['Location', 'Date'])
 
 
         elif csv_file == 'wildfire_data_binned.csv':
-            # Standardize date format using the correct format '%m/%d/%Y'
-            df['Date'] = pd.to_datetime(df['Date'], format='%m/%d/%Y')
-            df = df.drop_duplicates(subset=['Date', 'Country'])
+            # Standardize date format using the correct format '%m/%d/%Y' (as text, the dtype policy keeps
+            # the repeated dates as a categorical and to_datetime would return a categorical too)
+            df['Date'] = pd.to_datetime(df['Date'].astype(str), format='%m/%d/%Y')
+            df = df.drop_duplicates(subset=['Date', 'Country']).astype({'Country': str})
 
             # Pivot the DataFrame to have countries as columns
             df_pivoted = df.pivot(index='Date', columns='Country', values='frp').reset_index()
+            df_pivoted.columns.name = None
 
-            # Format the 'Date' column in df_pivoted as 'MM/DD/YYYY'
-            df_pivoted['Date'] = df_pivoted['Date'].dt.strftime('%m/%d/%Y')
-
-            if master_df.empty:
-                master_df = df_pivoted.copy()
-
-            else:
-                # Merge on the 'Date' column to ensure proper alignment
-                master_df = pd.merge(master_df, df_pivoted, on='Date', how='outer')
-
-
+            # Merge on the 'Date' column to ensure proper alignment
+            regional_df = merge_frames(regional_df, df_pivoted, 'Date')
 
 
         elif csv_file == 'eia_data_all.csv':
             # Specify the custom format (adjust as needed based on your data)
             df['period'] = pd.to_datetime(df['period'], format='%Y-%m-%dT%H-%M', utc=True)
             fuel_types_to_include = ['Coal', 'Natural Gas', 'Petroleum', 'Other']
-            df_filtered = df[df['type-name'].isin(fuel_types_to_include)]
+            df_filtered = df[df['type-name'].isin(fuel_types_to_include)].astype({'type-name': str})
 
             # Group by the DATE part of the period and fuel type, then calculate the average
             daily_averages = df_filtered.groupby([df['period'].dt.date, 'type-name'])['value'].mean().reset_index()
@@ -117,108 +424,63 @@ def process_data():
             # Pivot the data to have fuel types as columns
             daily_averages_pivot = daily_averages.pivot(index='Date', columns='Fuel_Type',
                                                         values='Average_Energy_Value').reset_index()
+            daily_averages_pivot.columns.name = None
 
-            # Convert 'Date' to the same format as in master_df
-            daily_averages_pivot['Date'] = pd.to_datetime(daily_averages_pivot['Date']).dt.strftime('%m/%d/%Y')
-            if master_df.empty:
-                master_df = daily_averages_pivot.copy()
-
-
-            else:
-                master_df = pd.merge(master_df, daily_averages_pivot, on='Date', how='outer')
+            # Convert 'Date' to datetime
+            daily_averages_pivot['Date'] = pd.to_datetime(daily_averages_pivot['Date'])
+            regional_df = merge_frames(regional_df, daily_averages_pivot, 'Date')
 
 
         elif csv_file == 'air_quality_data_all.csv':
             # Standardize date format
             df['date'] = pd.to_datetime(df['date'], format='%m/%d/%Y', errors='coerce')
 
-            # Calculate the maximum AQI per day
-            daily_aqi_max = df.groupby(df['date'].dt.date)['aqi'].max().reset_index()
-            daily_aqi_max.columns = ['Date', 'MaxAQI']
+            # Calculate the maximum AQI per location and day
+            daily_aqi_max = df.groupby([df['Location'], df['date'].dt.date], observed=True)['aqi'].max().reset_index()
+            daily_aqi_max.columns = ['Location', 'Date', 'MaxAQI']
 
             # Convert 'Date' columns to datetime if they are not already
             daily_aqi_max['Date'] = pd.to_datetime(daily_aqi_max['Date'])
 
-            # Calculate Lagged_MaxAQI (shift the MaxAQI by 1 day)
-            daily_aqi_max['Lagged_MaxAQI'] = daily_aqi_max['MaxAQI'].shift(1)
-
-            # The merge operation
-            if master_df.empty:
-                master_df = daily_aqi_max.copy()
-
-
-            else:
-                master_df['Date'] = pd.to_datetime(master_df['Date'], format='%m/%d/%Y')
-                master_df = pd.merge(master_df, daily_aqi_max, on='Date', how='outer')
+            # Calculate Lagged_MaxAQI (shift the MaxAQI by 1 day within each location)
+            daily_aqi_max['Lagged_MaxAQI'] = daily_aqi_max.groupby('Location', observed=True)['MaxAQI'].shift(1)
 
-            # Reorder columns to have 'MaxAQI' last
-            if master_df.columns[-1] != 'MaxAQI':  # Check if 'MaxAQI' is not already last
-                master_df = master_df[[col for col in master_df.columns if col != 'MaxAQI'] + ['MaxAQI']]
+            location_df = merge_frames(location_df, daily_aqi_max, ['Location', 'Date'])
 
-            # Format the 'Date' columns in daily_aqi_data as 'MM/DD/YYYY'
-            daily_aqi_max['Date'] = daily_aqi_max['Date'].dt.strftime('%m/%d/%Y')
-            print(f"Shape of master_df after merging {csv_file}: {master_df.shape}")
+        elif csv_file == 'pollutant_concentrations_all.csv':
+            # The AQI of every pollutant by the EPA's daily averaging rules
+            daily_pollutant_aqi = pollutant_aqi(df, 'daily')
+            location_df = merge_frames(location_df, daily_pollutant_aqi, ['Location', 'Date'])
 
-        # Clean up the temporary file
-        os.remove(temp_file_path)
+        print(f"Shape of master_df after merging {csv_file}: {location_df.shape} per location, "
+              f"{regional_df.shape} regional")
 
-    # Impute 0 for the specified columns
-    columns_to_impute_zero = ['Canada', 'USA', 'Central America']
+    # Every location shares the regional sources of its day
+    master_df = pd.merge(location_df.astype({'Location': str}), regional_df, on='Date', how='left')
+    del location_df, regional_df
+    gc.collect()
 
-    # Get the index of the most recent row
-    most_recent_row_index = master_df['Date'].idxmax()
+    # Add the lag, rolling and EWM features (only new or corrected days are recomputed)
+    master_df = add_location_features(master_df)
 
-    # Get the index of the row before the most recent one
-    second_most_recent_row_index = master_df['Date'].sort_values(ascending=False).index[1]
-
-    # Apply fillna(0) to all rows except the most recent and second most recent ones
-    for col in columns_to_impute_zero:
-        master_df.loc[~master_df.index.isin([most_recent_row_index, second_most_recent_row_index]), col] = \
-            master_df.loc[~master_df.index.isin([most_recent_row_index, second_most_recent_row_index]), col].fillna(0)
-
-    # Impute missing values with the mean of each column, except for the most recent row
-    numerical_columns = master_df.select_dtypes(include=['number']).columns
-    for col in numerical_columns:
-        column_mean = master_df.loc[master_df.index != most_recent_row_index, col].mean()
-        master_df.loc[master_df.index != most_recent_row_index, col] = master_df.loc[
-            master_df.index != most_recent_row_index, col].fillna(column_mean)
+    # Wildfire data arrives a day late, so the last two days are left for it to fill in
+    master_df = impute_missing(master_df, settle_rows=2)
 
-    # Fill missing values in 'wind_dir' with the most frequent value, except for the most recent row
-    most_frequent_wind_dir = master_df.loc[master_df.index != most_recent_row_index, 'wind_dir'].mode()[0]
-    master_df.loc[master_df.index != most_recent_row_index, 'wind_dir'] = master_df.loc[
-        master_df.index != most_recent_row_index, 'wind_dir'].fillna(most_frequent_wind_dir)
+    master_df = finish_master_dataset(master_df, '%m/%d/%Y')
+    master_df = apply_dtype_policy(master_df, MASTER_DATASET_FILENAME)
 
     # Upload the master dataset to Google Cloud Storage
-    master_dataset_bucket_name = 'master-aqi-bucket'
-    master_dataset_bucket = storage_client.bucket(master_dataset_bucket_name)
-
-    # Format the 'Date' column in the final master_df as 'MM/DD/YYYY'
-    master_df['Date'] = pd.to_datetime(master_df['Date']).dt.strftime('%m/%d/%Y')
-
-    # Drop rows where 'Date' is NaN
-    master_df.dropna(subset=['Date'], inplace=True)
+    upload_master_dataset(storage_client, master_df)
 
-    # Drop columns that are completely empty
-    master_df.dropna(axis=1, how='all', inplace=True)
-
-    try:
-        master_dataset_bucket_name = 'master-aqi-bucket'
-        master_dataset_bucket = storage_client.bucket(master_dataset_bucket_name)
-
-        # Write the master dataframe to a CSV file
-        master_df.to_csv('/tmp/master_dataset.csv', index=False)
-
-        # Upload the CSV file to the bucket
-        blob = master_dataset_bucket.blob('master_dataset.csv')
-        blob.upload_from_filename('/tmp/master_dataset.csv')
-
-        print('Master dataset uploaded successfully to Google Cloud Storage.')
 
+if __name__ == '__main__':
+    # Every build runs in a worker process with memory and time limits, so the scheduler stays small
+    runner = JobRunner('process_data')
 
-# Schedule to run every hour
-schedule.every().hour.do(process_data)
+    # Schedule to run every hour
+    schedule.every().hour.do(runner.run, process_data)
 
-# Keep the script running to execute scheduled tasks
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+    # Keep the script running to execute scheduled tasks
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
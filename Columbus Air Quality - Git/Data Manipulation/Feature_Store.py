@@ -0,0 +1,226 @@
+import sqlite3
+from contextlib import closing, contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Where the feature values computed so far are kept between runs
+FEATURE_STORE_PATH = '/tmp/feature_store_values.sqlite'
+
+# Rows at the end of the stored history that are hashed again on every run, so late or corrected
+# data (wildfire arrives a day late, AirNow revises recent hours) is picked up. Older rows are settled.
+RECHECK_ROWS = 72
+
+# Temporal features built on top of the master dataset columns.
+# Windows are counted in rows (days in the daily master dataset).
+# AQI features are shifted by a row so a day's own MaxAQI never leaks into its inputs.
+FEATURES = [
+    {'name': 'MaxAQI_lag2', 'column': 'MaxAQI', 'kind': 'lag', 'window': 2},
+    {'name': 'MaxAQI_lag7', 'column': 'MaxAQI', 'kind': 'lag', 'window': 7},
+    {'name': 'MaxAQI_mean7', 'column': 'MaxAQI', 'kind': 'rolling_mean', 'window': 7, 'shift': 1},
+    {'name': 'MaxAQI_max7', 'column': 'MaxAQI', 'kind': 'rolling_max', 'window': 7, 'shift': 1},
+    {'name': 'USA_mean3', 'column': 'USA', 'kind': 'rolling_mean', 'window': 3},
+    {'name': 'USA_max7', 'column': 'USA', 'kind': 'rolling_max', 'window': 7},
+    {'name': 'Canada_mean3', 'column': 'Canada', 'kind': 'rolling_mean', 'window': 3},
+    {'name': 'Canada_max7', 'column': 'Canada', 'kind': 'rolling_max', 'window': 7},
+    {'name': 'temperature_lag1', 'column': 'temperature', 'kind': 'lag', 'window': 1},
+    {'name': 'temperature_mean3', 'column': 'temperature', 'kind': 'rolling_mean', 'window': 3},
+    {'name': 'congestion_ewm7', 'column': 'TotalSpeedDifference', 'kind': 'ewm', 'window': 7},
+]
+
+
+def feature_names():
+    """
+    Lists the columns the feature store adds to the master dataset.
+    """
+    return [spec['name'] for spec in FEATURES]
+
+
+def context_rows(spec):
+    """
+    Number of earlier rows a feature needs to compute its value for a row.
+    """
+    if spec['kind'] == 'lag':
+        return spec['window']
+    if spec['kind'] == 'ewm':
+        # EWM only needs its own previous value, which is kept in the store
+        return 0
+    return spec['window'] + spec.get('shift', 0) - 1
+
+
+def compute_feature(spec, values, start, previous=np.nan):
+    """
+    Computes one feature for the rows from `start` on.
+
+    `values` is the source column, it only has to reach `context_rows(spec)` rows
+    before `start`. `previous` is the EWM value of the row before `start`.
+    """
+    series = pd.Series(values, dtype='float64')
+    kind = spec['kind']
+    if kind == 'lag':
+        result = series.shift(spec['window'])
+    elif kind in ('rolling_mean', 'rolling_max'):
+        shifted = series.shift(spec.get('shift', 0))
+        rolling = shifted.rolling(spec['window'], min_periods=1)
+        result = rolling.mean() if kind == 'rolling_mean' else rolling.max()
+    elif kind == 'ewm':
+        # Same recursion as pandas ewm(span=window, adjust=False, ignore_na=True), seeded with the stored value
+        alpha = 2.0 / (spec['window'] + 1)
+        current = previous
+        out = np.empty(len(series) - start)
+        for i, value in enumerate(series.values[start:]):
+            if not np.isnan(value):
+                current = value if np.isnan(current) else alpha * value + (1 - alpha) * current
+            out[i] = current
+        return out
+    else:
+        raise ValueError(f"Unknown feature kind: {kind}")
+
+    return result.values[start:]
+
+
+def row_hashes(df, columns):
+    """
+    Hashes the source columns of every row, so corrected history can be spotted.
+    """
+    present = [col for col in columns if col in df.columns]
+    hashes = pd.util.hash_pandas_object(df[present], index=False).values
+    return hashes.view(np.int64)
+
+
+def first_changed_row(dates, hashes, stored):
+    """
+    Returns the position of the first row that is new or differs from what the store saw.
+    """
+    if stored.empty:
+        return 0
+
+    # Rows the store already has must still hash the same
+    in_store = dates.isin(stored.index)
+    matches = np.zeros(len(dates), dtype=bool)
+    matches[in_store] = stored['row_hash'].loc[dates[in_store]].values == hashes[in_store]
+    changed = np.flatnonzero(~matches)
+    first = int(changed[0]) if len(changed) else len(dates)
+
+    # Rows that disappeared from the history invalidate everything after them
+    missing = stored.index[~stored.index.isin(dates)]
+    if len(missing):
+        first = min(first, int(np.searchsorted(dates.values, missing.min().to_datetime64())))
+    return first
+
+
+def connect(path=FEATURE_STORE_PATH):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS feature_rows (date TEXT PRIMARY KEY, row_hash INTEGER NOT NULL)')
+    return connection
+
+
+@contextmanager
+def transaction(connection):
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def stored_features(connection):
+    return [row[1] for row in connection.execute('PRAGMA table_info(feature_rows)').fetchall()
+            if row[1] not in ('date', 'row_hash')]
+
+
+def date_keys(dates):
+    # ISO dates sort the same as the dates themselves
+    return [date.isoformat() for date in dates]
+
+
+def recheck_start(connection, dates):
+    """
+    Returns the position the stored history is checked again from, and the stored rows from there on.
+
+    The rows before it are only counted, not hashed. If their number differs
+    from the store's (a backfill added older history), everything is checked.
+    """
+    (n_stored,) = connection.execute('SELECT COUNT(*) FROM feature_rows').fetchone()
+    tail = connection.execute('SELECT date, row_hash FROM feature_rows ORDER BY date DESC LIMIT ?',
+                              (RECHECK_ROWS,)).fetchall()
+    position = n_stored - len(tail)
+    if tail and int(np.searchsorted(dates.values, pd.Timestamp(tail[-1][0]).to_datetime64())) == position:
+        return position, tail
+    return 0, connection.execute('SELECT date, row_hash FROM feature_rows').fetchall()
+
+
+def add_features(master_df, path=FEATURE_STORE_PATH):
+    """
+    Adds the temporal features to the master dataset.
+
+    Only the last RECHECK_ROWS stored rows and the new ones are hashed, and
+    only the rows from the first new or corrected one on are computed and
+    written, the rest are read from the store. A brand new feature is
+    computed over the whole history once and then kept up to date like the
+    others.
+    """
+    df = master_df.dropna(subset=['Date']).sort_values('Date').reset_index(drop=True)
+    dates = pd.DatetimeIndex(df['Date'])
+    source_columns = sorted({spec['column'] for spec in FEATURES})
+    specs = [spec for spec in FEATURES if spec['column'] in df.columns]
+
+    with closing(connect(path)) as connection, transaction(connection):
+        checked_from, tail = recheck_start(connection, dates)
+        stored = pd.DataFrame({'row_hash': [row_hash for _, row_hash in tail]},
+                              index=pd.DatetimeIndex([date for date, _ in tail]))
+        hashes = row_hashes(df.iloc[checked_from:], source_columns)
+        start = checked_from + first_changed_row(dates[checked_from:], hashes, stored)
+
+        in_store = stored_features(connection)
+        known_names = [spec['name'] for spec in specs if spec['name'] in in_store]
+        known = {}
+        if start and known_names:
+            rows = connection.execute(f'SELECT {", ".join(known_names)} FROM feature_rows ORDER BY date LIMIT ?',
+                                      (start,))
+            known = dict(zip(known_names, np.array(rows.fetchall(), dtype=float).reshape(-1, len(known_names)).T))
+
+        values = {}
+        for spec in specs:
+            name = spec['name']
+            feature_start = start if name in known else 0
+            head = known[name] if feature_start else np.empty(0)
+
+            # Only feed the rows the feature can see from the first row being recomputed
+            offset = max(feature_start - context_rows(spec), 0)
+            source = df[spec['column']].values[offset:]
+            previous = head[-1] if len(head) else np.nan
+            fresh = compute_feature(spec, source, feature_start - offset, previous)
+            values[name] = np.concatenate([head, fresh]).astype(np.float32)
+
+        # Keep the store in step with the history it was computed from: new columns are filled in
+        # for the settled rows, the rows from `start` on are replaced
+        new_names = [name for name in values if name not in in_store]
+        for name in new_names:
+            connection.execute(f'ALTER TABLE feature_rows ADD COLUMN {name} REAL')
+        if new_names and start:
+            connection.executemany(
+                f'UPDATE feature_rows SET {", ".join(f"{name} = ?" for name in new_names)} WHERE date = ?',
+                zip(*[values[name][:start].tolist() for name in new_names], date_keys(dates[:start])))
+        if start == 0:
+            connection.execute('DELETE FROM feature_rows')
+        elif start < len(df):
+            connection.execute('DELETE FROM feature_rows WHERE date >= ?', (dates[start].isoformat(),))
+        else:
+            # Rows past the end of the history are no longer in it
+            connection.execute('DELETE FROM feature_rows WHERE date > ?', (dates[-1].isoformat(),))
+        if start < len(df):
+            names = list(values)
+            connection.executemany(
+                f'INSERT INTO feature_rows (date, row_hash{"".join(f", {name}" for name in names)}) '
+                f'VALUES ({", ".join("?" * (len(names) + 2))})',
+                zip(date_keys(dates[start:]), hashes[start - checked_from:].tolist(),
+                    *[values[name][start:].tolist() for name in names]))
+            print(f"Feature store recomputed {len(df) - start} of {len(df)} rows")
+
+    for name, column in values.items():
+        df[name] = column
+    return df
@@ -1,7 +1,15 @@
-import requests
 import json
+import os
+import sys
 import pandas as pd
 
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Http_Client import http_get
+
+# Pulls a range into a local CSV for a quick look. To fill the storage the live collectors write to,
+# use Backfill/Backfill.py, which fetches every source in parallel and resumes interrupted runs.
+
 def get_energy_data_from_eia(api_key):
 
     base_url = "https://api.eia.gov/v2/electricity/rto/fuel-type-data/data/"
@@ -21,7 +29,7 @@ def get_energy_data_from_eia(api_key):
     }
 
     # Get the energy data
-    response = requests.get(base_url, headers=headers, params={"api_key": api_key, "data[]": "value"})
+    response = http_get('eia', base_url, headers=headers, params={"api_key": api_key, "data[]": "value"})
 
     if response.status_code == 200:
         api_response = response.json()
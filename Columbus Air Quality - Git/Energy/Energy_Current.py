@@ -1,12 +1,17 @@
 import schedule
-import datetime
 import time
 import requests
 import pandas as pd
-from google.cloud import storage
 import os
 import json
-import tempfile
+import sys
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Dtype_Policy import apply_dtype_policy
+import Clock
+from Http_Client import http_get
+from Staging import UPSERT_KEYS, flush, stage_upserts
 
 # Google Cloud Storage configuration (replace with your actual service account key file path)
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'PATH_TO_YOUR_SERVICE_ACCOUNT_KEY_FILE.json'
@@ -14,7 +19,7 @@ STORAGE_BUCKET_NAME = 'YOUR_STORAGE_BUCKET_NAME'
 
 def get_and_save_energy_data():
     """
-    Fetches energy data from the EIA API and saves it to cloud storage.
+    Fetches energy data from the EIA API and stages it for cloud storage.
     """
     try:
         # EIA API key (replace with your actual key)
@@ -23,7 +28,7 @@ def get_and_save_energy_data():
         base_url = "https://api.eia.gov/v2/electricity/rto/fuel-type-data/data/"
 
         # Get today's date
-        today = datetime.date.today().strftime('%Y-%m-%d')
+        today = Clock.today().strftime('%Y-%m-%d')
 
         # Set up the request to get today's data up to 11:00 PM
         headers = {
@@ -40,37 +45,21 @@ def get_and_save_energy_data():
         }
 
         # Get the energy data
-        response = requests.get(base_url, headers=headers, params={"api_key": EIA_API_KEY, "data[]": "value"})
+        response = http_get('eia', base_url, headers=headers, params={"api_key": EIA_API_KEY, "data[]": "value"})
         response.raise_for_status()
 
         data = response.json()
 
         if data and 'response' in data and 'data' in data['response']:
             data_list = data['response']['data']
-            energy_data = pd.DataFrame(data_list)
-
-            # Connect to cloud storage
-            storage_client = storage.Client()
-            bucket = storage_client.bucket(STORAGE_BUCKET_NAME)
+            energy_data = apply_dtype_policy(pd.DataFrame(data_list))
 
-            # Save the energy data to cloud storage
+            # Stage the energy data, the flusher appends it to cloud storage in batches.
+            # Hours EIA already sent (or the backfill wrote) are only staged again if they changed.
             blob_name = "eia_data_all.csv"
-            energy_data_blob = bucket.blob(blob_name)
-
-            if energy_data_blob.exists():
-                # Add new data to the existing file
-                with tempfile.NamedTemporaryFile(mode='w+', delete=False) as temp_file:
-                    energy_data_blob.download_to_filename(temp_file.name)
-                    existing_data = pd.read_csv(temp_file.name)
-                updated_data = pd.concat([existing_data, energy_data], ignore_index=True)
-                energy_data_blob.upload_from_string(updated_data.to_csv(index=False), content_type='text/csv')
-                os.remove(temp_file.name)
-
-            else:
-                # Create a new file to store the energy data
-                energy_data_blob.upload_from_string(energy_data.to_csv(index=False), content_type='text/csv')
-
-            print(f"EIA data for {today} fetched and saved successfully!")
+            stage_upserts(STORAGE_BUCKET_NAME, blob_name, energy_data, UPSERT_KEYS[blob_name])
+
+            print(f"EIA data for {today} fetched and staged successfully!")
         else:
             print("No data found in the EIA response.")
 
@@ -78,10 +67,21 @@ def get_and_save_energy_data():
         print(f"API Error: {e}")
 
 
-# Schedule the task to run every day at 11:58 PM
-schedule.every().day.at("23:58").do(get_and_save_energy_data)
+def schedule_jobs(scheduler=schedule.default_scheduler):
+    """
+    Schedules this script's jobs (the replay harness reads them from here too).
+    """
+    # Schedule the task to run every day at 11:58 PM
+    scheduler.every().day.at("23:58").do(get_and_save_energy_data)
+
+    # Push the staged data to cloud storage once it is due
+    scheduler.every().minute.do(flush)
+
+
+if __name__ == '__main__':
+    schedule_jobs()
 
-# Keep the script running to check for scheduled tasks
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+    # Keep the script running to check for scheduled tasks
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
\ No newline at end of file
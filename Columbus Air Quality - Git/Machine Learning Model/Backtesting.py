@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.callbacks import EarlyStopping
+
+import LSTM
+from Locations import active_locations
+from Preprocessing import Preprocessor
+from Training_Telemetry import RunLog
+
+# Where the master dataset is read from and where cached work is kept between runs
+MASTER_DATASET_PATH = f'/tmp/{LSTM.MASTER_DATASET_FILENAME}'
+CACHE_DIR = f'/tmp/aqi_backtest_cache_{LSTM.RESOLUTION}'
+
+# File names for the results
+RESULTS_FILENAME = 'backtest_results.csv'
+SUMMARY_FILENAME = 'backtest_summary.csv'
+
+
+def make_folds(n_rows, min_train_rows, step, horizon):
+    """
+    Lists the forecast origins for a rolling-origin (walk-forward) backtest.
+
+    Each origin is the index of the last row the fold is allowed to train on.
+    The fold then forecasts the `horizon` rows after it.
+    """
+    return list(range(min_train_rows - 1, n_rows - horizon, step))
+
+
+def dataset_fingerprint(df):
+    """
+    Hashes the dataset contents so cached work is thrown away when the data changes.
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=True).values
+    return hashlib.sha1(row_hashes.tobytes()).hexdigest()[:16]
+
+
+def build_window_cache(df, columns, lookback, fingerprint):
+    """
+    Saves every lookback window over the candidate features (plus the target) to disk once.
+
+    Workers memory-map the file and slice the columns and rows a fold needs,
+    so no fold has to rebuild its own windows.
+    """
+    path = os.path.join(CACHE_DIR, f'windows_{fingerprint}_{lookback}.npy')
+    if not os.path.exists(path):
+        windows = np.lib.stride_tricks.sliding_window_view(df[columns].values.astype(np.float32), lookback, axis=0)
+        temp_path = f'{path}.{os.getpid()}.tmp.npy'
+        np.save(temp_path, np.ascontiguousarray(windows.transpose(0, 2, 1)))
+        os.replace(temp_path, path)
+    return path
+
+
+def selection_cache_path(fingerprint, origin, n_features):
+    return os.path.join(CACHE_DIR, f'features_{fingerprint}_{origin}_{n_features}.json')
+
+
+def selection_origin(origin, folds, reselect_every):
+    """
+    Returns the origin whose feature selection a fold reuses.
+    """
+    position = folds.index(origin)
+    return folds[position - position % reselect_every]
+
+
+# Set once in each worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(master_dataset_path, windows_path, all_features, settings):
+    # One thread per worker, the parallelism comes from running folds side by side
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    df, _ = LSTM.load_master_dataset(master_dataset_path, settings['location'])
+    _worker_state.update({
+        'df': df,
+        'windows': np.load(windows_path, mmap_mode='r') if windows_path else None,
+        'all_features': all_features,
+        'settings': settings,
+    })
+
+
+def _run_selection(origin):
+    """
+    Runs the feature selection on everything up to `origin` and caches the result.
+    """
+    df = _worker_state['df']
+    settings = _worker_state['settings']
+    path = selection_cache_path(settings['fingerprint'], origin, settings['n_features'])
+    if not os.path.exists(path):
+        features = LSTM.select_features(df.iloc[:origin + 1], _worker_state['all_features'],
+                                        n_features_to_select=settings['n_features'])
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(features, f)
+        os.replace(temp_path, path)
+    return origin
+
+
+def _run_fold(origin, selected_at):
+    """
+    Trains the ensemble on one fold and forecasts the rows after its origin.
+    """
+    df = _worker_state['df']
+    windows = _worker_state['windows']
+    all_features = _worker_state['all_features']
+    settings = _worker_state['settings']
+    lookback = settings['lookback']
+    horizon = settings['horizon']
+
+    with open(selection_cache_path(settings['fingerprint'], selected_at, settings['n_features'])) as f:
+        features = json.load(f)
+    columns = features + [LSTM.TARGET]
+
+    # The cached windows hold every candidate column with the target last
+    column_index = [all_features.index(col) for col in features] + [len(all_features)]
+
+    # Window i covers rows i..i+lookback-1 and predicts row i+lookback, keep the ones that end by the origin
+    n_train = origin - lookback + 1
+    X = np.asarray(windows[:n_train][:, :, column_index], dtype=np.float32)
+    y = df[LSTM.TARGET].values[lookback:lookback + n_train].astype(np.float32)
+
+    # Scale with what the fold's training rows show, like the hourly job does
+    preprocessor = Preprocessor.fit(df.iloc[:origin + 1], columns)
+    X = preprocessor.transform(X).astype(np.float32)
+    y = preprocessor.transform_target(y).astype(np.float32)
+
+    # Hold out the last part of the fold for early stopping, like the hourly job does
+    split = int(len(X) * 0.8)
+    last_sequence = preprocessor.transform(df[columns].values[origin - lookback + 1:origin + 1])
+    lagged_index = columns.index('Lagged_MaxAQI') if 'Lagged_MaxAQI' in features else None
+
+    started = time.time()
+    run_log = RunLog(f'backtest_origin_{origin}', profile_steps=False)
+    member_predictions = []
+    hyperparameters = settings['hyperparameters']
+    for i in range(settings['n_models']):
+        # The same members the hourly job trains, with the tuned configuration if there is one
+        model = LSTM.build_member(hyperparameters, i, len(columns))
+        early_stop = EarlyStopping(monitor='val_loss', patience=settings['patience'])
+        model.fit(X[:split], y[:split], epochs=settings['epochs'], batch_size=hyperparameters['batch_size'],
+                  validation_data=(X[split:], y[split:]), callbacks=[early_stop, run_log.callback(i, split, early_stop)],
+                  verbose=0)
+        member_predictions.append(LSTM.forecast_recursive(model, last_sequence, horizon, lagged_index))
+
+    # Free the graphs before the worker takes the next fold
+    tf.keras.backend.clear_session()
+
+    actuals = df[LSTM.TARGET].values[origin + 1:origin + 1 + horizon].astype(float)
+    predictions = preprocessor.inverse_target(np.mean(member_predictions, axis=0))
+    return origin, predictions, actuals, time.time() - started
+
+
+def horizon_metrics(predictions, actuals):
+    """
+    Scores every forecast horizon at once.
+
+    `predictions` and `actuals` are (folds, horizons) arrays, NaN marks a missing observation.
+    """
+    errors = predictions - actuals
+    valid = ~np.isnan(errors)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mae = np.nansum(np.abs(errors), axis=0) / n
+        rmse = np.sqrt(np.nansum(errors ** 2, axis=0) / n)
+        bias = np.nansum(errors, axis=0) / n
+    return pd.DataFrame({
+        'horizon': np.arange(1, errors.shape[1] + 1),
+        'n_forecasts': n,
+        'MAE': mae,
+        'RMSE': rmse,
+        'Bias': bias,
+    })
+
+
+def run_backtest(master_dataset_path=MASTER_DATASET_PATH, min_train_rows=365, step=7, horizon=LSTM.FORECAST_STEPS,
+                 reselect_every=4, n_features=10, n_models=LSTM.N_MODELS, epochs=300, patience=25,
+                 max_workers=None, output_dir='.', location=None):
+    """
+    Runs a walk-forward backtest of the LSTM ensemble over one location of the master dataset.
+
+    The location defaults to the first active one. The members are built with
+    the settings the hourly job uses (LSTM.load_hyperparameters()), so the
+    scores describe the deployed ensemble.
+
+    Folds run in parallel worker processes. Feature selections are cached per
+    origin and reused for `reselect_every` folds in a row.
+
+    Returns the per-horizon summary table.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if not os.path.exists(master_dataset_path):
+        # Fetch the master dataset the same way the hourly job does
+        storage_client = LSTM.get_storage_client()
+        blob = storage_client.bucket(LSTM.master_dataset_bucket_name).blob(LSTM.MASTER_DATASET_FILENAME)
+        blob.download_to_filename(master_dataset_path)
+
+    location = location or active_locations()[0]['slug']
+    df, all_features = LSTM.load_master_dataset(master_dataset_path, location)
+    folds = make_folds(len(df), min_train_rows, step, horizon)
+    if not folds:
+        print(f"Not enough history for a backtest: {len(df)} rows, {min_train_rows} needed for the first fold.")
+        return None
+
+    fingerprint = dataset_fingerprint(df)
+    hyperparameters = LSTM.load_hyperparameters()
+    windows_path = build_window_cache(df, all_features + [LSTM.TARGET], hyperparameters['lookback'], fingerprint)
+    settings = {
+        'fingerprint': fingerprint,
+        'location': location,
+        'hyperparameters': hyperparameters,
+        'lookback': hyperparameters['lookback'],
+        'horizon': horizon,
+        'n_features': n_features,
+        'n_models': n_models,
+        'epochs': epochs,
+        'patience': patience,
+    }
+    print(f"Backtesting {location}: {len(folds)} folds from {df.index[folds[0]]} to {df.index[folds[-1]]}")
+
+    selected_at = {origin: selection_origin(origin, folds, reselect_every) for origin in folds}
+    missing_selections = sorted({origin for origin in selected_at.values()
+                                 if not os.path.exists(selection_cache_path(fingerprint, origin, n_features))})
+
+    started = time.time()
+    # TensorFlow does not survive a fork, so every worker starts a fresh interpreter
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                             initargs=(master_dataset_path, windows_path, all_features, settings)) as pool:
+        # Feature selections first, every fold needs its selection to be on disk
+        list(pool.map(_run_selection, missing_selections))
+        results = list(pool.map(_run_fold, folds, [selected_at[origin] for origin in folds]))
+
+    origins = np.array([result[0] for result in results])
+    predictions = np.vstack([result[1] for result in results])
+    actuals = np.vstack([result[2] for result in results])
+    fold_seconds = np.array([result[3] for result in results])
+
+    # One compact row per fold and horizon
+    n_folds = len(origins)
+    results_df = pd.DataFrame({
+        'origin': np.repeat(df.index[origins].strftime(LSTM.DATE_FORMAT), horizon),
+        'horizon': np.tile(np.arange(1, horizon + 1), n_folds).astype(np.int8),
+        'predicted': predictions.ravel().astype(np.float32),
+        'actual': actuals.ravel().astype(np.float32),
+    })
+    summary = horizon_metrics(predictions, actuals)
+
+    os.makedirs(output_dir, exist_ok=True)
+    results_df.to_csv(os.path.join(output_dir, RESULTS_FILENAME), index=False)
+    summary.to_csv(os.path.join(output_dir, SUMMARY_FILENAME), index=False)
+
+    print(summary.to_string(index=False))
+    print(f"{n_folds} folds finished in {time.time() - started:.0f}s "
+          f"({fold_seconds.sum():.0f}s of training spread over the workers)")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward backtest of the AQI forecast ensemble.')
+    parser.add_argument('--master-dataset', default=MASTER_DATASET_PATH,
+                        help='Local copy of the master dataset (downloaded if missing)')
+    parser.add_argument('--min-train-rows', type=int, default=365, help='Rows of history in the first fold')
+    parser.add_argument('--step', type=int, default=7, help='Rows between fold origins')
+    parser.add_argument('--horizon', type=int, default=LSTM.FORECAST_STEPS, help='Rows forecast per fold')
+    parser.add_argument('--reselect-every', type=int, default=4,
+                        help='Folds that share one feature selection')
+    parser.add_argument('--epochs', type=int, default=300)
+    parser.add_argument('--patience', type=int, default=25)
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (defaults to the CPU count)')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--location', default=None, help='Location slug to backtest (defaults to the first location)')
+    args = parser.parse_args()
+
+    run_backtest(args.master_dataset, min_train_rows=args.min_train_rows, step=args.step, horizon=args.horizon,
+                 reselect_every=args.reselect_every, epochs=args.epochs, patience=args.patience,
+                 max_workers=args.workers, output_dir=args.output_dir, location=args.location)
@@ -0,0 +1,207 @@
+import argparse
+import datetime
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Every forecast the hourly job issued, and the running skill of the ones whose day has been observed
+FORECAST_ARCHIVE_DB_PATH = os.environ.get('AQ_FORECAST_ARCHIVE_DB', '/tmp/aq_forecast_archive.sqlite')
+
+# Skill rows are kept for every location and engine, and for all of them together under this name
+ALL = '*'
+
+# First AQI of every category above Good (the same as LSTM.AQI_CATEGORY_THRESHOLDS)
+CATEGORY_THRESHOLDS = [51, 101, 151, 201, 301]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS forecasts (
+    location TEXT NOT NULL,
+    target_date TEXT NOT NULL,
+    issued_at TEXT NOT NULL,
+    horizon INTEGER NOT NULL,
+    engine TEXT NOT NULL,
+    predicted REAL NOT NULL,
+    observed REAL,
+    PRIMARY KEY (location, target_date, issued_at)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS forecasts_unscored ON forecasts (target_date) WHERE observed IS NULL;
+CREATE TABLE IF NOT EXISTS skill (
+    location TEXT NOT NULL,
+    engine TEXT NOT NULL,
+    horizon INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    sum_abs_error REAL NOT NULL,
+    sum_squared_error REAL NOT NULL,
+    sum_error REAL NOT NULL,
+    category_hits INTEGER NOT NULL,
+    PRIMARY KEY (location, engine, horizon)
+) WITHOUT ROWID;
+"""
+
+
+def connect(path=FORECAST_ARCHIVE_DB_PATH):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+@contextmanager
+def transaction(connection):
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def category_index(aqi):
+    """
+    Returns the AQI category of every value as 0 (Good) to 5 (Hazardous).
+    """
+    return np.searchsorted(CATEGORY_THRESHOLDS, np.asarray(aqi, dtype=float), side='right')
+
+
+def archive_forecast(predictions_df, step, last_dates, issued_at=None, path=FORECAST_ARCHIVE_DB_PATH):
+    """
+    Adds an issued forecast (the rows written to the forecast file) to the archive.
+
+    `last_dates` maps every location to the last date its forecast started
+    from, the horizon of a row is how many steps its date is past that.
+    """
+    issued_at = issued_at or datetime.datetime.now().isoformat(timespec='seconds')
+    dates = pd.to_datetime(predictions_df['Date'])
+    starts = pd.to_datetime(predictions_df['Location'].map(last_dates))
+    horizons = ((dates - starts) / step).round().astype(int)
+    rows = [(location, date.isoformat(), issued_at, int(horizon), engine, float(predicted))
+            for location, date, horizon, engine, predicted in zip(predictions_df['Location'], dates, horizons,
+                                                                  predictions_df['Engine'],
+                                                                  predictions_df['Predicted AQI'])]
+    with closing(connect(path)) as connection, transaction(connection):
+        connection.executemany('INSERT OR REPLACE INTO forecasts (location, target_date, issued_at, horizon, engine, '
+                               'predicted) VALUES (?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+def final_observations(df, target='MaxAQI'):
+    """
+    Returns (location, date, observed) of the master dataset rows that will not change any more.
+
+    A location's last row can still be a day in progress, so it waits until a later one arrives.
+    """
+    df = df[['Location', target]].dropna(subset=[target])
+    dates = pd.Series(df.index, index=df.index)
+    last_dates = dates.groupby(df['Location'].values).transform('max')
+    final = df[df.index.values < last_dates.values]
+    return pd.DataFrame({'location': final['Location'].values, 'target_date': final.index,
+                         'observed': final[target].astype(float).values})
+
+
+def score_observations(df, target='MaxAQI', path=FORECAST_ARCHIVE_DB_PATH):
+    """
+    Scores the archived forecasts whose day has been observed and folds them into the running skill.
+
+    Only forecasts not scored yet are looked at (through a partial index), and
+    the skill table keeps sums per location, engine and horizon, so the cost
+    follows the new observations rather than the size of the archive.
+    Returns the number of forecasts scored.
+    """
+    with closing(connect(path)) as connection, transaction(connection):
+        (oldest,) = connection.execute('SELECT MIN(target_date) FROM forecasts WHERE observed IS NULL').fetchone()
+        if oldest is None:
+            return 0
+
+        observations = final_observations(df, target)
+        observations = observations[observations['target_date'] >= pd.Timestamp(oldest)]
+        if observations.empty:
+            return 0
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS observations '
+                           '(location TEXT, target_date TEXT, observed REAL, PRIMARY KEY (location, target_date))')
+        connection.execute('DELETE FROM observations')
+        connection.executemany('INSERT OR REPLACE INTO observations VALUES (?, ?, ?)',
+                               [(location, date.isoformat(), observed) for location, date, observed in
+                                observations.itertuples(index=False)])
+
+        scored = pd.DataFrame(connection.execute(
+            'SELECT f.location, f.target_date, f.issued_at, f.engine, f.horizon, f.predicted, o.observed '
+            'FROM forecasts f JOIN observations o ON f.location = o.location AND f.target_date = o.target_date '
+            'WHERE f.observed IS NULL').fetchall(),
+            columns=['location', 'target_date', 'issued_at', 'engine', 'horizon', 'predicted', 'observed'])
+        if scored.empty:
+            return 0
+
+        error = scored['predicted'] - scored['observed']
+        scored['abs_error'] = error.abs()
+        scored['squared_error'] = error ** 2
+        scored['error'] = error
+        scored['category_hit'] = (category_index(scored['predicted']) == category_index(scored['observed'])).astype(int)
+
+        # Every forecast counts towards its own location and engine and towards the ALL rows
+        sums = []
+        for location_key in ['location', None]:
+            for engine_key in ['engine', None]:
+                keys = scored.assign(location=scored['location'] if location_key else ALL,
+                                     engine=scored['engine'] if engine_key else ALL)
+                sums.append(keys.groupby(['location', 'engine', 'horizon']).agg(
+                    n=('error', 'size'), sum_abs_error=('abs_error', 'sum'), sum_squared_error=('squared_error', 'sum'),
+                    sum_error=('error', 'sum'), category_hits=('category_hit', 'sum')).reset_index())
+        sums = pd.concat(sums, ignore_index=True)
+
+        connection.executemany(
+            'INSERT INTO skill VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (location, engine, horizon) DO UPDATE SET '
+            'n = n + excluded.n, sum_abs_error = sum_abs_error + excluded.sum_abs_error, '
+            'sum_squared_error = sum_squared_error + excluded.sum_squared_error, '
+            'sum_error = sum_error + excluded.sum_error, category_hits = category_hits + excluded.category_hits',
+            [(row.location, row.engine, int(row.horizon), int(row.n), float(row.sum_abs_error),
+              float(row.sum_squared_error), float(row.sum_error), int(row.category_hits))
+             for row in sums.itertuples(index=False)])
+        connection.executemany('UPDATE forecasts SET observed = ? WHERE location = ? AND target_date = ? '
+                               'AND issued_at = ?',
+                               list(zip(scored['observed'], scored['location'], scored['target_date'],
+                                        scored['issued_at'])))
+    return len(scored)
+
+
+def skill_metrics(row):
+    n, sum_abs_error, sum_squared_error, sum_error, category_hits = row
+    return {'n': n, 'mae': sum_abs_error / n, 'rmse': float(np.sqrt(sum_squared_error / n)), 'bias': sum_error / n,
+            'category_hit_rate': category_hits / n}
+
+
+def skill(horizon, location=ALL, engine=ALL, path=FORECAST_ARCHIVE_DB_PATH):
+    """
+    Returns the MAE, RMSE, bias (predicted minus observed) and category hit rate of the forecasts `horizon`
+    steps ahead, or None if none has been scored yet.
+    """
+    with closing(connect(path)) as connection:
+        row = connection.execute('SELECT n, sum_abs_error, sum_squared_error, sum_error, category_hits FROM skill '
+                                 'WHERE location = ? AND engine = ? AND horizon = ?',
+                                 (location, engine, horizon)).fetchone()
+    return skill_metrics(row) if row else None
+
+
+def skill_table(location=ALL, engine=ALL, path=FORECAST_ARCHIVE_DB_PATH):
+    """
+    Returns the skill of every horizon, one row per horizon.
+    """
+    with closing(connect(path)) as connection:
+        rows = connection.execute('SELECT horizon, n, sum_abs_error, sum_squared_error, sum_error, category_hits '
+                                  'FROM skill WHERE location = ? AND engine = ? ORDER BY horizon',
+                                  (location, engine)).fetchall()
+    return pd.DataFrame([{'horizon': row[0], **skill_metrics(row[1:])} for row in rows])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prints the skill of the archived forecasts by horizon.')
+    parser.add_argument('--location', default=ALL, help='Location slug, all locations by default')
+    parser.add_argument('--engine', default=ALL, help='Model engine, all engines by default')
+    args = parser.parse_args()
+
+    table = skill_table(args.location, args.engine)
+    print(table.round(3).to_string(index=False) if not table.empty else "No forecast has been scored yet")
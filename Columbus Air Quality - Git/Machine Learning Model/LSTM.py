@@ -6,217 +6,683 @@ from tensorflow.keras.layers import LSTM, Dense, Dropout
 from tensorflow.keras.callbacks import EarlyStopping
 from tensorflow.keras.regularizers import l2
 from sklearn.metrics import mean_squared_error
-from google.cloud import storage
 import os
+import json
 import matplotlib.pyplot as plt
-from sklearn.preprocessing import RobustScaler
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.feature_selection import RFE
 import schedule
 import datetime
 import time
 import gc
+import sys
+
+# The feature store and the shared helpers live in the other project folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data Manipulation'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+import AQI_Calculator
+import Feature_Store
+import Forecast_Archive
+from Dtype_Policy import read_csv_compact
+from Job_Runner import JobRunner
+from Model_Engines import GradientBoostingEngine, ModelEngine, split_by_date
+from Preprocessing import Preprocessor, encode_wind_dir
+from Training_Telemetry import RunLog
+from Locations import LEGACY_LOCATION
+from Storage import get_storage_client
 
 # Set your Google Cloud credentials path
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'XXXXXXXXXX'
 
-storage_client = storage.Client()
 master_dataset_bucket_name = 'master-aqi-bucket'
-master_dataset_bucket = storage_client.bucket(master_dataset_bucket_name)
 
 # Specify the forecast bucket name
 forecast_dataset_bucket_name = 'columbus-forecast-bucket'
-forecast_dataset_bucket = storage_client.bucket(forecast_dataset_bucket_name)
 
-
-def run_LSTM():
+# Resolution of the master dataset, 'daily' or 'hourly' (set the same way for Feature_Engineering.py)
+RESOLUTION = os.environ.get('AQ_RESOLUTION', 'daily')
+if RESOLUTION == 'hourly':
+    MASTER_DATASET_FILENAME = 'master_dataset_hourly.csv'
+    FORECAST_FILENAME = 'aqi_forecast_hourly.csv'
+    DATE_FORMAT = '%m/%d/%Y %H:%M'
+    STEP = pd.Timedelta(hours=1)
+else:
+    MASTER_DATASET_FILENAME = 'master_dataset.csv'
+    FORECAST_FILENAME = 'aqi_forecast.csv'
+    DATE_FORMAT = '%m/%d/%Y'
+    STEP = pd.Timedelta(days=1)
+
+# Initial set of features (the one-hot encoded wind directions are added to these). The per-pollutant
+# AQI columns are only there once pollutant concentrations have been collected.
+BASE_FEATURES = ['temperature', 'humidity', 'wind_speed', 'pressure', 'precip', 'visibility',
+                 'Canada', 'Central America', 'USA', 'Coal', 'Natural Gas', 'Other', 'Petroleum',
+                 'Lagged_MaxAQI', 'CongestionMinutes'] + Feature_Store.feature_names() + AQI_Calculator.feature_names()
+TARGET = 'MaxAQI'
+
+# Model settings shared by the hourly job and the backtests
+LOOKBACK = 4
+BATCH_SIZE = 32
+N_MODELS = 3
+FORECAST_DAYS = 3
+FORECAST_STEPS = int(pd.Timedelta(days=FORECAST_DAYS) / STEP)
+
+# Warm start: the saved ensemble is fine-tuned on new days instead of being rebuilt every hour
+MODEL_DIR = os.environ.get('AQ_MODEL_DIR', f'/tmp/aqi_models_{RESOLUTION}')
+FULL_RETRAIN_EVERY_DAYS = 7
+FINE_TUNE_EPOCHS = 10
+REPLAY_RATIO = 3  # Older days replayed per new day, so the models do not forget the rest of the history
+VAL_LOSS_TOLERANCE = 1.5  # Retrain from scratch if the loss on new days grows past this multiple of the baseline
+
+# Ensemble settings. Member i has units + i * units_step units. The best configuration Tuning.py
+# saved in TUNING_DIR replaces them on the next full retrain.
+HYPERPARAMETERS = {
+    'units': 50,
+    'units_step': 10,
+    'layers': 5,
+    'dropout': 0.2,
+    'l2': 0.01,
+    'learning_rate': 0.001,
+    'lookback': LOOKBACK,
+    'batch_size': BATCH_SIZE,
+}
+TUNING_DIR = os.environ.get('AQ_TUNING_DIR', f'{MODEL_DIR}_tuning')
+BEST_CONFIG_FILENAME = 'best_config.json'
+
+# Model behind the forecast: 'lstm', 'gbm' (gradient boosting, trains in seconds) or 'best' to train
+# both and keep the one with the lower error on the most recent dates
+MODEL_ENGINE = os.environ.get('AQ_MODEL_ENGINE', 'lstm')
+
+# 'probabilistic' adds quantiles and the chance of reaching every AQI category to the forecast
+# (Monte Carlo dropout), 'point' only writes the ensemble mean
+FORECAST_MODE = os.environ.get('AQ_FORECAST_MODE', 'probabilistic')
+MC_SAMPLES = 100  # Stochastic passes per ensemble member
+FORECAST_QUANTILES = [0.1, 0.5, 0.9]
+
+# First AQI of every category above Good
+AQI_CATEGORY_THRESHOLDS = {
+    'Moderate': 51,
+    'Unhealthy for Sensitive Groups': 101,
+    'Unhealthy': 151,
+    'Very Unhealthy': 201,
+    'Hazardous': 301,
+}
+
+
+def load_master_dataset(file_path, location=None):
+    """
+    Loads the master dataset and gets it ready for training.
+
+    Rows are sorted by location and date. Pass a location slug to only keep
+    that location's rows. With more than one location, a one-hot column per
+    location is added so a single model can tell them apart.
+
+    Returns the prepared table and the list of candidate feature columns.
+    """
+    df = read_csv_compact(file_path, 'master dataset')
+
+    # Master datasets built before locations existed only cover the legacy location
+    if 'Location' not in df.columns:
+        df['Location'] = LEGACY_LOCATION
+    df['Location'] = df['Location'].astype(str)
+    if location is not None:
+        df = df[df['Location'] == location]
+
+    # Set 'Date' as the index and convert to datetime
+    df['Date'] = pd.to_datetime(df['Date'], format=DATE_FORMAT)
+    df = df.sort_values(['Location', 'Date'], kind='stable')
+    df.set_index('Date', inplace=True)
+
+    # One-hot encode 'wind_dir' on the fixed compass, so training and forecasting always get the same columns
+    df, all_wind_dir_columns = encode_wind_dir(df)
+
+    # Handle missing values using ffill within each location
+    value_columns = [col for col in df.columns if col != 'Location']
+    df[value_columns] = df.groupby('Location')[value_columns].ffill()
+
+    location_columns = []
+    if df['Location'].nunique() > 1:
+        location_dummies = pd.get_dummies(df['Location'], prefix='location', dtype=np.int8)
+        df = pd.concat([df, location_dummies], axis=1)
+        location_columns = list(location_dummies.columns)
+
+    all_features = [col for col in BASE_FEATURES if col in df.columns] + all_wind_dir_columns + location_columns
+    return df, all_features
+
+
+def location_columns(features):
+    return [col for col in features if col.startswith('location_')]
+
+
+def select_features(df, all_features, n_features_to_select=10, n_iterations=5):
+    """
+    Picks the most useful features with RFE on a Random Forest.
+
+    RFE is run several times with different seeds and the features chosen
+    most often are kept, so one unlucky forest does not decide the inputs.
+    The location columns are always kept on top of the selection.
+    """
+    locations = location_columns(all_features)
+    all_features = [col for col in all_features if col not in locations]
+    votes = pd.Series(0, index=all_features)
+    for iteration in range(n_iterations):
+        estimator = RandomForestRegressor(n_estimators=100, random_state=iteration + 1)
+        selector = RFE(estimator, n_features_to_select=n_features_to_select, step=1)
+        selector = selector.fit(df[all_features], df[TARGET].values.ravel())
+
+        # Get the selected features and their rankings
+        selected_features = df[all_features].columns[selector.support_]
+        votes[selected_features] += 1
+
+        print("Selected Features:", list(selected_features))
+        print("Feature Rankings:", selector.ranking_)
+
+    # Keep the features picked most often (ties keep the original column order)
+    ranked = votes.sort_values(ascending=False, kind='stable')
+    return [col for col in all_features if col in ranked.index[:n_features_to_select]] + locations
+
+
+def create_sequences(dataset, lookback):
+    """
+    Cuts the dataset into overlapping windows of `lookback` rows.
+
+    The target is the last column of the row right after each window.
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(dataset, lookback, axis=0)
+    n_sequences = max(len(dataset) - lookback - 1, 0)
+
+    # sliding_window_view puts the window on the last axis, move it in front of the columns
+    X = windows[:n_sequences].transpose(0, 2, 1)
+    y = dataset[lookback:lookback + n_sequences, -1]
+    return np.ascontiguousarray(X), np.array(y)
+
+
+def location_sequences(df, columns, lookback):
+    """
+    Cuts the windows location by location, so no window runs from one location into the next.
+
+    Returns the stacked windows and targets, plus the location and date of each target row.
+    """
+    X_parts, y_parts, locations, dates = [], [], [], []
+    for slug, rows in df.groupby('Location', sort=False):
+        X, y = create_sequences(rows[columns].values.astype(np.float32), lookback)
+        X_parts.append(X)
+        y_parts.append(y)
+        locations.append(np.full(len(y), slug, dtype=object))
+        dates.append(rows.index[lookback:lookback + len(y)])
+
+    return (np.concatenate(X_parts), np.concatenate(y_parts), np.concatenate(locations),
+            pd.DatetimeIndex(np.concatenate(dates)))
+
+
+def last_sequences(df, columns, lookback):
+    """
+    Returns the most recent window of every location, its slug and its last date.
+    """
+    groups = list(df.groupby('Location', sort=False))
+    sequences = np.stack([rows[columns].values.astype(float)[-lookback:] for _, rows in groups])
+    return sequences, [slug for slug, _ in groups], [rows.index[-1] for _, rows in groups]
+
+
+def build_model(units, lookback, n_features, batch_size=BATCH_SIZE, layers=5, dropout=0.2, l2_strength=0.01,
+                learning_rate=0.001):
+    """
+    Builds one member of the LSTM ensemble: `layers` stacked LSTM layers with dropout between them.
+    """
+    model = Sequential()
+    for _ in range(layers - 1):
+        model.add(LSTM(units, return_sequences=True, kernel_regularizer=l2(l2_strength)))
+        model.add(Dropout(dropout))
+    model.add(LSTM(units, kernel_regularizer=l2(l2_strength)))
+    model.add(Dense(1))
+
+    # Model Optimizer
+    model.compile(loss='mean_squared_error', optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate))
+
+    model.build(input_shape=(batch_size, lookback, n_features))
+    return model
+
+
+def forecast_recursive(model, last_sequence, n_steps, lagged_index=None, training=False):
+    """
+    Predicts `n_steps` ahead by feeding each prediction back in as the next target value.
+
+    The other features are carried forward from the last known row. If the
+    lagged AQI is one of the inputs, it is moved along with the predictions.
+
+    `last_sequence` is one window, or a (locations, lookback, features) batch
+    that is forecast in one pass per step. With `training` the dropout layers
+    stay on, so every row of the batch follows its own random path.
+    """
+    sequences = np.array(last_sequence, dtype=float)
+    single = sequences.ndim == 2
+    if single:
+        sequences = sequences[np.newaxis]
+
+    predictions = np.empty((len(sequences), n_steps))
+    for step in range(n_steps):
+        if training:
+            next_pred = model(sequences.astype(np.float32), training=True).numpy()[:, 0]
+        else:
+            next_pred = model.predict(sequences, verbose=0)[:, 0]
+        predictions[:, step] = next_pred
+
+        # Update the last sequences for the next prediction
+        next_rows = sequences[:, -1].copy()
+        if lagged_index is not None:
+            next_rows[:, lagged_index] = sequences[:, -1, -1]
+        next_rows[:, -1] = next_pred
+        sequences = np.concatenate([sequences[:, 1:], next_rows[:, np.newaxis]], axis=1)
+
+    return predictions[0] if single else predictions
+
+
+def forecast_samples(models, last_sequences, n_steps, lagged_index=None, n_samples=MC_SAMPLES):
+    """
+    Samples the forecast of every location with Monte Carlo dropout.
+
+    Each location's window is repeated `n_samples` times and every member
+    forecasts the whole stack as one batch per step, so the cost is one call
+    per member and step whatever the number of samples.
+
+    Returns an array of (locations, members * samples, steps).
+    """
+    n_locations = len(last_sequences)
+    repeated = np.repeat(np.asarray(last_sequences, dtype=np.float32), n_samples, axis=0)
+    samples = [forecast_recursive(model, repeated, n_steps, lagged_index, training=True)
+               .reshape(n_locations, n_samples, n_steps) for model in models]
+    return np.concatenate(samples, axis=1)
+
+
+def forecast_distribution(samples):
+    """
+    Summarizes forecast samples into quantile and AQI category columns, one value per location and step.
+    """
+    columns = {}
+    for q, values in zip(FORECAST_QUANTILES, np.quantile(samples, FORECAST_QUANTILES, axis=1)):
+        columns[f'AQI p{round(q * 100)}'] = values.reshape(-1)
+    for category, threshold in AQI_CATEGORY_THRESHOLDS.items():
+        columns[f'P({category} or worse)'] = (samples >= threshold).mean(axis=1).reshape(-1)
+    return columns
+
+
+def load_hyperparameters(tuning_dir=TUNING_DIR):
+    """
+    Returns the ensemble settings, with the values of the best tuned configuration if there is one.
+    """
+    hyperparameters = dict(HYPERPARAMETERS)
     try:
-        # 1. Load and preprocess the data
-        blob = master_dataset_bucket.blob('master_dataset.csv')
-        blob.download_to_filename('/tmp/master_dataset.csv')
-        df = pd.read_csv('/tmp/master_dataset.csv')
-
-        # Set 'Date' as the index and convert to datetime
-        df['Date'] = pd.to_datetime(df['Date'], format='%m/%d/%Y')
-        df.set_index('Date', inplace=True)
-
-        # One-hot encode 'wind_dir' on the training data
-        df = pd.get_dummies(df, columns=['wind_dir'], prefix='wind_dir')
-
-        # Get the list of all one-hot encoded wind direction columns from the training data
-        all_wind_dir_columns = [col for col in df.columns if col.startswith('wind_dir_')]
-
-        # Initial set of features
-        all_features = ['temperature', 'humidity', 'wind_speed', 'pressure', 'precip', 'visibility',
-                        'Canada', 'Central America', 'USA', 'Coal', 'Natural Gas', 'Other', 'Petroleum',
-                        'Lagged_MaxAQI'] + \
-                       all_wind_dir_columns
-
-        target = ['MaxAQI']
-
-        # Fill NaN values in the one-hot encoded wind direction columns with 0s
-        df[all_wind_dir_columns] = df[all_wind_dir_columns].fillna(0)
-
-        # Handle missing values using ffill for the main DataFrame
-        df.ffill(inplace=True)
-
-        # Feature Selection using RFE with Random Forest (with loop for stability check)
-        n_iterations = 5  # Number of times to run RFE
-        selected_features_list = []
-        random_state_seed = 1
-        for _ in range(n_iterations):
-            estimator = RandomForestRegressor(n_estimators=100, random_state=random_state_seed)
-            selector = RFE(estimator, n_features_to_select=10, step=1)
-            selector = selector.fit(df[all_features], df[target].values.ravel())
-
-            # Get the selected features and their rankings
-            selected_features = df[all_features].columns[selector.support_]
-            feature_rankings = selector.ranking_
-
-            selected_features_list.append(selected_features)
-
-            print("Selected Features:", selected_features)
-            print("Feature Rankings:", feature_rankings)
-
-            # 2. Prepare sequences for LSTM
-        features = selected_features_list
-
-        def create_sequences(dataset, lookback):
-            X, y = [], []
-            for i in range(len(dataset) - lookback - 1):
-                X.append(dataset[i:(i + lookback), :])
-                y.append(dataset[i + lookback, -1])
-
-            return np.array(X), np.array(y)
-
-        lookback = 4
-        X, y = create_sequences(df[features].values, lookback)
-
-        # Split into training and testing sets
-        train_size = int(len(X) * 0.8)
-        X_train, X_test = X[:train_size], X[train_size:]
-        y_train, y_test = y[:train_size], y[train_size:]
-
-        # 3. Build and train multiple LSTM models (Ensemble)
-        n_models = 3
-        ensemble_predictions = []
-        batch_size = 32
-        histories = []
-        for i in range(n_models):
-            model = Sequential()
-            model.add(LSTM(50 + i * 10, return_sequences=True, kernel_regularizer=l2(0.01)))
-            model.add(Dropout(0.2))
-            model.add(LSTM(50 + i * 10, return_sequences=True, kernel_regularizer=l2(0.01)))
-            model.add(Dropout(0.2))
-            model.add(LSTM(50 + i * 10, return_sequences=True, kernel_regularizer=l2(0.01)))
-            model.add(Dropout(0.2))
-            model.add(LSTM(50 + i * 10, return_sequences=True, kernel_regularizer=l2(0.01)))
-            model.add(Dropout(0.2))
-            model.add(LSTM(50 + i * 10, kernel_regularizer=l2(0.01)))
-            model.add(Dense(1))
-
-            # Model Optimizer
-            model.compile(loss='mean_squared_error', optimizer=tf.keras.optimizers.Adam())
-
-            model.build(input_shape=(batch_size, lookback, len(features)))
-
-            # Add early stopping
-            early_stop = EarlyStopping(monitor='val_loss', patience=25)
-
-            history = model.fit(X_train, y_train, epochs=300, batch_size=32, validation_data=(X_test, y_test),
-                                callbacks=[early_stop])
-            histories.append(history)
-            # 5. Make predictions for the next 3 days (for each model)
-
-            # Prepare the input data
-
-            # Re-download the master dataset to get the latest data
-            blob = master_dataset_bucket.blob('master_dataset.csv')
-            blob.download_to_filename('/tmp/latest_master_dataset.csv')
-
-            # Load the latest data
-            latest_data = pd.read_csv('/tmp/latest_master_dataset.csv')
+        with open(os.path.join(tuning_dir, BEST_CONFIG_FILENAME)) as f:
+            best = json.load(f)
+    except FileNotFoundError:
+        return hyperparameters
+    except (OSError, ValueError) as e:
+        print(f"Could not read the tuned configuration, using the defaults: {e}")
+        return hyperparameters
+    hyperparameters.update({key: value for key, value in best.items() if key in HYPERPARAMETERS})
+    return hyperparameters
+
+
+def build_member(hyperparameters, i, n_features):
+    """
+    Builds member `i` of the ensemble with the given settings.
+    """
+    hp = hyperparameters
+    return build_model(hp['units'] + i * hp['units_step'], hp['lookback'], n_features, hp['batch_size'],
+                       hp['layers'], hp['dropout'], hp['l2'], hp['learning_rate'])
+
+
+def train_ensemble(X_train, y_train, X_test, y_test, hyperparameters=HYPERPARAMETERS):
+    """
+    Trains every member of the ensemble from random initialization.
+    """
+    run_log = RunLog('full_retrain')
+    models = []
+    histories = []
+    for i in range(N_MODELS):
+        model = build_member(hyperparameters, i, X_train.shape[2])
+
+        # Add early stopping
+        early_stop = EarlyStopping(monitor='val_loss', patience=25)
+
+        history = model.fit(X_train, y_train, epochs=300, batch_size=hyperparameters['batch_size'],
+                            validation_data=(X_test, y_test),
+                            callbacks=[early_stop, run_log.callback(i, len(X_train), early_stop)])
+        models.append(model)
+        histories.append(history)
+
+    # Saved next to the run's telemetry log, the workers have no display to show it on
+    plot_histories(histories, f"{os.path.splitext(run_log.path)[0]}_loss.png")
+    return models, histories
+
+
+def fine_tune_ensemble(models, X, y, new_windows, seed=None, batch_size=BATCH_SIZE):
+    """
+    Continues training the saved ensemble on the new windows plus a replay sample of older ones.
+
+    The replay sample is a fixed multiple of the new windows, so the cost of an
+    update grows with the amount of new data and not with the whole history.
+    """
+    rng = np.random.default_rng(seed)
+    new_index = np.flatnonzero(new_windows)
+    old_index = np.flatnonzero(~new_windows)
+    n_replay = min(len(old_index), max(REPLAY_RATIO * len(new_index), batch_size))
+    index = np.concatenate([rng.choice(old_index, n_replay, replace=False), new_index])
+
+    run_log = RunLog('fine_tune')
+    for i, model in enumerate(models):
+        model.fit(X[index], y[index], epochs=FINE_TUNE_EPOCHS, batch_size=batch_size, shuffle=True, verbose=0,
+                  callbacks=[run_log.callback(i, len(index))])
+
+
+def save_ensemble(models, state, model_dir=MODEL_DIR):
+    """
+    Saves the ensemble (weights and optimizer state) and what it was trained on.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    for i, model in enumerate(models):
+        model.save(os.path.join(model_dir, f'member_{i}.keras'))
+    with open(os.path.join(model_dir, 'training_state.json'), 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def load_ensemble(model_dir=MODEL_DIR):
+    """
+    Loads the ensemble saved by the last run, or returns (None, None) if there is none.
+    """
+    state_path = os.path.join(model_dir, 'training_state.json')
+    if not os.path.exists(state_path):
+        return None, None
 
-            # Preprocess the latest data
-            latest_data['Date'] = pd.to_datetime(latest_data['Date'], format='%m/%d/%Y')
-            latest_data.set_index('Date', inplace=True)
-
-            # One-hot encode 'wind_dir' on the LATEST data
-            latest_data = pd.get_dummies(latest_data, columns=['wind_dir'], prefix='wind_dir')
-
-            # Align the columns
-            for col in all_wind_dir_columns:
-                if col not in latest_data.columns:
-                    latest_data[col] = 0
-            latest_data = latest_data[
-                all_wind_dir_columns + [col for col in features if col not in all_wind_dir_columns]]
-
-            # Fill missing values using ffill()
-            latest_data.ffill(inplace=True)
-
-            # After applying ffill to the latest_data
-            pd.set_option('display.max_columns', None)
-            print(latest_data.tail(3))
-
-            # Create sequences for prediction
-            last_sequence = latest_data[features].values[-lookback:]
-
-            prediction_sequences = []
-            for i in range(3):
-                next_pred = model.predict(last_sequence.reshape(1, lookback, len(features)))
-                prediction_sequences.append(next_pred[0, 0])
-
-                next_pred_reshaped = next_pred.reshape(-1)
-
-                # Update the last sequence for the next prediction
-                last_sequence = np.vstack([last_sequence[1:], np.hstack([next_pred_reshaped, last_sequence[-1, 1:]])])
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        models = [tf.keras.models.load_model(os.path.join(model_dir, f'member_{i}.keras'))
+                  for i in range(state['n_models'])]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not load the saved ensemble: {e}")
+        return None, None
+
+    return models, state
+
+
+def needs_full_retrain(state, all_features):
+    """
+    Decides whether the ensemble has to be trained from scratch.
+
+    Returns the decision and the reason for it.
+    """
+    if state is None:
+        return True, "no saved ensemble"
+    missing = [col for col in state['features'] if col not in all_features]
+    if missing:
+        return True, f"features {missing} are no longer in the master dataset"
+    if location_columns(state['features']) != location_columns(all_features):
+        return True, "the locations in the master dataset changed"
+    if 'preprocessing' not in state:
+        return True, "the saved ensemble was trained on unscaled features"
+    if state.get('hyperparameters', HYPERPARAMETERS) != load_hyperparameters():
+        return True, "the ensemble settings changed (a new tuned configuration)"
+    days_since_full = (datetime.date.today() - datetime.date.fromisoformat(state['last_full_train'])).days
+    if days_since_full >= FULL_RETRAIN_EVERY_DAYS:
+        return True, f"last full retrain was {days_since_full} days ago"
+    return False, None
+
+
+class LSTMEngine(ModelEngine):
+    """
+    The LSTM ensemble, warm started between runs.
+
+    A full retrain picks the features with RFE and trains every member from
+    scratch. Otherwise the saved ensemble is fine-tuned on the new days, unless
+    needs_full_retrain or the loss on those days says it has gone stale.
+    """
+    name = 'lstm'
+
+    def __init__(self, model_dir, n_steps, step_size):
+        super().__init__(model_dir, n_steps, step_size)
+        self.models = None
+        self.preprocessor = None
+
+    def fit(self, df, all_features):
+        # Reuse the previous ensemble when it is still fresh, otherwise start over
+        models, state = load_ensemble(self.model_dir)
+        full_retrain, reason = needs_full_retrain(state, all_features)
+        features = state['features'] if not full_retrain else None
+
+        if not full_retrain:
+            columns = features + [TARGET]
+            hyperparameters = state.get('hyperparameters', HYPERPARAMETERS)
+            preprocessor = Preprocessor.from_dict(state['preprocessing'])
+            X, y, _, target_dates = location_sequences(preprocessor.transform_frame(df), columns,
+                                                       hyperparameters['lookback'])
+            new_windows = target_dates > pd.Timestamp(state['last_trained_date'])
+
+            # Score the old ensemble on the days it has not seen yet before learning from them
+            if new_windows.any():
+                new_loss = np.mean([model.evaluate(X[new_windows], y[new_windows], verbose=0) for model in models])
+                if new_loss > state['baseline_val_loss'] * VAL_LOSS_TOLERANCE:
+                    full_retrain = True
+                    reason = f"loss on new data {new_loss:.1f} is above the baseline {state['baseline_val_loss']:.1f}"
+
+        if full_retrain:
+            print(f"Full retrain: {reason}")
+
+            # Feature Selection using RFE with Random Forest (with loop for stability check)
+            features = select_features(df, all_features)
+
+            # 2. Prepare sequences for LSTM (the target goes last so the windows can find it), scaled with
+            # what the training dates show
+            columns = features + [TARGET]
+            hyperparameters = load_hyperparameters()
+            preprocessor = Preprocessor.fit(df[split_by_date(df.index)], columns)
+            X, y, window_locations, target_dates = location_sequences(preprocessor.transform_frame(df), columns,
+                                                                      hyperparameters['lookback'])
+
+            # Split into training and testing sets by date, so every location is tested on the same days
+            train = split_by_date(target_dates)
+            X_train, X_test = X[train], X[~train]
+            y_train, y_test = y[train], y[~train]
+
+            # 3. Build and train multiple LSTM models (Ensemble)
+            models, _ = train_ensemble(X_train, y_train, X_test, y_test, hyperparameters)
+            state = {
+                'features': features,
+                'n_models': len(models),
+                'last_full_train': datetime.date.today().isoformat(),
+                'baseline_val_loss': float(np.mean([model.evaluate(X_test, y_test, verbose=0) for model in models])),
+                'preprocessing': preprocessor.to_dict(),
+                'hyperparameters': hyperparameters,
+            }
+        elif new_windows.any():
+            print(f"Fine-tuning the ensemble on {new_windows.sum()} new windows")
+            fine_tune_ensemble(models, X, y, new_windows, batch_size=hyperparameters['batch_size'])
+        else:
+            print("No new days since the last update, reusing the saved ensemble")
+
+        if full_retrain:
+            # Score the ensemble mean on the held out windows, back on the AQI scale
+            test_predictions = preprocessor.inverse_target(
+                np.mean([model.predict(X_test, verbose=0)[:, 0] for model in models], axis=0))
+            y_test = preprocessor.inverse_target(y_test)
+            mse_original_scale = mean_squared_error(y_test, test_predictions)
+            print("Test MSE:", mse_original_scale)
+            print("Test RMSE:", np.sqrt(mse_original_scale))
+            squared_errors = pd.Series((test_predictions - y_test) ** 2, index=window_locations[~train])
+            print("Test RMSE per location:", np.sqrt(squared_errors.groupby(level=0).mean()).round(2).to_dict())
+
+            # Kept until the next full retrain, fine-tuning is not scored on held out days
+            state['test_rmse'] = float(np.sqrt(mse_original_scale))
+
+        self.models, self.state, self.preprocessor = models, state, preprocessor
+        if full_retrain or new_windows.any():
+            state['last_trained_date'] = target_dates.max().strftime('%Y-%m-%d')
+            self.save()
+
+    def last_sequences(self, df):
+        columns = self.state['features'] + [TARGET]
+
+        # The most recent rows of every location are the starting point of the forecast
+        pd.set_option('display.max_columns', None)
+        print(df[columns].tail(3))
+        lookback = self.state.get('hyperparameters', HYPERPARAMETERS)['lookback']
+        sequences, slugs, last_dates = last_sequences(self.preprocessor.transform_frame(df), columns, lookback)
+        lagged_index = columns.index('Lagged_MaxAQI') if 'Lagged_MaxAQI' in self.state['features'] else None
+        return sequences, slugs, last_dates, lagged_index
+
+    def predict_horizon(self, df):
+        sequences, slugs, last_dates, lagged_index = self.last_sequences(df)
+
+        # Predict for each model, all locations at once, and average the predictions from all models
+        ensemble_predictions = [forecast_recursive(model, sequences, self.n_steps, lagged_index)
+                                for model in self.models]
+        return self.preprocessor.inverse_target(np.mean(ensemble_predictions, axis=0)), slugs, last_dates
+
+    def predict_samples(self, df):
+        sequences, _, _, lagged_index = self.last_sequences(df)
+        return self.preprocessor.inverse_target(forecast_samples(self.models, sequences, self.n_steps, lagged_index))
+
+    def save(self):
+        save_ensemble(self.models, self.state, self.model_dir)
+
+    def load(self):
+        self.models, self.state = load_ensemble(self.model_dir)
+        if self.state and 'preprocessing' in self.state:
+            self.preprocessor = Preprocessor.from_dict(self.state['preprocessing'])
+        return self.models is not None and self.preprocessor is not None
+
+
+# Engines the job can run, chosen per deployment with AQ_MODEL_ENGINE
+ENGINES = {
+    'lstm': LSTMEngine,
+    'gbm': GradientBoostingEngine,
+}
+
+
+def engine_model_dir(name):
+    # The LSTM keeps the folder it always used, so its saved ensemble is still picked up
+    return MODEL_DIR if name == 'lstm' else f'{MODEL_DIR}_{name}'
+
+
+def plot_histories(histories, path):
+    """
+    Plots the average training and validation loss of the ensemble to the image file `path`.
+    """
+    # Members stop at different epochs, so pad with NaN
+    n_epochs = max(len(h.history['loss']) for h in histories)
+    train_losses = np.full((len(histories), n_epochs), np.nan)
+    val_losses = np.full((len(histories), n_epochs), np.nan)
+    for i, h in enumerate(histories):
+        train_losses[i, :len(h.history['loss'])] = h.history['loss']
+        val_losses[i, :len(h.history['val_loss'])] = h.history['val_loss']
+    avg_train_loss = np.nanmean(train_losses, axis=0)
+    avg_val_loss = np.nanmean(val_losses, axis=0)
+
+    fig, ax = plt.subplots()
+    ax.plot(avg_train_loss)
+    ax.plot(avg_val_loss)
+    ax.set_title('Average Ensemble Model Loss')
+    ax.set_ylabel('Loss')
+    ax.set_xlabel('Epoch')
+    ax.legend(['Train', 'Validation'], loc='upper right')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fig.savefig(path)
+    # Figures stay open (and in memory) until closed
+    plt.close(fig)
+    print(f"Saved the ensemble loss plot to {path}")
 
-            predictions = np.array(prediction_sequences)
 
-            ensemble_predictions.append(predictions)
+def run_LSTM():
+    try:
+        storage_client = get_storage_client()
+        master_dataset_bucket = storage_client.bucket(master_dataset_bucket_name)
+        forecast_dataset_bucket = storage_client.bucket(forecast_dataset_bucket_name)
 
-        # Average the predictions from all models
-        final_predictions = np.mean(ensemble_predictions, axis=0)
+        # 1. Load and preprocess the data
+        blob = master_dataset_bucket.blob(MASTER_DATASET_FILENAME)
+        blob.download_to_filename(f'/tmp/{MASTER_DATASET_FILENAME}')
+        df, all_features = load_master_dataset(f'/tmp/{MASTER_DATASET_FILENAME}')
+
+        # Score the archived forecasts of the days observed since the last run
+        try:
+            scored = Forecast_Archive.score_observations(df, TARGET)
+            if scored:
+                print(f"Scored {scored} archived forecasts")
+        except Exception as e:
+            print(f"Error scoring the archived forecasts: {e}")
+
+        # Train the chosen engine, or every engine when the best one is kept
+        engines = []
+        for name in (list(ENGINES) if MODEL_ENGINE == 'best' else [MODEL_ENGINE]):
+            engine = ENGINES[name](engine_model_dir(name), FORECAST_STEPS, STEP)
+            started = time.time()
+            try:
+                engine.fit(df, all_features)
+            except Exception as e:
+                # With more than one engine the others can still forecast
+                print(f"Error training {name}: {e}")
+                continue
+            print(f"{name} trained in {time.time() - started:.1f}s, test RMSE on recent dates: {engine.test_rmse}")
+            engines.append(engine)
+
+        if not engines:
+            raise RuntimeError("No model engine could be trained, no forecast was made")
+
+        # Forecast with the engine that did best on the recent dates (unscored engines go last)
+        engine = min(engines, key=lambda e: e.test_rmse if e.test_rmse is not None else np.inf)
+        if len(engines) > 1:
+            print(f"Forecasting with {engine.name}")
+
+        # 5. Make predictions for the next 3 days
+        final_predictions, slugs, last_dates = engine.predict_horizon(df)
+
+        # Create a DataFrame for predictions, each location's dates start after its own last row
+        predictions_df = pd.concat([
+            pd.DataFrame({'Location': slug,
+                          'Date': pd.date_range(start=last_date + STEP, periods=FORECAST_STEPS, freq=STEP),
+                          'Predicted AQI': location_predictions})
+            for slug, last_date, location_predictions in zip(slugs, last_dates, final_predictions)
+        ], ignore_index=True)
+
+        samples = engine.predict_samples(df) if FORECAST_MODE == 'probabilistic' else None
+        if samples is not None:
+            # Rows are in location then date order, the same as the flattened (locations, steps) summaries
+            for column, values in forecast_distribution(samples).items():
+                predictions_df[column] = np.round(values, 3)
+        predictions_df['Engine'] = engine.name
 
         # Print the predictions
-        future_dates = pd.date_range(start=df.index[-1] + pd.Timedelta(days=1), periods=3)
-        for date, pred in zip(future_dates, final_predictions):
-            print(f'Predicted AQI for {date.strftime("%m/%d/%Y")}: {pred}')
+        for slug, date, pred in zip(predictions_df['Location'], predictions_df['Date'], predictions_df['Predicted AQI']):
+            print(f'Predicted AQI for {slug} on {date.strftime(DATE_FORMAT)}: {pred}')
 
-        # Create a DataFrame for predictions
-        predictions_df = pd.DataFrame({'Date': future_dates, 'Predicted AQI': final_predictions})
-
-        blob = forecast_dataset_bucket.blob('aqi_forecast.csv')
+        blob = forecast_dataset_bucket.blob(FORECAST_FILENAME)
         blob.upload_from_string(predictions_df.to_csv(index=False), content_type='text/csv')
-        print("Predictions saved to aqi_forecast.csv in columbus-forecast-bucket")
-
-        # Plot training & validation loss values
-        avg_train_loss = np.mean([h.history['loss'] for h in histories], axis=0)
-        avg_val_loss = np.mean([h.history['val_loss'] for h in histories], axis=0)
+        print(f"Predictions saved to {FORECAST_FILENAME} in {forecast_dataset_bucket_name}")
 
-        plt.plot(avg_train_loss)
-        plt.plot(avg_val_loss)
-        plt.title('Average Ensemble Model Loss')
-        plt.ylabel('Loss')
-        plt.xlabel('Epoch')
-        plt.legend(['Train', 'Validation'], loc='upper right')
-        plt.show()
-
-        # Print predictions
-        print("Predictions:", final_predictions)
-
-        mse_original_scale = mean_squared_error(y_test[-3:], final_predictions)
-        print("MSE:", mse_original_scale)
-        print("RMSE:", np.sqrt(mse_original_scale))
+        # Keep every issued forecast, the file above only holds the latest
+        try:
+            Forecast_Archive.archive_forecast(predictions_df, STEP, dict(zip(slugs, last_dates)))
+        except Exception as e:
+            print(f"Error archiving the forecast: {e}")
 
     except Exception as e:
         print(f"An error occurred: {e}")
+        # The runner and the pipeline have to see the run failed, so it is retried
+        raise
+
+    finally:
+        # Drop the graphs of this run's models, Keras keeps them for the life of the process otherwise
+        tf.keras.backend.clear_session()
+        gc.collect()
+
 
+if __name__ == '__main__':
+    # Every run trains in a worker process with memory and time limits, so the scheduler stays small
+    runner = JobRunner('run_LSTM')
 
-# Schedule the task to run every hour
-schedule.every().hour.do(run_LSTM)
+    # Schedule the task to run every hour
+    schedule.every().hour.do(runner.run, run_LSTM)
 
-# Keep the script running to execute scheduled tasks
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+    # Keep the script running to execute scheduled tasks
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
@@ -0,0 +1,169 @@
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+# Column forecast by every engine (the same as in LSTM.py)
+TARGET = 'MaxAQI'
+
+# Share of the dates (the oldest) trained on when an engine is scored, the rest are the recent test dates
+TRAIN_SHARE = 0.8
+
+# Gradient boosting settings. The last LAGS values of the target are inputs next to the current row's features.
+LAGS = 4
+GBM_MAX_ITER = 300
+GBM_LEARNING_RATE = 0.05
+RESIDUAL_QUANTILES = 200  # Points of the test error distribution kept per horizon for the forecast samples
+
+
+def split_by_date(dates, share=TRAIN_SHARE):
+    """
+    Returns a mask of the rows before the split date, so every location is tested on the same recent days.
+    """
+    dates = pd.DatetimeIndex(dates)
+    split_date = np.sort(dates.values)[int(len(dates) * share)]
+    return dates.values < split_date
+
+
+class ModelEngine:
+    """
+    What the forecasting job needs from a model.
+
+    An engine forecasts `n_steps` rows of `step_size` ahead. fit trains (or
+    updates) it on the prepared master dataset, scores it on the most recent
+    dates and saves it to `model_dir`. load brings back what the last fit
+    saved. predict_horizon forecasts every location from its last rows, and
+    predict_samples draws possible forecasts for the quantiles and category
+    probabilities (None if the engine cannot).
+    """
+    name = None
+
+    def __init__(self, model_dir, n_steps, step_size):
+        self.model_dir = model_dir
+        self.n_steps = n_steps
+        self.step_size = step_size
+        self.state = None
+
+    @property
+    def test_rmse(self):
+        # Error on the recent dates at the last scored fit, used to pick between engines
+        return self.state.get('test_rmse') if self.state else None
+
+    def fit(self, df, all_features):
+        raise NotImplementedError
+
+    def predict_horizon(self, df):
+        """
+        Returns the (locations, n_steps) forecast, the location slugs and the last date of every location.
+        """
+        raise NotImplementedError
+
+    def predict_samples(self, df):
+        """
+        Returns (locations, samples, n_steps) possible forecasts.
+        """
+        return None
+
+    def save(self):
+        raise NotImplementedError
+
+    def load(self):
+        raise NotImplementedError
+
+
+class GradientBoostingEngine(ModelEngine):
+    """
+    Histogram gradient boosting on the current features and lagged AQI, one model per step ahead.
+
+    Every step has its own model (direct forecasting), so no prediction is fed
+    back in and the errors do not compound. Training takes seconds. The errors
+    on the test dates are kept per step and added to the forecast for the
+    samples.
+    """
+    name = 'gbm'
+
+    def __init__(self, model_dir, n_steps, step_size):
+        super().__init__(model_dir, n_steps, step_size)
+        self.models = None
+        self.residuals = None
+
+    @staticmethod
+    def lag_features(df, features):
+        """
+        Adds the last LAGS target values of every location and returns the table and the input columns.
+        """
+        by_location = df.groupby('Location', sort=False)[TARGET]
+        lags = {f'{TARGET}_lag_{lag}': by_location.shift(lag) for lag in range(LAGS)}
+        return df.assign(**lags), features + list(lags)
+
+    @staticmethod
+    def new_model(seed):
+        return HistGradientBoostingRegressor(max_iter=GBM_MAX_ITER, learning_rate=GBM_LEARNING_RATE,
+                                             early_stopping=True, random_state=seed)
+
+    def fit(self, df, all_features):
+        df, columns = self.lag_features(df, all_features)
+        X = df[columns].values.astype(np.float32)
+        by_location = df.groupby('Location', sort=False)[TARGET]
+
+        models, residuals = [], []
+        squared_errors = None
+        for step in range(1, self.n_steps + 1):
+            # Target `step` rows ahead within the same location, rows without one are left out
+            y = by_location.shift(-step).values
+            has_target = ~np.isnan(y)
+            train = split_by_date(df.index[has_target] + step * self.step_size)
+
+            # Score on the recent dates, then refit on everything
+            X_step, y_step = X[has_target], y[has_target]
+            model = self.new_model(step).fit(X_step[train], y_step[train])
+            # Actual minus forecast, so adding them to a forecast gives possible actual values
+            errors = y_step[~train] - model.predict(X_step[~train])
+            if step == 1:
+                squared_errors = errors ** 2
+            residuals.append(np.quantile(errors, np.linspace(0.005, 0.995, RESIDUAL_QUANTILES)))
+            models.append(self.new_model(step).fit(X_step, y_step))
+
+        self.models = models
+        self.residuals = np.stack(residuals, axis=1)
+        # One step ahead, the same as the LSTM's test windows
+        self.state = {'features': all_features, 'n_steps': self.n_steps,
+                      'test_rmse': float(np.sqrt(np.mean(squared_errors)))}
+        self.save()
+
+    def last_rows(self, df):
+        df, columns = self.lag_features(df, self.state['features'])
+        last = df.groupby('Location', sort=False).tail(1)
+        return last[columns].values.astype(np.float32), list(last['Location']), list(last.index)
+
+    def predict_horizon(self, df):
+        X, slugs, last_dates = self.last_rows(df)
+        predictions = np.stack([model.predict(X) for model in self.models], axis=1)
+        return predictions, slugs, last_dates
+
+    def predict_samples(self, df):
+        # The forecast plus every kept test error of its step
+        predictions, _, _ = self.predict_horizon(df)
+        return predictions[:, np.newaxis, :] + self.residuals[np.newaxis]
+
+    def save(self):
+        os.makedirs(self.model_dir, exist_ok=True)
+        with open(os.path.join(self.model_dir, 'models.pkl'), 'wb') as f:
+            pickle.dump({'models': self.models, 'residuals': self.residuals}, f)
+        with open(os.path.join(self.model_dir, 'training_state.json'), 'w') as f:
+            json.dump(self.state, f, indent=2)
+
+    def load(self):
+        try:
+            with open(os.path.join(self.model_dir, 'training_state.json')) as f:
+                self.state = json.load(f)
+            with open(os.path.join(self.model_dir, 'models.pkl'), 'rb') as f:
+                saved = pickle.load(f)
+        except (OSError, ValueError, pickle.UnpicklingError) as e:
+            print(f"Could not load the saved gradient boosting models: {e}")
+            return False
+        self.models, self.residuals = saved['models'], saved['residuals']
+        return True
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import RobustScaler
+
+# Column the models forecast (the same as in LSTM.py), always the last of a model's columns
+TARGET = 'MaxAQI'
+
+# Wind directions as Weatherstack reports them. They are always encoded in this order,
+# so every run and every model sees the same wind columns.
+COMPASS_POINTS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+                  'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+# One-hot columns are left as they are
+ONE_HOT_PREFIXES = ('wind_dir_', 'location_')
+
+# Columns holding earlier values of the target. They are scaled like the target, so a
+# scaled prediction can be fed straight back into them.
+TARGET_LIKE_COLUMNS = ['Lagged_MaxAQI']
+
+
+def encode_wind_dir(df):
+    """
+    One-hot encodes 'wind_dir' on the 16-point compass. Unknown or missing directions get all zeros.
+
+    Returns the table and the wind columns.
+    """
+    df = df.assign(wind_dir=pd.Categorical(df['wind_dir'].astype('string').str.strip().str.upper(),
+                                           categories=COMPASS_POINTS))
+    df = pd.get_dummies(df, columns=['wind_dir'], prefix='wind_dir', dtype=np.int8)
+    return df, [f'wind_dir_{point}' for point in COMPASS_POINTS]
+
+
+class Preprocessor:
+    """
+    Scales a model's columns (its features with the target last).
+
+    The scaling is fitted with a RobustScaler on the training rows and kept in
+    the model's training state (to_dict / from_dict), so training, fine-tuning
+    and forecasting all apply exactly the same transform. Predictions come
+    back on the AQI scale through inverse_target.
+    """
+
+    def __init__(self, columns, center, scale):
+        self.columns = list(columns)
+        self.center = np.asarray(center, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+
+    @classmethod
+    def fit(cls, df, columns):
+        columns = list(columns)
+        if columns[-1] != TARGET:
+            raise ValueError(f"The target has to be the last column, got {columns[-1]}")
+
+        center = np.zeros(len(columns))
+        scale = np.ones(len(columns))
+        scaled = [i for i, col in enumerate(columns) if not col.startswith(ONE_HOT_PREFIXES)]
+        # Missing values are ignored by the fit
+        scaler = RobustScaler().fit(df[[columns[i] for i in scaled]].values.astype(float))
+        center[scaled] = scaler.center_
+        scale[scaled] = scaler.scale_
+
+        for i, col in enumerate(columns):
+            if col in TARGET_LIKE_COLUMNS:
+                center[i], scale[i] = center[-1], scale[-1]
+        return cls(columns, center, scale)
+
+    def transform(self, values):
+        """
+        Scales an array whose last axis holds the columns (rows or windows).
+        """
+        return (np.asarray(values, dtype=float) - self.center) / self.scale
+
+    def transform_frame(self, df):
+        """
+        Returns a copy of the table with the model's columns scaled.
+        """
+        scaled = df.copy()
+        scaled[self.columns] = self.transform(df[self.columns].values).astype(np.float32)
+        return scaled
+
+    def transform_target(self, y):
+        return (np.asarray(y, dtype=float) - self.center[-1]) / self.scale[-1]
+
+    def inverse_target(self, y):
+        return np.asarray(y, dtype=float) * self.scale[-1] + self.center[-1]
+
+    def to_dict(self):
+        return {'columns': self.columns, 'center': self.center.tolist(), 'scale': self.scale.tolist()}
+
+    @classmethod
+    def from_dict(cls, saved):
+        return cls(saved['columns'], saved['center'], saved['scale'])
@@ -0,0 +1,163 @@
+import datetime
+import json
+import os
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Where the per-run training logs (and profiler traces) are written
+TELEMETRY_DIR = os.environ.get('AQ_TELEMETRY_DIR', '/tmp/aqi_training_telemetry')
+
+# Batches of the first epoch of the first member to capture a profiler trace of, as 'first,last' (e.g. '10,20').
+# Empty means no trace, tracing slows those batches down.
+PROFILE_STEPS = os.environ.get('AQ_PROFILE_STEPS', '')
+
+
+def parse_profile_steps(value=PROFILE_STEPS):
+    """
+    Returns the (first, last) batch to trace, or None.
+    """
+    if not value:
+        return None
+    first, last = (int(step) for step in value.split(','))
+    return first, last
+
+
+def peak_memory_mb():
+    """
+    Returns the peak resident memory of this process and the peak memory of every GPU, in MB.
+    """
+    # ru_maxrss is in KB on Linux
+    peaks = {'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    for gpu in tf.config.list_logical_devices('GPU'):
+        try:
+            peaks[gpu.name] = tf.config.experimental.get_memory_info(gpu.name)['peak'] / 2 ** 20
+        except (ValueError, RuntimeError):
+            pass
+    return peaks
+
+
+class RunLog:
+    """
+    The training log of one run (a full retrain, a fine-tuning or a backtest fold).
+
+    Every member adds its record when it finishes training and the whole log is
+    rewritten to `<kind>_<timestamp>.json`, so a run that dies still leaves what
+    its finished members recorded.
+    """
+
+    def __init__(self, kind, telemetry_dir=TELEMETRY_DIR, profile_steps=None):
+        self.kind = kind
+        self.telemetry_dir = telemetry_dir
+        self.profile_steps = parse_profile_steps() if profile_steps is None else profile_steps
+        self.started = datetime.datetime.now()
+        self.members = []
+        self.path = os.path.join(telemetry_dir, f"{kind}_{self.started.strftime('%Y%m%d-%H%M%S')}.json")
+
+    def callback(self, member, n_samples, early_stopping=None):
+        """
+        Returns the telemetry callback for one member. Only the first member is profiled.
+        """
+        profile_steps = self.profile_steps if member == 0 else None
+        return TrainingTelemetry(self, member, n_samples, early_stopping, profile_steps)
+
+    def add(self, record):
+        self.members.append(record)
+        self.write()
+
+    def write(self):
+        os.makedirs(self.telemetry_dir, exist_ok=True)
+        log = {'kind': self.kind, 'started': self.started.isoformat(timespec='seconds'), 'members': self.members}
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(log, f, indent=2)
+        os.replace(temp_path, self.path)
+
+
+class TrainingTelemetry(tf.keras.callbacks.Callback):
+    """
+    Records where one member's training time goes.
+
+    Per epoch: wall time, training samples per second and the train and
+    validation loss. When training ends: the epoch early stopping fired at,
+    the best epoch and how many epochs ran after it (what the patience cost),
+    and peak memory. It can also trace a few batches with the TensorFlow
+    profiler (open the trace directory in TensorBoard).
+    """
+
+    def __init__(self, run_log, member, n_samples, early_stopping=None, profile_steps=None):
+        super().__init__()
+        self.run_log = run_log
+        self.member = member
+        self.n_samples = n_samples
+        self.early_stopping = early_stopping
+        self.profile_steps = profile_steps
+        self.trace_dir = None
+        self.tracing = False
+        self.epochs = []
+
+    def on_train_begin(self, logs=None):
+        self.train_started = time.time()
+        self.epochs = []
+        for gpu in tf.config.list_logical_devices('GPU'):
+            try:
+                tf.config.experimental.reset_memory_stats(gpu.name)
+            except (ValueError, RuntimeError):
+                pass
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_started = time.time()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps and not self.epochs and batch == self.profile_steps[0]:
+            self.trace_dir = os.path.join(self.run_log.telemetry_dir, 'traces',
+                                          os.path.splitext(os.path.basename(self.run_log.path))[0])
+            tf.profiler.experimental.start(self.trace_dir)
+            self.tracing = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.tracing and batch == self.profile_steps[1]:
+            self.stop_trace()
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Also stops a trace whose last batch was past the end of the epoch
+        self.stop_trace()
+        logs = logs or {}
+        seconds = time.time() - self.epoch_started
+        self.epochs.append({
+            'epoch': epoch,
+            'seconds': round(seconds, 3),
+            'samples_per_second': round(self.n_samples / seconds, 1) if seconds > 0 else None,
+            'loss': logs.get('loss'),
+            'val_loss': logs.get('val_loss'),
+        })
+
+    def stop_trace(self):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+
+    def on_train_end(self, logs=None):
+        self.stop_trace()
+        val_losses = [epoch['val_loss'] for epoch in self.epochs]
+        best_epoch = int(np.nanargmin(np.array(val_losses, dtype=float))) if None not in val_losses else None
+        stopped_epoch = self.early_stopping.stopped_epoch if self.early_stopping else 0
+        record = {
+            'member': self.member,
+            'n_samples': self.n_samples,
+            'epochs_run': len(self.epochs),
+            'early_stopped_at': stopped_epoch or None,
+            'best_epoch': best_epoch,
+            'epochs_after_best': len(self.epochs) - 1 - best_epoch if best_epoch is not None else None,
+            'seconds': round(time.time() - self.train_started, 3),
+            'peak_memory_mb': {name: round(peak, 1) for name, peak in peak_memory_mb().items()},
+            'profiler_trace': self.trace_dir,
+            'epochs': self.epochs,
+        }
+        self.run_log.add(record)
+        summary = f"{self.run_log.kind} member {self.member}: {record['epochs_run']} epochs in {record['seconds']:.1f}s"
+        if best_epoch is not None:
+            summary += f", best epoch {best_epoch}, {record['epochs_after_best']} epochs after it"
+        print(summary)
@@ -0,0 +1,326 @@
+import argparse
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+import LSTM
+from Backtesting import dataset_fingerprint
+from Model_Engines import split_by_date
+from Preprocessing import Preprocessor
+
+# Where the master dataset is read from (the same local copy the backtests use)
+MASTER_DATASET_PATH = f'/tmp/{LSTM.MASTER_DATASET_FILENAME}'
+CACHE_DIR = os.path.join(LSTM.TUNING_DIR, 'cache')
+TRIALS_DIR = os.path.join(LSTM.TUNING_DIR, 'trials')
+LEADERBOARD_FILENAME = 'leaderboard.csv'
+
+# What a trial's settings are drawn from: a list is picked from, ('uniform', low, high) and
+# ('log', low, high) are drawn uniformly on a linear or log scale
+SEARCH_SPACE = {
+    'units': [16, 32, 48, 64, 96, 128],
+    'layers': [1, 2, 3, 4, 5],
+    'dropout': ('uniform', 0.0, 0.5),
+    'l2': ('log', 1e-5, 1e-1),
+    'learning_rate': ('log', 1e-4, 1e-2),
+    'lookback': [6, 12, 24, 48] if LSTM.RESOLUTION == 'hourly' else [2, 3, 4, 7, 14],
+    'batch_size': [16, 32, 64, 128],
+}
+
+# Successive halving (ASHA): every trial first trains MIN_EPOCHS. Whenever a trial is in the best
+# 1/REDUCTION_FACTOR of a rung it goes on to REDUCTION_FACTOR times as many epochs, up to MAX_EPOCHS.
+MIN_EPOCHS = 5
+MAX_EPOCHS = 135
+REDUCTION_FACTOR = 3
+RUNG_EPOCHS = [MIN_EPOCHS * REDUCTION_FACTOR ** rung
+               for rung in range(int(round(np.log(MAX_EPOCHS / MIN_EPOCHS) / np.log(REDUCTION_FACTOR))) + 1)]
+
+
+def sample_config(rng):
+    """
+    Draws one configuration from SEARCH_SPACE.
+    """
+    config = {}
+    for name, space in SEARCH_SPACE.items():
+        if isinstance(space, list):
+            config[name] = space[rng.integers(len(space))]
+        elif space[0] == 'log':
+            config[name] = float(np.exp(rng.uniform(np.log(space[1]), np.log(space[2]))))
+        else:
+            config[name] = float(rng.uniform(space[1], space[2]))
+    # Plain ints, so the configuration can be written as JSON
+    return {name: int(value) if isinstance(value, (int, np.integer)) else value for name, value in config.items()}
+
+
+def windows_prefix(fingerprint, lookback):
+    return os.path.join(CACHE_DIR, f'windows_{fingerprint}_{lookback}')
+
+
+def build_window_cache(df, features, fingerprint):
+    """
+    Cuts the scaled training and validation windows of every lookback in the search space once.
+
+    They are split by date like the hourly job splits them, so a trial's
+    validation loss is measured on the same recent days its test RMSE would be.
+    Workers memory-map the files instead of each building its own copy.
+    """
+    columns = features + [LSTM.TARGET]
+    preprocessor = Preprocessor.fit(df[split_by_date(df.index)], columns)
+    scaled = preprocessor.transform_frame(df)
+    for lookback in SEARCH_SPACE['lookback']:
+        prefix = windows_prefix(fingerprint, lookback)
+        if os.path.exists(f'{prefix}_y_val.npy'):
+            continue
+        X, y, _, target_dates = LSTM.location_sequences(scaled, columns, lookback)
+        train = split_by_date(target_dates)
+        for name, values in [('X_train', X[train]), ('y_train', y[train]), ('X_val', X[~train]), ('y_val', y[~train])]:
+            temp_path = f'{prefix}_{name}.{os.getpid()}.tmp.npy'
+            np.save(temp_path, np.ascontiguousarray(values, dtype=np.float32))
+            os.replace(temp_path, f'{prefix}_{name}.npy')
+
+
+def tuning_features(df, all_features):
+    """
+    Returns the features the trials train on: the ones of the saved ensemble, or a fresh RFE selection.
+    """
+    try:
+        with open(os.path.join(LSTM.MODEL_DIR, 'training_state.json')) as f:
+            features = json.load(f)['features']
+        if all(col in all_features for col in features):
+            return features
+    except (OSError, ValueError, KeyError):
+        pass
+    return LSTM.select_features(df, all_features)
+
+
+# Set once in each worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(fingerprint, threads):
+    # A few threads per worker, the parallelism comes from running trials side by side
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    _worker_state['windows'] = {
+        lookback: {name: np.load(f'{windows_prefix(fingerprint, lookback)}_{name}.npy', mmap_mode='r')
+                   for name in ['X_train', 'y_train', 'X_val', 'y_val']}
+        for lookback in SEARCH_SPACE['lookback']
+    }
+
+
+def _train_rung(trial_id, config, rung):
+    """
+    Trains a trial up to the epochs of `rung`, continuing from where its last rung stopped.
+
+    Returns the trial, the rung, its best validation loss so far and the seconds it took.
+    """
+    started = time.time()
+    windows = _worker_state['windows'][config['lookback']]
+    path = os.path.join(TRIALS_DIR, f'trial_{trial_id}.keras')
+    if rung == 0:
+        model = LSTM.build_model(config['units'], config['lookback'], windows['X_train'].shape[2],
+                                 config['batch_size'], config['layers'], config['dropout'], config['l2'],
+                                 config['learning_rate'])
+    else:
+        model = tf.keras.models.load_model(path)
+
+    history = model.fit(windows['X_train'], windows['y_train'], batch_size=config['batch_size'],
+                        initial_epoch=RUNG_EPOCHS[rung - 1] if rung else 0, epochs=RUNG_EPOCHS[rung],
+                        validation_data=(windows['X_val'], windows['y_val']), verbose=0)
+    model.save(path)
+
+    # Free the graph before the worker takes the next trial
+    tf.keras.backend.clear_session()
+    val_loss = float(np.nanmin(history.history['val_loss']))
+    return trial_id, rung, val_loss if np.isfinite(val_loss) else float('inf'), time.time() - started
+
+
+class HyperparameterSearch:
+    """
+    Asynchronous successive halving over sampled configurations.
+
+    Whenever a worker is free it gets the best pending promotion (a trial in
+    the top 1/REDUCTION_FACTOR of its rung that has not gone on yet, highest
+    rung first), or else a new trial. So no worker waits for a rung to fill
+    up, and poor trials stop after MIN_EPOCHS. The leaderboard and the best
+    configuration are saved after every result, a run that is stopped keeps
+    what it found.
+    """
+
+    def __init__(self, n_trials, deadline, seed=None, tuning_dir=LSTM.TUNING_DIR):
+        self.n_trials = n_trials
+        self.deadline = deadline
+        self.rng = np.random.default_rng(seed)
+        self.tuning_dir = tuning_dir
+        self.trials = {}
+        self.rung_results = [[] for _ in RUNG_EPOCHS]  # (val_loss, trial_id) of every finished rung
+        self.promoted = [set() for _ in RUNG_EPOCHS]
+        self.best = None
+
+    def next_job(self):
+        """
+        Returns the next (trial_id, config, rung) to train, or None if there is nothing to start.
+        """
+        if time.time() > self.deadline:
+            return None
+
+        for rung in reversed(range(len(RUNG_EPOCHS) - 1)):
+            results = sorted(self.rung_results[rung])
+            for val_loss, trial_id in results[:len(results) // REDUCTION_FACTOR]:
+                if trial_id not in self.promoted[rung]:
+                    self.promoted[rung].add(trial_id)
+                    self.trials[trial_id]['status'] = 'running'
+                    return trial_id, self.trials[trial_id]['config'], rung + 1
+
+        if len(self.trials) < self.n_trials:
+            trial_id = len(self.trials)
+            self.trials[trial_id] = {'config': sample_config(self.rng), 'rung': None, 'val_loss': None,
+                                     'seconds': 0.0, 'status': 'running'}
+            return trial_id, self.trials[trial_id]['config'], 0
+        return None
+
+    def record(self, trial_id, rung, val_loss, seconds):
+        trial = self.trials[trial_id]
+        trial.update(rung=rung, val_loss=val_loss, seconds=trial['seconds'] + seconds,
+                     status='finished' if rung == len(RUNG_EPOCHS) - 1 else 'paused')
+        self.rung_results[rung].append((val_loss, trial_id))
+        print(f"Trial {trial_id} rung {rung} ({RUNG_EPOCHS[rung]} epochs): val loss {val_loss:.4f} "
+              f"in {seconds:.0f}s {trial['config']}")
+
+        # Losses after different numbers of epochs do not compare, the best is the best of the highest rung
+        # (that has a trial which did not fail or diverge)
+        scored_rungs = [rung for rung, results in enumerate(self.rung_results)
+                        if any(np.isfinite(loss) for loss, _ in results)]
+        if scored_rungs:
+            best_rung = max(scored_rungs)
+            best_loss, best_id = min(self.rung_results[best_rung])
+            if self.best is None or self.best[0] != best_id or self.best[1] != best_rung:
+                self.best = (best_id, best_rung, best_loss)
+                self.save_best()
+        self.save_leaderboard()
+
+    def fail(self, trial_id, rung, error):
+        """
+        Records a trial whose rung raised. It ranks last in the rung and is never promoted.
+        """
+        trial = self.trials[trial_id]
+        trial.update(rung=rung, val_loss=float('inf'), status='failed')
+        self.rung_results[rung].append((float('inf'), trial_id))
+        self.promoted[rung].add(trial_id)
+        print(f"Trial {trial_id} rung {rung} ({RUNG_EPOCHS[rung]} epochs) failed: {error} {trial['config']}")
+        self.save_leaderboard()
+
+    def save_best(self):
+        best_id, best_rung, best_loss = self.best
+        best = {**self.trials[best_id]['config'], 'units_step': LSTM.HYPERPARAMETERS['units_step'],
+                'trial': best_id, 'epochs': RUNG_EPOCHS[best_rung], 'val_loss': best_loss,
+                'tuned_at': datetime.datetime.now().isoformat(timespec='seconds')}
+        path = os.path.join(self.tuning_dir, LSTM.BEST_CONFIG_FILENAME)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(best, f, indent=2)
+        os.replace(f'{path}.tmp', path)
+
+    def leaderboard(self):
+        rows = [{'trial': trial_id, **trial['config'], 'epochs': RUNG_EPOCHS[trial['rung']],
+                 'val_loss': trial['val_loss'], 'seconds': round(trial['seconds'], 1), 'status': trial['status']}
+                for trial_id, trial in self.trials.items() if trial['rung'] is not None]
+        if not rows:
+            return pd.DataFrame()
+        # Trials that went further first, then by loss
+        return pd.DataFrame(rows).sort_values(['epochs', 'val_loss'], ascending=[False, True])
+
+    def save_leaderboard(self):
+        path = os.path.join(self.tuning_dir, LEADERBOARD_FILENAME)
+        self.leaderboard().to_csv(f'{path}.tmp', index=False)
+        os.replace(f'{path}.tmp', path)
+
+    def run(self, fingerprint, max_workers, threads_per_worker=1):
+        # TensorFlow does not survive a fork, so every worker starts a fresh interpreter
+        context = multiprocessing.get_context('spawn')
+        running = {}  # Future of every job in progress and its (trial_id, rung)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(fingerprint, threads_per_worker)) as pool:
+            while True:
+                while len(running) < max_workers:
+                    job = self.next_job()
+                    if job is None:
+                        break
+                    trial_id, config, rung = job
+                    running[pool.submit(_train_rung, *job)] = (trial_id, rung)
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial_id, rung = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self.fail(trial_id, rung, e)
+                    else:
+                        self.record(*result)
+
+
+def run_tuning(master_dataset_path=MASTER_DATASET_PATH, n_trials=200, hours=8.0, max_workers=None,
+               threads_per_worker=1, seed=None):
+    """
+    Searches the ensemble settings on the master dataset and saves the best configuration.
+
+    The hourly job picks it up in its next full retrain. Returns the leaderboard.
+    """
+    for folder in [CACHE_DIR, TRIALS_DIR]:
+        os.makedirs(folder, exist_ok=True)
+    if not os.path.exists(master_dataset_path):
+        # Fetch the master dataset the same way the hourly job does
+        storage_client = LSTM.get_storage_client()
+        blob = storage_client.bucket(LSTM.master_dataset_bucket_name).blob(LSTM.MASTER_DATASET_FILENAME)
+        blob.download_to_filename(master_dataset_path)
+
+    df, all_features = LSTM.load_master_dataset(master_dataset_path)
+    features = tuning_features(df, all_features)
+    # The windows depend on the features as well as the data
+    fingerprint = f"{dataset_fingerprint(df)}_{hashlib.sha1(json.dumps(features).encode('utf-8')).hexdigest()[:8]}"
+    build_window_cache(df, features, fingerprint)
+
+    max_workers = max_workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+    print(f"Tuning on {len(features)} features with {max_workers} workers, rungs of {RUNG_EPOCHS} epochs, "
+          f"up to {n_trials} trials or {hours:g} hours")
+
+    started = time.time()
+    search = HyperparameterSearch(n_trials, started + hours * 3600, seed)
+    try:
+        search.run(fingerprint, max_workers, threads_per_worker)
+    finally:
+        # The trial models are only needed to continue them
+        shutil.rmtree(TRIALS_DIR, ignore_errors=True)
+
+    leaderboard = search.leaderboard()
+    print(leaderboard.head(10).to_string(index=False))
+    print(f"{len(search.trials)} trials in {time.time() - started:.0f}s, "
+          f"best configuration saved to {os.path.join(LSTM.TUNING_DIR, LSTM.BEST_CONFIG_FILENAME)}")
+    return leaderboard
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Searches the LSTM ensemble settings with parallel trials and successive halving.')
+    parser.add_argument('--master-dataset', default=MASTER_DATASET_PATH,
+                        help='Local copy of the master dataset (downloaded if missing)')
+    parser.add_argument('--trials', type=int, default=200, help='Most configurations to try')
+    parser.add_argument('--hours', type=float, default=8.0, help='No trial is started or continued after this')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (defaults to the CPU count over the threads per worker)')
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    run_tuning(args.master_dataset, n_trials=args.trials, hours=args.hours, max_workers=args.workers,
+               threads_per_worker=args.threads_per_worker, seed=args.seed)
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import closing
+
+# The jobs and the shared helpers live in the other project folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data Manipulation'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Machine Learning Model'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Feature_Engineering import LOCATION_FILES, MASTER_DATASET_FILENAME, bucket_names
+from Job_Runner import JobRunner
+from Locations import active_locations
+from Staging import STAGING_DB_PATH, connect, staged_version, transaction
+from Storage import get_storage_client, location_blob_name
+
+# Google Cloud Storage configuration (replace with your actual service account key file path)
+os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'PATH_TO_YOUR_SERVICE_ACCOUNT_KEY_FILE.json'
+
+# Bucket the master dataset is written to (the same as in Feature_Engineering.py and LSTM.py)
+MASTER_DATASET_BUCKET_NAME = 'master-aqi-bucket'
+
+# How often the inputs are checked for changes. Checking only reads generations, nothing is downloaded.
+POLL_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pipeline_fingerprints (
+    node TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    ran_at REAL NOT NULL
+);
+"""
+
+
+def source_inputs():
+    """
+    The files the collectors write and the master dataset is built from (read with their staged deltas).
+    """
+    inputs = []
+    for csv_file, bucket_name in bucket_names.items():
+        if csv_file in LOCATION_FILES:
+            inputs += [(bucket_name, location_blob_name(location, csv_file), True) for location in active_locations()]
+        else:
+            inputs.append((bucket_name, csv_file, True))
+    return inputs
+
+
+def master_inputs():
+    return [(MASTER_DATASET_BUCKET_NAME, MASTER_DATASET_FILENAME, False)]
+
+
+# The jobs in dependency order: collectors -> master dataset (with its features) -> models and forecast.
+# A node's inputs are the files the nodes before it write, so when a node changes its output the
+# next one runs in the same pass instead of waiting for the next poll.
+NODES = [
+    {'name': 'master_dataset', 'job': 'Feature_Engineering:process_data', 'inputs': source_inputs},
+    {'name': 'forecast', 'job': 'LSTM:run_LSTM', 'inputs': master_inputs},
+]
+
+
+def fingerprint(storage_client, inputs):
+    """
+    Returns the version of every input: generation and deltas for staged files,
+    generation and content hash for the others.
+    """
+    versions = {}
+    for bucket_name, blob_name, staged in inputs:
+        bucket = storage_client.bucket(bucket_name)
+        if staged:
+            version = staged_version(bucket, blob_name)
+        else:
+            blob = bucket.get_blob(blob_name)
+            version = (blob.generation, blob.md5_hash) if blob else None
+        versions[f'{bucket_name}/{blob_name}'] = version
+    # Through JSON, so it compares the same as what was stored
+    return json.dumps(versions, sort_keys=True)
+
+
+def connect_fingerprints(path=STAGING_DB_PATH):
+    connection = connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def recorded_fingerprint(node, path=STAGING_DB_PATH):
+    with closing(connect_fingerprints(path)) as connection:
+        row = connection.execute('SELECT fingerprint FROM pipeline_fingerprints WHERE node = ?', (node,)).fetchone()
+    return row[0] if row else None
+
+
+def record_fingerprint(node, value, path=STAGING_DB_PATH):
+    with closing(connect_fingerprints(path)) as connection, transaction(connection):
+        connection.execute('INSERT OR REPLACE INTO pipeline_fingerprints VALUES (?, ?, ?)', (node, value, time.time()))
+
+
+class Pipeline:
+    """
+    Runs every node whose inputs changed since its last successful run, in dependency order.
+
+    Each node runs in its own JobRunner worker. The fingerprint is taken before
+    the run, so inputs that change while it runs make it run again.
+    """
+
+    def __init__(self, storage_client, nodes=NODES):
+        self.storage_client = storage_client
+        self.nodes = nodes
+        self.runners = {node['name']: JobRunner(node['name']) for node in nodes}
+
+    def run_pending(self, force=False):
+        """
+        Makes one pass over the nodes. Returns the names of the nodes that ran.
+        """
+        ran = []
+        for node in self.nodes:
+            try:
+                current = fingerprint(self.storage_client, node['inputs']())
+            except Exception as e:
+                print(f"Error checking the inputs of {node['name']}: {e}")
+                continue
+            if not force and current == recorded_fingerprint(node['name']):
+                continue
+
+            print(f"Inputs of {node['name']} changed, running {node['job']}")
+            runner = self.runners[node['name']]
+            runner.run(node['job'])
+            ran.append(node['name'])
+            # Jobs raise when they fail, a failed run leaves the old fingerprint so the next pass retries it
+            if runner.last_error is None:
+                record_fingerprint(node['name'], current)
+            else:
+                print(f"{node['name']} failed, it runs again on the next pass")
+        return ran
+
+    def run(self, interval=POLL_SECONDS):
+        while True:
+            time.sleep(interval)
+            self.run_pending()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rebuilds the master dataset and retrains the forecast only when their inputs change.')
+    parser.add_argument('--once', action='store_true', help='Make one pass and exit')
+    parser.add_argument('--force', action='store_true', help='Run every node on the first pass')
+    parser.add_argument('--poll-seconds', type=int, default=POLL_SECONDS)
+    args = parser.parse_args()
+
+    pipeline = Pipeline(get_storage_client())
+    pipeline.run_pending(force=args.force)
+    if not args.once:
+        pipeline.run(args.poll_seconds)
@@ -0,0 +1,254 @@
+import argparse
+import datetime
+import importlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+# The collectors, the jobs and the shared helpers live in the other project folders
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ['AirNow', 'Energy', 'Weather', 'Traffic', 'Wildfire', 'Data Manipulation', 'Machine Learning Model',
+               'Pipeline', 'Common']:
+    sys.path.append(os.path.join(PROJECT_DIR, folder))
+import Clock
+from Stub_APIs import StubAPIs
+
+# The collectors replayed and the file each one writes. They write to the bucket
+# Feature_Engineering.py reads that file from.
+COLLECTORS = {
+    'AirNow': 'air_quality_data_all.csv',
+    'WeatherCurrentPull': 'weather_data_all.csv',
+    'TrafficCurrent': 'traffic_data_all_segments.csv',
+    'Energy_Current': 'eia_data_all.csv',
+    'WildfireCurrent': 'wildfire_data_binned.csv',
+}
+
+# The API budgets are multiplied by this, the replay does not wait for the real clock.
+# 1 keeps the real budgets.
+RATE_SCALE = 3600
+
+
+def configure_environment(work_dir, api_base_url, locations=None, engine=None):
+    """
+    Points every script at the work folder and the stub APIs.
+
+    Has to run before the scripts are imported, they read these settings when
+    they are. The jobs' worker processes inherit them.
+    """
+    settings = {
+        'AQ_STORAGE_DIR': os.path.join(work_dir, 'storage'),
+        'AQ_STAGING_DB': os.path.join(work_dir, 'staging.sqlite'),
+        'AQ_RATE_LIMIT_DB': os.path.join(work_dir, 'rate_limits.sqlite'),
+        'AQ_MODEL_DIR': os.path.join(work_dir, 'models'),
+        'AQ_FEATURE_STORE_DIR': os.path.join(work_dir, 'feature_store'),
+        'AQ_TELEMETRY_DIR': os.path.join(work_dir, 'telemetry'),
+        'AQ_FORECAST_ARCHIVE_DB': os.path.join(work_dir, 'forecast_archive.sqlite'),
+        'AQ_NOWCAST_DB': os.path.join(work_dir, 'nowcast.sqlite'),
+        'AQ_API_BASE_URL': api_base_url,
+    }
+    if locations:
+        settings['AQ_LOCATIONS'] = locations
+    if engine:
+        settings['AQ_MODEL_ENGINE'] = engine
+    os.makedirs(settings['AQ_FEATURE_STORE_DIR'], exist_ok=True)
+    os.environ.update(settings)
+
+
+def load_collectors(rate_scale=RATE_SCALE):
+    """
+    Imports every collector with its jobs on its own scheduler. Returns {name: (module, scheduler)}.
+    """
+    import schedule
+    from Feature_Engineering import bucket_names
+    from Http_Client import PROVIDERS
+
+    for budget in PROVIDERS.values():
+        budget['rate'] *= rate_scale
+
+    collectors = {}
+    for name, csv_file in COLLECTORS.items():
+        module = importlib.import_module(name)
+        module.STORAGE_BUCKET_NAME = bucket_names[csv_file]
+        scheduler = schedule.Scheduler()
+        module.schedule_jobs(scheduler)
+        collectors[name] = (module, scheduler)
+    return collectors
+
+
+def job_times(job):
+    """
+    Returns the times of day a scheduled job runs at. Hourly and minutely jobs are lined up on midnight.
+    """
+    if job.unit == 'days' and job.interval == 1:
+        return [job.at_time or datetime.time(0)]
+    if job.unit == 'hours':
+        minute = job.at_time.minute if job.at_time else 0
+        return [datetime.time(hour, minute) for hour in range(0, 24, job.interval)]
+    if job.unit == 'minutes':
+        return [datetime.time(minute // 60, minute % 60) for minute in range(0, 24 * 60, job.interval)]
+    raise ValueError(f"Cannot replay a job that runs every {job.interval} {job.unit}")
+
+
+def day_ticks(collectors):
+    """
+    Returns one day of the collectors' jobs as (time, collector, job) in the order they run.
+
+    The every-minute flushes are left out, the replay flushes after every tick
+    instead (staged rows only become due by the wall clock).
+    """
+    from Staging import flush
+
+    ticks = []
+    for name, (_, scheduler) in collectors.items():
+        for job in scheduler.jobs:
+            if job.job_func.func is flush:
+                continue
+            ticks += [(at, name, job) for at in job_times(job)]
+    return sorted(ticks, key=lambda tick: tick[0])
+
+
+def storage_bytes(path):
+    total = 0
+    for folder, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(folder, file)) for file in files)
+    return total
+
+
+class Replay:
+    """
+    Runs N simulated days of the pipeline against the stub APIs and the filesystem buckets.
+
+    Every tick sets the simulated clock, runs the collector's job the way its
+    scheduler would and flushes what was staged. Every `pipeline_every_hours`
+    simulated hours the pipeline (Pipeline.py) rebuilds the master dataset and
+    retrains whatever changed, in its worker processes. The time and memory of
+    every stage are kept for the report.
+
+    The jobs' worker processes keep the real clock, so the LSTM's full retrain
+    every FULL_RETRAIN_EVERY_DAYS still counts real days.
+    """
+
+    def __init__(self, collectors, pipeline, pipeline_every_hours=24):
+        self.collectors = collectors
+        self.pipeline = pipeline
+        self.pipeline_every_hours = pipeline_every_hours
+        self.stages = defaultdict(lambda: {'runs': 0, 'seconds': 0.0, 'errors': 0, 'peak_rss_mb': None})
+
+    def record(self, stage, seconds, error=None, peak_rss_mb=None):
+        stats = self.stages[stage]
+        stats['runs'] += 1
+        stats['seconds'] += seconds
+        stats['errors'] += error is not None
+        if peak_rss_mb is not None:
+            stats['peak_rss_mb'] = max(stats['peak_rss_mb'] or 0.0, peak_rss_mb)
+
+    def timed(self, stage, function, *args, **kwargs):
+        started = time.time()
+        error = None
+        try:
+            function(*args, **kwargs)
+        except Exception as e:
+            error = e
+            print(f"{stage} failed: {e}")
+        self.record(stage, time.time() - started, error)
+
+    def run_pipeline(self):
+        for name in self.pipeline.run_pending():
+            runner = self.pipeline.runners[name]
+            self.record(name, runner.last_duration, runner.last_error, runner.last_peak_rss_mb)
+
+    def run(self, start, days):
+        from Staging import flush
+
+        ticks = day_ticks(self.collectors)
+        for day in range(days):
+            date = start + datetime.timedelta(days=day)
+            print(f"Replaying {date.isoformat()} ({day + 1}/{days})")
+            for hour in range(24):
+                for at, name, job in [tick for tick in ticks if tick[0].hour == hour]:
+                    Clock.set_simulated_now(datetime.datetime.combine(date, at))
+                    self.timed(name, job.job_func)
+                    self.timed('flush', flush, force=True)
+
+                if (hour + 1) % self.pipeline_every_hours == 0:
+                    Clock.set_simulated_now(datetime.datetime.combine(date, datetime.time(hour, 59)))
+                    self.run_pipeline()
+        Clock.set_simulated_now(None)
+
+
+def report(replay, stub, days, wall_seconds, work_dir):
+    """
+    Puts together what the replay cost. The workers' CPU time and memory are only known once they stopped.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'days': days,
+        'wall_seconds': round(wall_seconds, 1),
+        'simulated_days_per_hour': round(days / wall_seconds * 3600, 1) if wall_seconds else None,
+        'stages': {stage: {**stats, 'seconds': round(stats['seconds'], 2)} for stage, stats in replay.stages.items()},
+        'api': stub.stats(),
+        # The replay's own time includes the collectors and the stub APIs
+        'cpu_seconds': {'replay': round(own.ru_utime + own.ru_stime, 1),
+                        'workers': round(workers.ru_utime + workers.ru_stime, 1)},
+        # ru_maxrss is in KB on Linux, for the workers it is the largest one
+        'peak_rss_mb': {'replay': round(own.ru_maxrss / 1024, 1), 'workers': round(workers.ru_maxrss / 1024, 1)},
+        'storage_bytes': storage_bytes(os.path.join(work_dir, 'storage')),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replays simulated days of every collector, the master dataset build and the forecast '
+                    'offline, against stub APIs and filesystem buckets, and reports what it cost.')
+    parser.add_argument('--days', type=int, default=14, help='Simulated days to replay')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, default=None,
+                        help='First simulated day (YYYY-MM-DD), by default the days up to yesterday')
+    parser.add_argument('--work-dir', default=None, help='Folder for the buckets, models and databases '
+                                                         '(a new temporary folder by default)')
+    parser.add_argument('--locations', default=None, help='Comma separated slugs, all locations by default')
+    parser.add_argument('--engine', default=None, help="Model engine ('lstm', 'gbm' or 'best')")
+    parser.add_argument('--pipeline-every-hours', type=int, default=24,
+                        help='Simulated hours between pipeline passes (1 is what the hourly jobs do)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay of every stub API response')
+    parser.add_argument('--rate-limited-share', type=float, default=0.0,
+                        help='Share of the API calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429')
+    parser.add_argument('--rate-scale', type=float, default=RATE_SCALE,
+                        help='Multiplies the API budgets, 1 keeps the real ones')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='aq_replay_')
+    start = args.start or datetime.date.today() - datetime.timedelta(days=args.days)
+
+    stub = StubAPIs(args.latency_ms, args.rate_limited_share, args.retry_after, args.seed)
+    stub.start()
+    configure_environment(work_dir, stub.base_url, args.locations, args.engine)
+
+    # Imported now that the environment points at the work folder
+    from Pipeline import Pipeline
+    from Storage import get_storage_client
+
+    collectors = load_collectors(args.rate_scale)
+    pipeline = Pipeline(get_storage_client())
+    replay = Replay(collectors, pipeline, args.pipeline_every_hours)
+
+    started = time.time()
+    try:
+        replay.run(start, args.days)
+    finally:
+        wall_seconds = time.time() - started
+        for runner in pipeline.runners.values():
+            runner.stop_worker()
+        stub.stop()
+
+    summary = report(replay, stub, args.days, wall_seconds, work_dir)
+    with open(os.path.join(work_dir, 'replay_report.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(json.dumps(summary, indent=2))
+    print(f"Replay of {args.days} days took {wall_seconds:.0f}s, everything it wrote is in {work_dir}")
@@ -0,0 +1,242 @@
+import copy
+import csv
+import datetime
+import io
+import json
+import math
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+import Clock
+
+# Responses recorded from every provider, replayed with the simulated date and values that change from day to day
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# AirNow's category names by the lowest AQI of each category
+AQI_CATEGORIES = [(0, 1, 'Good'), (51, 2, 'Moderate'), (101, 3, 'Unhealthy for Sensitive Groups'),
+                  (151, 4, 'Unhealthy'), (201, 5, 'Very Unhealthy'), (301, 6, 'Hazardous')]
+
+COMPASS_POINTS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+                  'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+
+def load_fixture(filename):
+    with open(os.path.join(FIXTURES_DIR, filename)) as f:
+        return f.read()
+
+
+def rng_for(*keys):
+    """
+    Returns a random generator seeded by the keys, so a replay of the same days gets the same responses.
+    """
+    return np.random.default_rng(zlib.crc32('|'.join(str(key) for key in keys).encode('utf-8')))
+
+
+def seasonal_factor(date):
+    # A slow swing over the month, so the models have something to learn
+    return 1 + 0.3 * math.sin(2 * math.pi * date.toordinal() / 30)
+
+
+def aqi_category(aqi):
+    return next((number, name) for low, number, name in reversed(AQI_CATEGORIES) if aqi >= low)
+
+
+def render_airnow(path, query, headers):
+    if path.startswith('/aq/data'):
+        return render_airnow_monitors(query)
+    now = Clock.now()
+    zip_code = query.get('zipCode', [''])[0]
+    rng = rng_for('airnow', now.date(), now.hour, zip_code)
+    observations = json.loads(load_fixture('airnow_current.json'))
+    for observation in observations:
+        observation['DateObserved'] = f"{now.strftime('%Y-%m-%d')} "
+        observation['HourObserved'] = now.hour
+        observation['AQI'] = int(max(0, round(observation['AQI'] * seasonal_factor(now.date()) *
+                                              rng.lognormal(0, 0.15))))
+        number, name = aqi_category(observation['AQI'])
+        observation['Category'] = {'Number': number, 'Name': name}
+    return 'application/json', json.dumps(observations)
+
+
+def render_airnow_monitors(query):
+    # Every monitor in the recording reports every hour from startDate to endDate (UTC hours)
+    start = datetime.datetime.strptime(query['startDate'][0], '%Y-%m-%dT%H')
+    end = datetime.datetime.strptime(query['endDate'][0], '%Y-%m-%dT%H')
+    rows = []
+    for hours in range(int((end - start).total_seconds() // 3600) + 1):
+        hour = start + datetime.timedelta(hours=hours)
+        rng = rng_for('airnow-monitors', hour, query.get('BBOX', [''])[0])
+        for row in json.loads(load_fixture('airnow_data.json')):
+            daily_shape = 1 + 0.3 * math.sin(2 * math.pi * (hour.hour - 15) / 24)
+            row['UTC'] = hour.strftime('%Y-%m-%dT%H:%M')
+            row['RawConcentration'] = round(row['RawConcentration'] * seasonal_factor(hour.date()) * daily_shape *
+                                            float(rng.lognormal(0, 0.2)), 1)
+            row['Value'] = row['RawConcentration']
+            rows.append(row)
+    return 'application/json', json.dumps(rows)
+
+
+def render_weatherstack(path, query, headers):
+    now = Clock.now()
+    rng = rng_for('weatherstack', now.date(), now.hour, query.get('query', [''])[0])
+    response = json.loads(load_fixture('weatherstack_current.json'))
+    current = response['current']
+    current['temperature'] = int(round(current['temperature'] * seasonal_factor(now.date()) + rng.normal(0, 3)))
+    current['feelslike'] = current['temperature'] + int(rng.integers(-2, 4))
+    current['humidity'] = int(np.clip(current['humidity'] + rng.normal(0, 10), 5, 100))
+    current['wind_speed'] = int(abs(current['wind_speed'] + rng.normal(0, 5)))
+    current['wind_dir'] = str(rng.choice(COMPASS_POINTS))
+    current['pressure'] = int(round(current['pressure'] + rng.normal(0, 6)))
+    current['precip'] = round(float(rng.exponential(1.5)) if rng.random() < 0.3 else 0.0, 1)
+    response['location']['localtime'] = now.strftime('%Y-%m-%d %H:%M')
+    return 'application/json', json.dumps(response)
+
+
+def render_eia(path, query, headers):
+    # The day asked for is in the X-Params header, every hour of it is returned
+    params = json.loads(headers.get('X-Params', '{}'))
+    day = params.get('start', Clock.now().strftime('%Y-%m-%d'))[:10]
+    rng = rng_for('eia', day)
+    response = json.loads(load_fixture('eia_fuel_type_data.json'))
+    hour_rows = response['response']['data']
+    rows = []
+    for hour in range(23, -1, -1):
+        daily_shape = 1 + 0.15 * math.sin(2 * math.pi * (hour - 6) / 24)
+        for row in hour_rows:
+            row = copy.deepcopy(row)
+            row['period'] = f'{day}T{hour:02d}-04'
+            row['value'] = int(round(row['value'] * daily_shape * rng.lognormal(0, 0.05)))
+            rows.append(row)
+    response['response']['data'] = rows
+    response['response']['total'] = len(rows)
+    return 'application/json', json.dumps(response)
+
+
+def render_tomtom(path, query, headers):
+    now = Clock.now()
+    rng = rng_for('tomtom', now.date(), now.hour, now.minute, query.get('point', [''])[0])
+    response = json.loads(load_fixture('tomtom_flow_segment.json'))
+    segment = response['flowSegmentData']
+    segment['currentSpeed'] = int(round(segment['freeFlowSpeed'] * rng.uniform(0.45, 1.0)))
+    segment['currentTravelTime'] = int(round(segment['freeFlowTravelTime'] * segment['freeFlowSpeed'] /
+                                             max(segment['currentSpeed'], 1)))
+    return 'application/json', json.dumps(response)
+
+
+def render_firms(path, query, headers):
+    # /api/area/csv/<key>/<source>/<area>/<days>/<date>
+    day = path.rstrip('/').split('/')[-1]
+    rng = rng_for('firms', day)
+    rows = list(csv.DictReader(io.StringIO(load_fixture('firms_area.csv'))))
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+    writer.writeheader()
+    for row in rows:
+        # Every fire in the recording burns on some days and not on others
+        for _ in range(rng.poisson(1.5)):
+            writer.writerow({**row, 'acq_date': day, 'frp': round(float(row['frp']) * rng.lognormal(0, 0.5), 1)})
+    return 'text/csv', output.getvalue()
+
+
+RENDERERS = {
+    'airnow': render_airnow,
+    'weatherstack': render_weatherstack,
+    'eia': render_eia,
+    'tomtom': render_tomtom,
+    'firms': render_firms,
+}
+
+
+class StubAPIs:
+    """
+    A local HTTP server standing in for every provider, for Http_Client's AQ_API_BASE_URL.
+
+    A request to /<provider>/<path> gets the provider's recorded response,
+    rendered for the simulated time. Every response waits `latency_ms`, and a
+    `rate_limited_share` of the requests get a 429 with Retry-After instead.
+    Requests, 429s and bytes sent are counted per provider.
+    """
+
+    def __init__(self, latency_ms=0, rate_limited_share=0.0, retry_after=1, seed=0):
+        self.latency_ms = latency_ms
+        self.rate_limited_share = rate_limited_share
+        self.retry_after = retry_after
+        self.rng = np.random.default_rng(seed)
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.handle(self)
+
+            def log_message(self, format, *args):
+                # The collectors print what they fetched already
+                pass
+
+        return Handler
+
+    def count(self, provider, key, value=1):
+        with self.lock:
+            self.counts[provider][key] += value
+
+    def handle(self, request):
+        parts = urlsplit(request.path)
+        provider, _, path = parts.path.lstrip('/').partition('/')
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+        if provider not in RENDERERS:
+            request.send_error(404, f'No stub for {provider}')
+            return
+        self.count(provider, 'requests')
+
+        with self.lock:
+            rate_limited = self.rng.random() < self.rate_limited_share
+        if rate_limited:
+            self.count(provider, 'rate_limited')
+            request.send_response(429)
+            request.send_header('Retry-After', str(self.retry_after))
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        content_type, body = RENDERERS[provider](f'/{path}', parse_qs(parts.query), request.headers)
+        body = body.encode('utf-8')
+        self.count(provider, 'bytes', len(body))
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name='stub-apis')
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {provider: dict(counts) for provider, counts in self.counts.items()}
@@ -0,0 +1,242 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Locations import LEGACY_LOCATION, active_locations
+from Staging import read_staged_csv, staged_version
+from Storage import get_storage_client, location_blob, location_blob_name
+
+# Where the served files are written (replace with your actual bucket names, the same as in
+# LSTM.py and AirNow.py)
+FORECAST_BUCKET_NAME = 'columbus-forecast-bucket'
+AIR_QUALITY_BUCKET_NAME = 'YOUR_STORAGE_BUCKET_NAME'
+
+# Resolution of the forecast to serve, 'daily' or 'hourly' (set the same way as for LSTM.py)
+RESOLUTION = os.environ.get('AQ_RESOLUTION', 'daily')
+FORECAST_FILENAME = 'aqi_forecast_hourly.csv' if RESOLUTION == 'hourly' else 'aqi_forecast.csv'
+CURRENT_AQI_FILENAME = 'current-aqi.csv'
+NOWCAST_FILENAME = 'aqi_nowcast.csv'
+ALL_AIR_QUALITY_DATA_FILENAME = 'air_quality_data_all.csv'
+
+# Server settings
+HOST = '0.0.0.0'
+PORT = 8080
+REFRESH_SECONDS = 30  # How often the source files are checked for a new generation
+MAX_AGE_SECONDS = 60  # How long clients and CDNs may keep a response
+HISTORY_DAYS = 30  # Days of daily maximum AQI kept for /history
+
+
+def parse_forecast(df):
+    """
+    Groups the forecast rows by location.
+
+    Probabilistic forecasts also carry their quantiles ('AQI p10' becomes 'p10')
+    and the chance of reaching every AQI category.
+    """
+    if 'Location' not in df.columns:
+        # Forecasts written before locations existed only cover the legacy location
+        df['Location'] = LEGACY_LOCATION
+    quantile_columns = [col for col in df.columns if col.startswith('AQI p')]
+    probability_columns = [col for col in df.columns if col.startswith('P(') and col.endswith(' or worse)')]
+
+    def entry(row):
+        item = {'date': str(row['Date']), 'predicted_aqi': round(float(row['Predicted AQI']), 1)}
+        item.update({col[len('AQI '):]: round(float(row[col]), 1) for col in quantile_columns})
+        if probability_columns:
+            item['category_probabilities'] = {col[len('P('):-len(' or worse)')]: round(float(row[col]), 3)
+                                              for col in probability_columns}
+        return item
+
+    return {slug: [entry(row) for _, row in rows.iterrows()] for slug, rows in df.groupby('Location', sort=False)}
+
+
+def parse_current(df):
+    return {'current_aqi': int(df['Current AQI'].iloc[0])}
+
+
+def parse_nowcast(df):
+    """
+    Today's and tomorrow's model forecast corrected with the latest readings (Common/Nowcast.py).
+    """
+    return [{'date': str(row['Date']), 'nowcast_aqi': round(float(row['Nowcast AQI']), 1),
+             'model_aqi': round(float(row['Model AQI']), 1), 'updated': str(row['Updated'])}
+            for _, row in df.iterrows()]
+
+
+def parse_history(df):
+    """
+    Reduces a location's air quality readings to the daily maximum AQI of the last HISTORY_DAYS days.
+    """
+    df = pd.DataFrame({'date': pd.to_datetime(df['date'].astype(str), format='%m/%d/%Y', errors='coerce'),
+                       'aqi': df['aqi']})
+    daily = df.dropna(subset=['date']).groupby('date')['aqi'].max().sort_index()
+    daily = daily[daily.index > daily.index.max() - pd.Timedelta(days=HISTORY_DAYS)] if len(daily) else daily
+    return [{'date': date.strftime('%m/%d/%Y'), 'max_aqi': int(aqi)} for date, aqi in daily.items()]
+
+
+class ServingCache:
+    """
+    Keeps the served files parsed and ready to send in memory.
+
+    A background thread checks the generation of every source file and only
+    downloads and parses the ones that changed. The air quality history also
+    picks up the batches the collectors flushed since its last compaction.
+    Every response body is rendered once per change, so requests are a
+    dictionary lookup.
+    """
+
+    def __init__(self, storage_client, locations):
+        self.locations = locations
+        forecast_bucket = storage_client.bucket(FORECAST_BUCKET_NAME)
+        air_quality_bucket = storage_client.bucket(AIR_QUALITY_BUCKET_NAME)
+
+        # (bucket, blob name, parser, whether it is written through the staging store) for every source,
+        # keyed by what it holds
+        self.sources = {('forecast', None): (forecast_bucket, FORECAST_FILENAME, parse_forecast, False)}
+        for location in locations:
+            for kind, filename, parser, staged in [('current', CURRENT_AQI_FILENAME, parse_current, False),
+                                                   ('nowcast', NOWCAST_FILENAME, parse_nowcast, False),
+                                                   ('history', ALL_AIR_QUALITY_DATA_FILENAME, parse_history, True)]:
+                # Moves files from before locations existed into the legacy location's partition
+                location_blob(air_quality_bucket, location, filename)
+                self.sources[(kind, location['slug'])] = (air_quality_bucket, location_blob_name(location, filename),
+                                                          parser, staged)
+
+        self.generations = {}
+        self.values = {}
+        self.responses = {}
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Reloads the sources whose generation changed. Returns how many were reloaded.
+        """
+        changed = 0
+        for key, (bucket, name, parser, staged) in self.sources.items():
+            try:
+                if staged:
+                    generation = staged_version(bucket, name)
+                else:
+                    blob = bucket.get_blob(name)
+                    generation = blob.generation if blob else None
+                if generation is None or generation == self.generations.get(key):
+                    continue
+                df = read_staged_csv(bucket, name) if staged else pd.read_csv(io.BytesIO(blob.download_as_bytes()))
+                value = parser(df)
+            except Exception as e:
+                # Keep serving what was loaded last
+                print(f"Error refreshing {name}: {e}")
+                continue
+            self.values[key] = value
+            self.generations[key] = generation
+            changed += 1
+
+        self.refreshed_at = time.time()
+        if changed or not self.responses:
+            self.render()
+        return changed
+
+    def render(self):
+        """
+        Renders every response body and swaps them in at once.
+        """
+        forecasts = self.values.get(('forecast', None), {})
+        documents = {}
+        for location in self.locations:
+            slug = location['slug']
+            documents[f'/forecast/{slug}'] = {'location': slug, 'forecast': forecasts.get(slug, [])}
+            documents[f'/current/{slug}'] = dict({'location': slug}, **self.values.get(('current', slug), {}))
+            documents[f'/nowcast/{slug}'] = {'location': slug, 'nowcast': self.values.get(('nowcast', slug), [])}
+            documents[f'/history/{slug}'] = {'location': slug, 'history': self.values.get(('history', slug), [])}
+        documents['/forecast'] = dict(forecasts)
+        documents['/current'] = {slug: value['current_aqi'] for (kind, slug), value in self.values.items()
+                                 if kind == 'current'}
+
+        responses = {}
+        for path, document in documents.items():
+            body = json.dumps(document, separators=(',', ':')).encode('utf-8')
+            responses[path] = (body, f'"{hashlib.sha1(body).hexdigest()[:16]}"')
+
+        with self.lock:
+            self.responses = responses
+
+    def response(self, path):
+        with self.lock:
+            return self.responses.get(path)
+
+    def run(self, interval=REFRESH_SECONDS):
+        while True:
+            time.sleep(interval)
+            self.refresh()
+
+
+class AQIRequestHandler(BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/') or '/'
+        if path == '/health':
+            age = time.time() - self.cache.refreshed_at if self.cache.refreshed_at else None
+            body = json.dumps({'status': 'ok', 'seconds_since_refresh': age}).encode('utf-8')
+            return self.send_body(200, body, cache_control='no-store')
+
+        response = self.cache.response(path)
+        if response is None:
+            return self.send_body(404, b'{"error":"not found"}', cache_control='no-store')
+
+        body, etag = response
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_body(200, body, etag=etag)
+
+    def send_body(self, status, body, etag=None, cache_control=f'public, max-age={MAX_AGE_SECONDS}'):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', cache_control)
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Logging every request would cost more than serving it
+        pass
+
+
+def serve(host=HOST, port=PORT, refresh_seconds=REFRESH_SECONDS):
+    """
+    Loads the served files once, then serves them while a background thread keeps them fresh.
+    """
+    cache = ServingCache(get_storage_client(), active_locations())
+    print(f"Loaded {cache.refresh()} source files")
+    threading.Thread(target=cache.run, args=(refresh_seconds,), daemon=True).start()
+
+    AQIRequestHandler.cache = cache
+    server = ThreadingHTTPServer((host, port), AQIRequestHandler)
+    print(f"Serving AQI forecasts on http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves the latest AQI forecast, current AQI and history as JSON.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--refresh-seconds', type=int, default=REFRESH_SECONDS)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.refresh_seconds)
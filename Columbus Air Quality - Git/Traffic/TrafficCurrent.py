@@ -3,39 +3,55 @@ import datetime
 import time
 import requests
 import pandas as pd
-from google.cloud import storage
 import os
-import tempfile
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Dtype_Policy import apply_dtype_policy
+import Clock
+from Http_Client import http_get
+from Locations import active_locations, MAX_CONCURRENT_LOCATIONS
+from Staging import flush, stage_rows
+from Storage import location_blob_name
+from Traffic_Rollups import DAILY_ROLLUP_HOUR, close_periods, fold_samples
 
 # TomTom API configuration (replace with your actual key)
+# The highway segments of each location are listed in Common/Locations.py
 TOMTOM_API_KEY = 'YOUR_TOMTOM_API_KEY'
 
-# Highway segments we're interested in, with their locations
-highway_segments = {
-    "I-70 West Downtown": (39.973589, -83.082973),
-    "I-70 East Downtown": (39.952439, -82.945859),
-    "I-71 North Downtown": (40.007293, -82.985081),
-    "I-71 South Downtown": (39.907918, -83.023019),
-    "I-315 North Downtown": (39.998029, -83.026691),
-    "I-670 West Downtown": (39.966024, -83.036566),
-    "I-670 East Downtown": (39.978885, -82.970333),
-}
-
 # Google Cloud Storage configuration
 # (replace with your actual service account key file path)
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'PATH_TO_YOUR_SERVICE_ACCOUNT_KEY_FILE.json'
 STORAGE_BUCKET_NAME = 'YOUR_STORAGE_BUCKET_NAME'
 
+# 'snapshots' saves every reading of the four daily runs. 'stream' polls every SAMPLE_MINUTES,
+# folds the readings into running per-segment aggregates and only saves one rollup row per
+# segment and period ('hour' or 'day')
+TRAFFIC_SAMPLING = os.environ.get('AQ_TRAFFIC_SAMPLING', 'snapshots')
+SAMPLE_MINUTES = 5
+ROLLUP_PERIOD = os.environ.get('AQ_TRAFFIC_ROLLUP_PERIOD', 'hour')
+
 def get_and_save_traffic_data():
     """
-    Gets traffic data for specific highway segments and saves it to cloud storage
+    Gets traffic data for every location with highway segments at the same time
+    """
+    locations = [location for location in active_locations() if location['traffic_segments']]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOCATIONS) as pool:
+        list(pool.map(get_and_save_location_traffic_data, locations))
+
+
+def get_and_save_location_traffic_data(location):
+    """
+    Gets traffic data for one location's highway segments and stages it for its cloud storage partition
     """
 
     try:
         # Create an empty table to store all the traffic data
         all_traffic_data = pd.DataFrame(columns=['timestamp', 'segment_name', 'frc', 'currentSpeed', 'freeFlowSpeed'])
 
-        for segment_name, (center_lat, center_lon) in highway_segments.items():
+        for segment_name, (center_lat, center_lon) in location['traffic_segments'].items():
             # Set how much area around the highway segment to look at
             zoom_level = 13
             radius_degrees = 0.02
@@ -50,13 +66,13 @@ def get_and_save_traffic_data():
             url = f"https://api.tomtom.com/traffic/services/4/flowSegmentData/absolute/{zoom_level}/json?key={TOMTOM_API_KEY}&bbox={bbox[0]},{bbox[1]},{bbox[2]},{bbox[3]}&point={center_lat},{center_lon}"
 
             # Get traffic data
-            response = requests.get(url)
+            response = http_get('tomtom', url)
             response.raise_for_status()
 
             data = response.json()
 
             # Get the current time in Eastern Daylight Time (EDT)
-            edt_now = datetime.datetime.now(tz=datetime.timezone(datetime.timedelta(hours=-4)))
+            edt_now = Clock.now(tz=datetime.timezone(datetime.timedelta(hours=-4)))
 
             if isinstance(data, dict) and 'flowSegmentData' in data:
                 flow_segment_data = data['flowSegmentData']
@@ -82,38 +98,54 @@ def get_and_save_traffic_data():
             else:
                 print(f"API Error or Unexpected Response for {segment_name}: {data}")
 
-        # Connect to cloud storage
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(STORAGE_BUCKET_NAME)
-
-        # Save all the traffic data to cloud storage
+        all_traffic_data = apply_dtype_policy(all_traffic_data)
         blob_name = 'traffic_data_all_segments.csv'
-        traffic_data_blob = bucket.blob(blob_name)
-        if traffic_data_blob.exists():
-            # Add new data to the existing file
-            with tempfile.NamedTemporaryFile(mode='w+', delete=False) as temp_file:
-                traffic_data_blob.download_to_filename(temp_file.name)
-                existing_data = pd.read_csv(temp_file.name)
-            updated_data = pd.concat([existing_data, all_traffic_data], ignore_index=True)
-            traffic_data_blob.upload_from_string(updated_data.to_csv(index=False), content_type='text/csv')
-            os.remove(temp_file.name)
-        else:
-            # Create a new file to store the traffic data
-            traffic_data_blob.upload_from_string(all_traffic_data.to_csv(index=False), content_type='text/csv')
-
-        print(f"Traffic data for all segments fetched and saved successfully!")
 
-    except requests.exceptions.RequestException as e:
-        print(f"API Error: {e}")
+        if TRAFFIC_SAMPLING == 'stream':
+            # Add the readings to the open period, and stage the rollups of the periods that just ended.
+            # Only daily rollups count the hours before 4 AM to the day before, an hourly rollup
+            # is dated with the calendar day of its hour.
+            if ROLLUP_PERIOD == 'hour':
+                day, hour = edt_now.strftime('%m/%d/%Y'), edt_now.hour
+            else:
+                day, hour = today, DAILY_ROLLUP_HOUR
+            fold_samples(location['slug'], all_traffic_data, day, hour, SAMPLE_MINUTES)
+            n_rollups = close_periods(location['slug'], day, hour, STORAGE_BUCKET_NAME,
+                                      location_blob_name(location, blob_name))
+            print(f"Traffic data for all {location['name']} segments sampled, {n_rollups} rollups staged")
+            return
 
+        # Stage the traffic data, the flusher appends it to cloud storage in batches
+        stage_rows(STORAGE_BUCKET_NAME, location_blob_name(location, blob_name), all_traffic_data)
 
-# Schedule the task to run at 9 AM, 12 PM, 5 PM, and 9 PM every day
-schedule.every().day.at("09:00").do(get_and_save_traffic_data)
-schedule.every().day.at("12:00").do(get_and_save_traffic_data)
-schedule.every().day.at("17:00").do(get_and_save_traffic_data)
-schedule.every().day.at("21:00").do(get_and_save_traffic_data)
+        print(f"Traffic data for all {location['name']} segments fetched and staged successfully!")
+
+    except requests.exceptions.RequestException as e:
+        print(f"API Error for {location['name']}: {e}")
 
-# Keep the script running to check for scheduled tasks
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+
+def schedule_jobs(scheduler=schedule.default_scheduler):
+    """
+    Schedules this script's jobs (the replay harness reads them from here too).
+    """
+    if TRAFFIC_SAMPLING == 'stream':
+        # Poll every few minutes
+        scheduler.every(SAMPLE_MINUTES).minutes.do(get_and_save_traffic_data)
+    else:
+        # Schedule the task to run at 9 AM, 12 PM, 5 PM, and 9 PM every day
+        scheduler.every().day.at("09:00").do(get_and_save_traffic_data)
+        scheduler.every().day.at("12:00").do(get_and_save_traffic_data)
+        scheduler.every().day.at("17:00").do(get_and_save_traffic_data)
+        scheduler.every().day.at("21:00").do(get_and_save_traffic_data)
+
+    # Push the staged data to cloud storage once it is due
+    scheduler.every().minute.do(flush)
+
+
+if __name__ == '__main__':
+    schedule_jobs()
+
+    # Keep the script running to check for scheduled tasks
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
\ No newline at end of file
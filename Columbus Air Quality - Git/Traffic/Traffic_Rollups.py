@@ -0,0 +1,131 @@
+import os
+import sys
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Staging import STAGING_DB_PATH, connect, stage_rows, transaction
+
+# Speed differences (free flow minus current, in mph) are counted in 1 mph bins for the percentiles.
+# Anything faster than free flow counts as 0, anything past the last bin counts in the last bin.
+HISTOGRAM_BINS = 100
+
+# A sample counts as congested when the current speed is below this share of the free flow speed
+CONGESTION_RATIO = 0.75
+
+# Hour stored for daily rollups, which cover the whole day
+DAILY_ROLLUP_HOUR = -1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traffic_rollup_state (
+    location TEXT NOT NULL,
+    segment_name TEXT NOT NULL,
+    day TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    frc TEXT,
+    samples INTEGER NOT NULL,
+    current_total REAL NOT NULL,
+    free_flow_total REAL NOT NULL,
+    difference_min REAL NOT NULL,
+    difference_max REAL NOT NULL,
+    histogram BLOB NOT NULL,
+    congestion_minutes REAL NOT NULL,
+    PRIMARY KEY (location, segment_name, day, hour)
+) WITHOUT ROWID;
+"""
+
+
+def connect_state(path=STAGING_DB_PATH):
+    # The running aggregates live next to the staged rows
+    connection = connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def histogram_percentile(histogram, q):
+    """
+    Approximates a percentile of the speed difference from its histogram (to the nearest mph).
+    """
+    total = histogram.sum()
+    if total == 0:
+        return np.nan
+    return float(np.searchsorted(np.cumsum(histogram), q * total))
+
+
+def fold_samples(location_slug, samples, day, hour, interval_minutes, path=STAGING_DB_PATH):
+    """
+    Adds one poll's readings to the running aggregates of every segment.
+
+    `samples` holds 'segment_name', 'frc', 'currentSpeed' and 'freeFlowSpeed'
+    for the period `day` / `hour`. Every congested sample adds
+    `interval_minutes` to the segment's congestion minutes.
+    """
+    with closing(connect_state(path)) as connection, transaction(connection):
+        for sample in samples.itertuples(index=False):
+            current, free_flow = float(sample.currentSpeed), float(sample.freeFlowSpeed)
+            difference = free_flow - current
+            congested = interval_minutes if current < CONGESTION_RATIO * free_flow else 0
+
+            state = connection.execute(
+                'SELECT samples, current_total, free_flow_total, difference_min, difference_max, histogram, '
+                'congestion_minutes FROM traffic_rollup_state '
+                'WHERE location = ? AND segment_name = ? AND day = ? AND hour = ?',
+                (location_slug, sample.segment_name, day, hour)).fetchone()
+            if state is None:
+                state = (0, 0.0, 0.0, difference, difference, np.zeros(HISTOGRAM_BINS, np.uint32).tobytes(), 0.0)
+
+            n, current_total, free_flow_total, minimum, maximum, histogram, congestion_minutes = state
+            histogram = np.frombuffer(histogram, dtype=np.uint32).copy()
+            histogram[int(np.clip(difference, 0, HISTOGRAM_BINS - 1))] += 1
+
+            connection.execute('INSERT OR REPLACE INTO traffic_rollup_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (location_slug, sample.segment_name, day, hour, str(sample.frc), n + 1,
+                                current_total + current, free_flow_total + free_flow,
+                                min(minimum, difference), max(maximum, difference), histogram.tobytes(),
+                                congestion_minutes + congested))
+
+
+def close_periods(location_slug, open_day, open_hour, bucket_name, blob_name, path=STAGING_DB_PATH):
+    """
+    Turns the aggregates of every period other than the open one into rollup rows and stages them.
+
+    The rows have the same columns as the raw snapshots (with the mean speeds)
+    plus the sample count, the hour and the streaming statistics.
+    Returns the number of rows staged.
+    """
+    with closing(connect_state(path)) as connection, transaction(connection):
+        finished = connection.execute(
+            'SELECT segment_name, day, hour, frc, samples, current_total, free_flow_total, difference_min, '
+            'difference_max, histogram, congestion_minutes FROM traffic_rollup_state '
+            'WHERE location = ? AND NOT (day = ? AND hour = ?) ORDER BY day, hour, segment_name',
+            (location_slug, open_day, open_hour)).fetchall()
+        if not finished:
+            return 0
+
+        rows = []
+        for segment_name, day, hour, frc, n, current_total, free_flow_total, minimum, maximum, histogram, \
+                congestion_minutes in finished:
+            histogram = np.frombuffer(histogram, dtype=np.uint32)
+            rows.append({
+                'timestamp': day,
+                'hour': hour if hour != DAILY_ROLLUP_HOUR else None,
+                'segment_name': segment_name,
+                'frc': frc,
+                'currentSpeed': round(current_total / n, 2),
+                'freeFlowSpeed': round(free_flow_total / n, 2),
+                'samples': n,
+                'speed_difference_min': minimum,
+                'speed_difference_max': maximum,
+                'speed_difference_p50': histogram_percentile(histogram, 0.5),
+                'speed_difference_p90': histogram_percentile(histogram, 0.9),
+                'congestion_minutes': congestion_minutes,
+            })
+
+        # Staged in the same transaction the aggregates are dropped in, so a period is written exactly once
+        stage_rows(bucket_name, blob_name, pd.DataFrame(rows), connection=connection)
+        connection.execute('DELETE FROM traffic_rollup_state WHERE location = ? AND NOT (day = ? AND hour = ?)',
+                           (location_slug, open_day, open_hour))
+    return len(rows)
@@ -3,44 +3,63 @@ import datetime
 import time
 import requests
 import pandas as pd
-from google.cloud import storage
 import os
-import tempfile
-import csv
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Dtype_Policy import apply_dtype_policy
+import Clock
+from Http_Client import http_get
+from Locations import active_locations, MAX_CONCURRENT_LOCATIONS
+from Staging import UPSERT_KEYS, flush, stage_upserts
+from Storage import location_blob_name
 
 # Weatherstack API configuration (replace with your actual key)
+# The place queried for each location is set in Common/Locations.py
 WEATHERSTACK_API_KEY = 'YOUR_WEATHERSTACK_API_KEY'
 
-# Location for weather data
-LOCATION = "Columbus, Ohio"
-
 # Google Cloud Storage configuration
 # (replace with your actual service account key file path)
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'PATH_TO_YOUR_SERVICE_ACCOUNT_KEY_FILE.json'
 STORAGE_BUCKET_NAME = 'YOUR_STORAGE_BUCKET_NAME'
 
+# Hours of the day the current weather is collected (Backfill.py fetches the same hours)
+COLLECTION_HOURS = [4, 16]
+
 # File name within the storage bucket
 ALL_WEATHER_DATA_FILENAME = 'weather_data_all.csv'
 
 def get_and_save_weather_data():
     """
-    Gets current weather data and saves it to cloud storage.
+    Gets current weather data for every location at the same time.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOCATIONS) as pool:
+        list(pool.map(get_and_save_location_weather_data, active_locations()))
+
+
+def get_and_save_location_weather_data(location):
+    """
+    Gets current weather data for one location and stages it for its cloud storage partition.
     """
     try:
         # Build the web address to get weather data
         base_url = "http://api.weatherstack.com/current"
-        url = f"{base_url}?access_key={WEATHERSTACK_API_KEY}&query={LOCATION}"
+        url = f"{base_url}?access_key={WEATHERSTACK_API_KEY}&query={location['weather_query']}"
 
         # Get weather data
-        response = requests.get(url)
+        response = http_get('weatherstack', url)
         response.raise_for_status()
 
         data = response.json()
 
         if data and data['current']:
             # Organize the weather data into a table
+            now = Clock.now()
             weather_data = pd.DataFrame([{
-                'date': pd.Timestamp.now().strftime('%-m/%-d/%Y'),  # Date in month/day/year format
+                'date': now.strftime('%-m/%-d/%Y'),  # Date in month/day/year format
+                'hour': now.hour,
                 'temperature': data['current']['temperature'],
                 'description': data['current']['weather_descriptions'],
                 'humidity': data['current']['humidity'],
@@ -54,59 +73,37 @@ def get_and_save_weather_data():
                 'visibility': data['current']['visibility']
             }])
 
-            # Connect to cloud storage
-            storage_client = storage.Client()
-            bucket = storage_client.bucket(STORAGE_BUCKET_NAME)
-
-            # Get the file to store weather data
-            weather_data_blob = bucket.blob(ALL_WEATHER_DATA_FILENAME)
-
-            if weather_data_blob.exists():
-                # Add new weather data to the existing file
-                with tempfile.NamedTemporaryFile(mode='w+', delete=False) as temp_file:
-                    weather_data_blob.download_to_filename(temp_file.name)
-
-                    with open(temp_file.name, 'r') as csvfile:
-                        reader = csv.reader(csvfile)
-                        rows = list(reader)
-
-                    # Make sure all dates are in the same format
-                    if rows and len(rows[0]) > 0 and rows[0][0] == 'date':
-                        for row in rows[1:]:
-                            if row:
-                                try:
-                                    # Try to understand the date format and convert it if needed
-                                    pd.to_datetime(row[0], format='%Y-%m-%d')
-                                    row[0] = pd.to_datetime(row[0], format='%Y-%m-%d').strftime('%-m/%-d/%Y')
-                                except ValueError:
-                                    try:
-                                        pd.to_datetime(row[0], format='%m-%d-%Y')
-                                        row[0] = pd.to_datetime(row[0], format='%m-%d-%Y').strftime('%-m/%-d/%Y')
-                                    except ValueError:
-                                        pass
-
-                    existing_data = pd.DataFrame(rows[1:], columns=rows[0])
-                updated_data = pd.concat([existing_data, weather_data], ignore_index=True)
-                weather_data_blob.upload_from_string(updated_data.to_csv(index=False), content_type='text/csv')
-                os.remove(temp_file.name)
-
-            else:
-                # Create a new file to store weather data
-                weather_data_blob.upload_from_string(weather_data.to_csv(index=False), content_type='text/csv')
-
-            print(f"Weather data fetched and saved successfully!")
+            weather_data = apply_dtype_policy(weather_data)
+
+            # Stage the reading, the flusher appends it to cloud storage in batches. A failed upload
+            # keeps it staged instead of losing it, and a backfilled reading of the same hour is replaced.
+            stage_upserts(STORAGE_BUCKET_NAME, location_blob_name(location, ALL_WEATHER_DATA_FILENAME),
+                          weather_data, UPSERT_KEYS[ALL_WEATHER_DATA_FILENAME])
+
+            print(f"Weather data for {location['name']} fetched and staged successfully!")
 
         else:
-            print("No weather data available or unexpected API response.")
+            print(f"No weather data available for {location['name']} or unexpected API response.")
 
     except requests.exceptions.RequestException as e:
-        print(f"API Error: {e}")
+        print(f"API Error for {location['name']}: {e}")
+
+def schedule_jobs(scheduler=schedule.default_scheduler):
+    """
+    Schedules this script's jobs (the replay harness reads them from here too).
+    """
+    # Run this script twice a day, at 4 AM and 4 PM
+    for hour in COLLECTION_HOURS:
+        scheduler.every().day.at(f"{hour:02d}:00").do(get_and_save_weather_data)
+
+    # Push the staged data to cloud storage once it is due
+    scheduler.every().minute.do(flush)
+
 
-# Run this script twice a day, at 4 AM and 4 PM
-schedule.every().day.at("04:00").do(get_and_save_weather_data)
-schedule.every().day.at("16:00").do(get_and_save_weather_data)
+if __name__ == '__main__':
+    schedule_jobs()
 
-# Keep the script running to check for scheduled tasks
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+    # Keep the script running to check for scheduled tasks
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
\ No newline at end of file
@@ -1,8 +1,16 @@
 import requests
 import pandas as pd
 import os
+import sys
 from datetime import datetime, timedelta
 
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Http_Client import http_get
+
+# Pulls a range into a local CSV for a quick look. To fill the storage the live collectors write to,
+# use Backfill/Backfill.py, which fetches every source in parallel and resumes interrupted runs.
+
 def get_past_weather_data(api_key, location, start_date, end_date, data_interval_hours=12):
     """
     Gets past weather data from the Weatherstack API for a specific time period.
@@ -30,7 +38,7 @@ def get_past_weather_data(api_key, location, start_date, end_date, data_interval
     }
 
     try:
-        response = requests.get(base_url, params=params)
+        response = http_get('weatherstack', base_url, params=params)
         response.raise_for_status()
 
         data = response.json()
@@ -1,13 +1,19 @@
 import requests
-from datetime import datetime, timedelta
+from datetime import timedelta
 import pandas as pd
 from io import StringIO
-from google.cloud import storage
 import os
-import tempfile
+import sys
 import schedule
 import time
 
+# Shared helpers for all the scripts live in the Common folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from Dtype_Policy import apply_dtype_policy
+import Clock
+from Http_Client import http_get
+from Staging import UPSERT_KEYS, flush, stage_object, stage_upserts
+
 # NASA FIRMS API configuration (replace with your actual key)
 NASA_FIRMS_API_KEY = 'YOUR_NASA_FIRMS_API_KEY'
 DATA_SOURCE = 'MODIS_NRT'
@@ -24,11 +30,11 @@ BINNED_WILDFIRE_DATA_FILENAME = 'wildfire_data_binned.csv'
 
 def get_wildfire_data_and_store():
     """
-    Gets wildfire data from yesterday, saves it to cloud storage,
+    Gets wildfire data from yesterday, stages it for cloud storage,
     and organizes the data by country and date.
     """
 
-    today = datetime.today()
+    today = Clock.now()
     yesterday = today - timedelta(days=1)
 
     # Build the web address to get wildfire data
@@ -36,7 +42,7 @@ def get_wildfire_data_and_store():
 
     try:
         # Get wildfire data
-        response = requests.get(api_endpoint)
+        response = http_get('firms', api_endpoint)
         response.raise_for_status()
 
         # Organize the data into a table
@@ -53,61 +59,44 @@ def get_wildfire_data_and_store():
 
         wildfire_data['Country'] = wildfire_data['latitude'].apply(categorize_country)
 
+        # The raw FIRMS table has a lot of wide columns, keep them as small as the values allow
+        wildfire_data = apply_dtype_policy(wildfire_data, ALL_WILDFIRE_DATA_FILENAME)
+
         # Summarize fire intensity by country for yesterday
-        yesterday_summary = wildfire_data.groupby('Country')['frp'].sum().reset_index()
+        yesterday_summary = wildfire_data.groupby('Country', observed=True)['frp'].sum().reset_index()
         yesterday_summary['Date'] = yesterday.strftime('%Y-%m-%d')
 
-        # Change date format to month-day-year
-        yesterday_summary['Date'] = pd.to_datetime(yesterday_summary['Date']).dt.strftime('%m-%d-%Y')
-
-        # Connect to cloud storage
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(STORAGE_BUCKET_NAME)
-
-        # Handle organized (binned) data storage and updates
-        binned_data_blob = bucket.blob(BINNED_WILDFIRE_DATA_FILENAME)
-        if binned_data_blob.exists():
-            # Add to existing organized data
-            with tempfile.NamedTemporaryFile(mode='w+', delete=False) as temp_file:
-                binned_data_blob.download_to_filename(temp_file.name)
-                existing_summary = pd.read_csv(temp_file.name)
-
-                # Make sure all dates are in the same format
-                if 'Date' in existing_summary.columns:
-                    for i, row in existing_summary.iterrows():
-                        if row['Date']:
-                            try:
-                                date_obj = pd.to_datetime(row['Date'], format='%Y-%m-%d')
-                            except ValueError:
-                                pass
-                            else:
-                                if pd.notnull(date_obj):
-                                    existing_summary.at[i, 'Date'] = date_obj.strftime('%m-%d-%Y')
-
-            updated_summary = pd.concat([existing_summary, yesterday_summary], ignore_index=True)
-
-            # Make sure all dates use slashes instead of dashes
-            updated_summary['Date'] = updated_summary['Date'].astype(str).str.replace('-', '/')
-            binned_data_blob.upload_from_string(updated_summary.to_csv(index=False), content_type='text/csv')
-            os.remove(temp_file.name)
-        else:
-            # Create a new file for organized data
-            yesterday_summary['Date'] = yesterday_summary['Date'].astype(str).str.replace('-', '/')
-            binned_data_blob.upload_from_string(yesterday_summary.to_csv(index=False), content_type='text/csv')
-
-        # Save all the new wildfire data, replacing the old data
-        all_data_blob = bucket.blob(ALL_WILDFIRE_DATA_FILENAME)
-        all_data_blob.upload_from_string(wildfire_data.to_csv(index=False), content_type='text/csv')
-
-        print(f"Wildfire data for {yesterday.strftime('%Y-%m-%d')} fetched, saved, and organized successfully!")
+        # Change date format to month/day/year
+        yesterday_summary['Date'] = pd.to_datetime(yesterday_summary['Date']).dt.strftime('%m/%d/%Y')
+        yesterday_summary = apply_dtype_policy(yesterday_summary, BINNED_WILDFIRE_DATA_FILENAME)
+
+        # Stage the organized (binned) data, the flusher appends it to cloud storage in batches
+        stage_upserts(STORAGE_BUCKET_NAME, BINNED_WILDFIRE_DATA_FILENAME, yesterday_summary,
+                      UPSERT_KEYS[BINNED_WILDFIRE_DATA_FILENAME])
+
+        # Stage all the new wildfire data, it replaces the old data on the next flush
+        stage_object(STORAGE_BUCKET_NAME, ALL_WILDFIRE_DATA_FILENAME, wildfire_data.to_csv(index=False))
+
+        print(f"Wildfire data for {yesterday.strftime('%Y-%m-%d')} fetched, staged, and organized successfully!")
 
     except requests.exceptions.RequestException as e:
         print(f"Error getting wildfire data: {e}")
 
-# Run this script every day at 7:58 PM
-schedule.every().day.at("19:58").do(get_wildfire_data_and_store)
+def schedule_jobs(scheduler=schedule.default_scheduler):
+    """
+    Schedules this script's jobs (the replay harness reads them from here too).
+    """
+    # Run this script every day at 7:58 PM
+    scheduler.every().day.at("19:58").do(get_wildfire_data_and_store)
+
+    # Push the staged data to cloud storage once it is due
+    scheduler.every().minute.do(flush)
+
+
+if __name__ == '__main__':
+    schedule_jobs()
 
-# Keep the script running to check for scheduled tasks
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+    # Keep the script running to check for scheduled tasks
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
\ No newline at end of file
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The scripts import each other by module name from their project folders, like they do when run
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ['Common', 'Data Manipulation', 'Machine Learning Model']:
+    sys.path.insert(0, os.path.join(ROOT, folder))
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import AQI_Calculator
+
+
+def hours(values, start='2024-07-01 00:00'):
+    index = pd.date_range(start, periods=len(values), freq='h')
+    return pd.DataFrame({'site': np.asarray(values, dtype=float)}, index=index)
+
+
+@pytest.mark.parametrize('concentration, aqi', [
+    (0.0, 0), (9.0, 50), (9.1, 51), (12.0, 56), (35.4, 100), (35.5, 101),
+    (55.45, 150),  # Truncated to 55.4 first
+    (325.4, 500), (400.0, 500),
+])
+def test_pm25_breakpoints(concentration, aqi):
+    assert AQI_Calculator.pollutant_aqi_values([concentration], 'PM2.5')[0] == aqi
+
+
+def test_missing_concentrations_stay_missing():
+    assert np.isnan(AQI_Calculator.pollutant_aqi_values([np.nan], 'PM2.5')[0])
+
+
+def test_pm10_past_its_table_is_500():
+    assert AQI_Calculator.pollutant_aqi_values([700], 'PM10')[0] == 500
+
+
+def test_ozone_8_hour_table_leaves_values_past_it_missing():
+    aqi = AQI_Calculator.pollutant_aqi_values([50, 70, 150, 200, 201, 250], 'OZONE')
+    np.testing.assert_array_equal(aqi, [46, 100, 247, 300, np.nan, np.nan])
+
+
+def test_ozone_1_hour_table_starts_at_125_ppb():
+    aqi = AQI_Calculator.concentration_to_aqi([124, 125, 210], AQI_Calculator.OZONE_1_HOUR_BREAKPOINTS, 0)
+    np.testing.assert_array_equal(aqi, [np.nan, 101, 203])
+
+
+@pytest.mark.parametrize('ppb, aqi', [(210, 203), (420, 316)])
+def test_high_ozone_uses_the_1_hour_table(ppb, aqi):
+    hourly = hours([ppb] * 8)
+    assert AQI_Calculator.hourly_aqi(hourly, 'OZONE')['site'].iloc[-1] == aqi
+    assert AQI_Calculator.daily_aqi(hourly, 'OZONE')['site'].iloc[0] == aqi
+
+
+def test_nowcast_of_steady_air_is_the_concentration():
+    np.testing.assert_allclose(AQI_Calculator.nowcast(hours([20.0] * 12))['site'].iloc[-1], 20.0)
+
+
+def test_nowcast_weight_has_a_floor():
+    # The lowest hour over the highest is 1/12, so the weight is the 0.5 floor:
+    # sum(0.5 ** i * (12 - i)) / sum(0.5 ** i) over the 12 hours
+    result = AQI_Calculator.nowcast(hours(np.arange(1.0, 13.0)))['site']
+    np.testing.assert_allclose(result.iloc[-1], 11.0029304, rtol=1e-6)
+
+
+def test_nowcast_weighs_recent_hours_more():
+    # Weight 8/10, so (10 + 0.8 * 8) / (1 + 0.8)
+    result = AQI_Calculator.nowcast(hours([np.nan] * 10 + [8.0, 10.0]))['site']
+    np.testing.assert_allclose(result.iloc[-1], 16.4 / 1.8)
+
+
+def test_nowcast_needs_two_of_the_last_three_hours():
+    result = AQI_Calculator.nowcast(hours([10.0] * 9 + [10.0, np.nan, np.nan]))['site']
+    assert np.isnan(result.iloc[-1])
+    assert not np.isnan(result.iloc[-2])
@@ -0,0 +1,110 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Feature_Store
+
+
+def history(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'Date': pd.date_range('2020-01-01', periods=n_rows, freq='D')})
+    for column in ['MaxAQI', 'USA', 'Canada', 'temperature', 'TotalSpeedDifference']:
+        df[column] = rng.normal(50, 10, n_rows)
+    df.loc[rng.random(n_rows) < 0.1, 'USA'] = np.nan
+    return df
+
+
+def from_scratch(df, tmp_path):
+    path = os.path.join(tmp_path, 'scratch.sqlite')
+    if os.path.exists(path):
+        os.remove(path)
+    return Feature_Store.add_features(df, path=path)
+
+
+def assert_same_features(actual, expected):
+    for name in Feature_Store.feature_names():
+        np.testing.assert_allclose(actual[name], expected[name], rtol=1e-6, equal_nan=True, err_msg=name)
+
+
+def stored_rows(path):
+    with sqlite3.connect(path) as connection:
+        return connection.execute('SELECT COUNT(*) FROM feature_rows').fetchone()[0]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return os.path.join(tmp_path, 'store.sqlite')
+
+
+def test_unchanged_history_recomputes_nothing(store, capsys):
+    df = history(500)
+    Feature_Store.add_features(df, path=store)
+    assert stored_rows(store) == 500
+    capsys.readouterr()
+
+    Feature_Store.add_features(df, path=store)
+    assert 'recomputed' not in capsys.readouterr().out
+    assert stored_rows(store) == 500
+
+
+def test_new_rows_only_recompute_the_tail(store, tmp_path, capsys):
+    df = history(500)
+    Feature_Store.add_features(df.iloc[:450], path=store)
+    capsys.readouterr()
+
+    result = Feature_Store.add_features(df, path=store)
+    assert 'recomputed 50 of 500 rows' in capsys.readouterr().out
+    assert stored_rows(store) == 500
+    assert_same_features(result, from_scratch(df, tmp_path))
+
+
+def test_corrected_recent_row_is_recomputed_from_there(store, tmp_path, capsys):
+    df = history(500)
+    Feature_Store.add_features(df, path=store)
+    capsys.readouterr()
+
+    corrected = df.copy()
+    corrected.loc[480, 'USA'] = 999.0
+    result = Feature_Store.add_features(corrected, path=store)
+    assert 'recomputed 20 of 500 rows' in capsys.readouterr().out
+    assert_same_features(result, from_scratch(corrected, tmp_path))
+
+
+def test_backfilled_history_is_recomputed(store, tmp_path):
+    df = history(500)
+    Feature_Store.add_features(df.iloc[50:], path=store)
+
+    result = Feature_Store.add_features(df, path=store)
+    assert stored_rows(store) == 500
+    assert_same_features(result, from_scratch(df, tmp_path))
+
+
+def test_removed_rows_leave_the_store(store, tmp_path):
+    df = history(500)
+    Feature_Store.add_features(df, path=store)
+
+    shorter = df.iloc[:490]
+    result = Feature_Store.add_features(shorter, path=store)
+    assert stored_rows(store) == 490
+    assert_same_features(result, from_scratch(shorter, tmp_path))
+
+
+def test_new_feature_is_filled_in_for_the_stored_history(store, tmp_path, monkeypatch):
+    df = history(300)
+    monkeypatch.setattr(Feature_Store, 'FEATURES', Feature_Store.FEATURES[:-2])
+    Feature_Store.add_features(df.iloc[:250], path=store)
+    monkeypatch.undo()
+
+    result = Feature_Store.add_features(df, path=store)
+    assert_same_features(result, from_scratch(df, tmp_path))
+    assert_same_features(Feature_Store.add_features(df, path=store), result)
+
+
+def test_ewm_matches_pandas():
+    spec = {'name': 'x_ewm7', 'column': 'x', 'kind': 'ewm', 'window': 7}
+    values = history(100)['USA'].values
+    expected = pd.Series(values).ewm(span=7, adjust=False, ignore_na=True).mean().values
+    np.testing.assert_allclose(Feature_Store.compute_feature(spec, values, 0), expected)
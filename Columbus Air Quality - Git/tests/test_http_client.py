@@ -0,0 +1,45 @@
+import pytest
+import requests
+
+import Http_Client
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def get(self, url, timeout=None, **kwargs):
+        return self.responses.pop(0)
+
+
+def response(status, retry_after=None):
+    result = requests.Response()
+    result.status_code = status
+    if retry_after is not None:
+        result.headers['Retry-After'] = str(retry_after)
+    return result
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waited = []
+    monkeypatch.setattr(Http_Client, 'acquire', lambda provider: None)
+    monkeypatch.setattr(Http_Client.time, 'sleep', waited.append)
+    return waited
+
+
+def serve(monkeypatch, *responses):
+    monkeypatch.setattr(Http_Client, '_session', lambda provider: (FakeSession(responses), Http_Client.CircuitBreaker()))
+
+
+def test_long_retry_after_fails_by_default(monkeypatch, sleeps):
+    serve(monkeypatch, response(429, 600), response(200))
+    assert Http_Client.http_get('airnow', 'https://example.com/').status_code == 429
+    assert sleeps == []
+
+
+def test_batch_callers_wait_out_long_retry_after(monkeypatch, sleeps):
+    serve(monkeypatch, response(429, 600), response(200))
+    result = Http_Client.http_get('airnow', 'https://example.com/', max_wait=Http_Client.BATCH_RETRY_AFTER_MAX)
+    assert result.status_code == 200
+    assert sleeps == [600]
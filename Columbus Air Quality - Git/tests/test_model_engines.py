@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+import Model_Engines
+
+
+class ConstantModel:
+    """
+    Always forecasts the same value, so the test errors are the targets minus it.
+    """
+    value = 100.0
+
+    def fit(self, X, y):
+        return self
+
+    def predict(self, X):
+        return np.full(len(X), self.value)
+
+
+def master(n_days=200, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2024-01-01', periods=n_days, freq='D')
+    frames = [pd.DataFrame({'Location': slug, 'MaxAQI': 100 + rng.exponential(30, n_days),
+                            'temperature': rng.normal(70, 10, n_days)}, index=dates)
+              for slug in ['columbus', 'dayton']]
+    return pd.concat(frames).sort_index(kind='stable')
+
+
+def test_samples_are_forecast_plus_actual_minus_forecast(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model_Engines.GradientBoostingEngine, 'new_model', staticmethod(lambda seed: ConstantModel()))
+    df = master()
+    engine = Model_Engines.GradientBoostingEngine(str(tmp_path), n_steps=3, step_size=pd.Timedelta(days=1))
+    engine.fit(df, ['temperature'])
+
+    samples = engine.predict_samples(df)
+    assert samples.shape == (2, Model_Engines.RESIDUAL_QUANTILES, 3)
+
+    # Every actual value is above the forecast, so every sample must be too
+    test_targets = df.loc[~Model_Engines.split_by_date(df.index), 'MaxAQI']
+    assert samples.min() >= ConstantModel.value
+    np.testing.assert_allclose(np.median(samples[0, :, 0]), test_targets.median(), rtol=0.1)
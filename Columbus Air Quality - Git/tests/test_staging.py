@@ -0,0 +1,70 @@
+import os
+
+import pandas as pd
+import pytest
+
+import Staging
+from Storage import LocalStorageClient
+
+BUCKET = 'columbus-weather-bucket'
+WEATHER_FILE = 'columbus/weather_data_all.csv'
+
+
+def weather(date, hour, temperature):
+    return pd.DataFrame([{'date': date, 'hour': hour, 'temperature': temperature, 'description': "['Sunny']"}])
+
+
+@pytest.fixture
+def staging(tmp_path):
+    return os.path.join(tmp_path, 'staging.sqlite')
+
+
+@pytest.fixture
+def client(tmp_path):
+    return LocalStorageClient(os.path.join(tmp_path, 'storage'))
+
+
+def test_live_reading_replaces_backfilled_hour(staging, client):
+    keys = Staging.UPSERT_KEYS['weather_data_all.csv']
+    Staging.stage_upserts(BUCKET, WEATHER_FILE, pd.concat([weather('7/1/2024', 4, 70), weather('7/1/2024', 16, 85)]),
+                          keys, path=staging)
+    Staging.flush(client, force=True, path=staging)
+    Staging.compact(client.bucket(BUCKET), WEATHER_FILE)
+
+    Staging.stage_upserts(BUCKET, WEATHER_FILE, weather('7/1/2024', 16, 84), keys, path=staging)
+    Staging.flush(client, force=True, path=staging)
+
+    df = Staging.read_staged_csv(client.bucket(BUCKET), WEATHER_FILE)
+    assert len(df) == 2
+    assert df.set_index('hour')['temperature'].to_dict() == {4: 70, 16: 84}
+
+
+def test_same_values_in_another_dtype_are_not_staged_again(staging):
+    keys = Staging.UPSERT_KEYS['weather_data_all.csv']
+    assert Staging.stage_upserts(BUCKET, WEATHER_FILE, weather('7/1/2024', 4, 70), keys, path=staging) == 1
+
+    as_floats = weather('7/1/2024', 4.0, 70.0)[['temperature', 'description', 'hour', 'date']]
+    assert Staging.stage_upserts(BUCKET, WEATHER_FILE, as_floats, keys, path=staging) == 0
+    assert Staging.stage_upserts(BUCKET, WEATHER_FILE, weather('7/1/2024', 4, 71.5), keys, path=staging) == 1
+
+
+def test_compaction_round_trip(staging, client, monkeypatch):
+    monkeypatch.setattr(Staging, 'COMPACT_AFTER_DELTAS', 3)
+    keys = Staging.UPSERT_KEYS['weather_data_all.csv']
+    for day in range(1, 6):
+        Staging.stage_upserts(BUCKET, WEATHER_FILE, pd.concat([weather(f'7/{day}/2024', 4, 60 + day),
+                                                               weather(f'7/{day}/2024', 16, 80 + day)]),
+                              keys, path=staging)
+        Staging.flush(client, force=True, path=staging)
+    bucket = client.bucket(BUCKET)
+    before = Staging.read_staged_csv(bucket, WEATHER_FILE)
+
+    # Re-reading what is stored and staging it again changes nothing
+    assert Staging.stage_upserts(BUCKET, WEATHER_FILE, before, keys, path=staging) == 0
+
+    Staging.compact(bucket, WEATHER_FILE)
+    assert Staging.list_deltas(bucket, WEATHER_FILE) == []
+    after = Staging.read_staged_csv(bucket, WEATHER_FILE)
+    pd.testing.assert_frame_equal(after, before)
+    assert len(after) == 10
+    assert after['temperature'].sum() == sum(60 + day + 80 + day for day in range(1, 6))
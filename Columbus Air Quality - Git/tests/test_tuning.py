@@ -0,0 +1,63 @@
+import json
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import LSTM
+import Tuning
+
+
+@pytest.fixture
+def search(tmp_path):
+    return Tuning.HyperparameterSearch(n_trials=6, deadline=time.time() + 3600, seed=0, tuning_dir=str(tmp_path))
+
+
+def start_trials(search):
+    jobs = [search.next_job() for _ in range(6)]
+    assert [(trial_id, rung) for trial_id, _, rung in jobs] == [(trial_id, 0) for trial_id in range(6)]
+    assert search.next_job() is None
+
+
+def test_best_third_of_a_rung_is_promoted(search):
+    start_trials(search)
+    for trial_id, val_loss in enumerate([5.0, 4.0, 3.0, 2.0, 1.0, 0.5]):
+        search.record(trial_id, 0, val_loss, 1.0)
+
+    # Best first, each promoted once
+    assert [job[::2] for job in [search.next_job(), search.next_job()]] == [(5, 1), (4, 1)]
+    assert search.next_job() is None
+    assert search.trials[5]['status'] == 'running'
+
+
+def test_failed_trial_ranks_last_and_is_not_promoted(search, tmp_path):
+    start_trials(search)
+    search.fail(5, 0, RuntimeError('out of memory'))
+    for trial_id, val_loss in enumerate([5.0, 4.0, 3.0, 2.0, 1.0]):
+        search.record(trial_id, 0, val_loss, 1.0)
+
+    assert search.trials[5]['status'] == 'failed'
+    assert [job[::2] for job in [search.next_job(), search.next_job()]] == [(4, 1), (3, 1)]
+    assert search.next_job() is None
+
+    leaderboard = pd.read_csv(os.path.join(tmp_path, Tuning.LEADERBOARD_FILENAME))
+    assert leaderboard.iloc[-1][['trial', 'status']].tolist() == [5, 'failed']
+    assert leaderboard.iloc[-1]['val_loss'] == float('inf')
+
+
+def test_failure_in_a_higher_rung_is_never_the_best(search, tmp_path):
+    start_trials(search)
+    for trial_id, val_loss in enumerate([5.0, 4.0, 3.0, 2.0, 1.0, 0.5]):
+        search.record(trial_id, 0, val_loss, 1.0)
+    assert search.next_job()[::2] == (5, 1)
+    search.fail(5, 1, RuntimeError('out of memory'))
+
+    # A new trial beats the rest of the first rung, the failed rung has no loss to compare with
+    search.n_trials = 7
+    assert search.next_job()[::2] == (4, 1)
+    assert search.next_job()[::2] == (6, 0)
+    search.record(6, 0, 0.1, 1.0)
+    with open(os.path.join(tmp_path, LSTM.BEST_CONFIG_FILENAME)) as f:
+        best = json.load(f)
+    assert (best['trial'], best['epochs'], best['val_loss']) == (6, Tuning.RUNG_EPOCHS[0], 0.1)